@@ -0,0 +1,93 @@
+"""
+    Compare the conversation schedulers with many concurrent flows.
+
+    Each flow starts at a random time in the first second and, every
+    time it is popped, is pushed back after an exponential gap (1 ms on
+    average), the way write_packets() reschedules a conversation after
+    it sends a packet.  "legacy" is the loop used before the scheduler
+    interface: a SortedDict of lists keyed by float seconds, popped with
+    popitem(index=0).
+
+    Usage: PYTHONPATH=src python benchmarks/bench_scheduler.py
+               [--flows 1000,100000,1000000] [--ops 200000]
+"""
+import argparse
+import random
+import time
+
+from sortedcontainers import SortedDict
+
+from sniffles.scheduler import SCHEDULERS, make_scheduler
+
+MEAN_GAP_NS = 1000000
+
+
+def start_times(flows):
+    return [random.randrange(1000000000) for _ in range(flows)]
+
+
+def run_scheduler(name, starts, ops):
+    scheduler = make_scheduler(name)
+    begin = time.perf_counter()
+    for flow, start in enumerate(starts):
+        scheduler.push(start, flow)
+    fill = time.perf_counter() - begin
+    expovariate = random.expovariate
+    lambd = 1 / MEAN_GAP_NS
+    begin = time.perf_counter()
+    for _ in range(ops):
+        time_ns, flow = scheduler.pop()
+        scheduler.push(time_ns + int(expovariate(lambd)), flow)
+    return fill, time.perf_counter() - begin
+
+
+def run_legacy(starts, ops):
+    queue = SortedDict()
+    begin = time.perf_counter()
+    for flow, start in enumerate(starts):
+        timekey = start / 1000000000
+        if timekey in queue:
+            queue[timekey].append(flow)
+        else:
+            queue[timekey] = [flow]
+    fill = time.perf_counter() - begin
+    expovariate = random.expovariate
+    lambd = 1 / MEAN_GAP_NS
+    done = 0
+    begin = time.perf_counter()
+    while done < ops:
+        now, con_list = queue.popitem(index=0)
+        for flow in con_list:
+            timekey = now + int(expovariate(lambd)) / 1000000000
+            if timekey in queue:
+                queue[timekey].append(flow)
+            else:
+                queue[timekey] = [flow]
+        done += len(con_list)
+    return fill, time.perf_counter() - begin
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--flows', default='1000,100000,1000000',
+                        help='comma separated concurrent flow counts')
+    parser.add_argument('--ops', type=int, default=200000,
+                        help='pop/push pairs per run')
+    args = parser.parse_args()
+    print("%-10s %10s %10s %14s" % ("scheduler", "flows", "fill (s)",
+                                     "ops/s"))
+    for flows in [int(f) for f in args.flows.split(',')]:
+        random.seed(flows)
+        starts = start_times(flows)
+        for name in ['legacy'] + list(SCHEDULERS):
+            random.seed(flows)
+            if name == 'legacy':
+                fill, elapsed = run_legacy(starts, args.ops)
+            else:
+                fill, elapsed = run_scheduler(name, starts, args.ops)
+            print("%-10s %10d %10.2f %14.0f" % (name, flows, fill,
+                                                 args.ops / elapsed))
+
+
+if __name__ == '__main__':
+    main()
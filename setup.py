@@ -16,6 +16,7 @@ setup(
     entry_points={
         'console_scripts': [
             'sniffles = sniffles.sniffles:main',
+            'sniffles-merge = sniffles.merge:main',
             'rulegen = sniffles.rand_rule_gen:main',
             'regexgen = sniffles.regex_generator:main'
         ],
@@ -32,7 +33,8 @@ setup(
           'examples/mac_definition_file.txt',
           'examples/re_features_complex.txt',
           'examples/re_features_simple.txt',
-          'examples/sniffles_example_config.txt']),
+          'examples/sniffles_example_config.txt',
+          'examples/sniffles_vars.txt']),
     ],
     ext_modules=[
         Extension(
@@ -50,4 +52,7 @@ setup(
     install_requires=[
         'sortedcontainers',
     ],
+    extras_require={
+        'batch': ['numpy'],
+    },
 )
@@ -0,0 +1,399 @@
+"""
+    Columnar batch generation of random traffic.
+
+    The BatchGenerator builds the packets for a whole batch of random
+    streams at once as NumPy arrays (5-tuples, lengths, sequence numbers
+    and timestamps), computes the IP and transport checksums vectorized,
+    and serializes the batch into one contiguous buffer of pcap records
+    that is handed to the TrafficWriter in a single write.
+
+    Only random, header-only traffic is supported (no rules, scans,
+    background traffic, IPv6, MAC definition files or host population).
+    Use batch_limitation() to find out whether a configuration can be
+    generated this way.  NumPy is an optional dependency; without it the
+    standard generator is used.
+"""
+import random
+
+from sniffles.ruletrafficgenerator import (ACK, ETHERNET_HDR_SIZE, FIN,
+                                           SUPPORTED_PROTOCOLS, SYN,
+                                           get_ip_spec)
+from sniffles.vendor_mac_list import VENDOR_MAC_OUI
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+PCAP_RECORD_SIZE = 16
+IPV4_HDR_SIZE = 20
+TCP_HDR_SIZE = 20
+UDP_HDR_SIZE = 8
+ICMP_HDR_SIZE = 8
+
+# Share of each protocol when the protocol is not fixed with -q.  This
+# matches get_random_protocol().
+RANDOM_PROTOCOLS = [('icmp', 5), ('udp', 15), ('tcp', 80)]
+
+if np is not None:
+    # pcap record header (little-endian, as TrafficWriter writes it),
+    # Ethernet header and IPv4 header.
+    BASE_HDR = np.dtype([('ts_sec', '<u4'), ('ts_usec', '<u4'),
+                         ('incl_len', '<u4'), ('orig_len', '<u4'),
+                         ('d_mac', 'u1', (6,)), ('s_mac', 'u1', (6,)),
+                         ('e_type', '>u2'), ('vhl', 'u1'), ('tos', 'u1'),
+                         ('length', '>u2'), ('id', '>u2'), ('frag', '>u2'),
+                         ('ttl', 'u1'), ('protocol', 'u1'),
+                         ('checksum', '>u2'), ('sip', '>u4'),
+                         ('dip', '>u4')])
+    TCP_HDR = np.dtype([('sport', '>u2'), ('dport', '>u2'), ('seq', '>u4'),
+                        ('ack', '>u4'), ('flags_n_offset', '>u2'),
+                        ('window', '>u2'), ('checksum', '>u2'),
+                        ('urg', '>u2')])
+    UDP_HDR = np.dtype([('sport', '>u2'), ('dport', '>u2'),
+                        ('length', '>u2'), ('checksum', '>u2')])
+    ICMP_HDR = np.dtype([('type', 'u1'), ('code', 'u1'),
+                         ('checksum', '>u2'), ('rest_of_header', '>u4')])
+
+
+def batch_limitation(sconf, rules=None):
+    """
+        Returns a message naming the first option that prevents batch
+        generation for this configuration, or None if the configuration
+        can be generated in batches.
+    """
+    if np is None:
+        return "NumPy is not installed"
+    if rules:
+        return "rules were provided"
+    if sconf.getEval() or sconf.getFullEval():
+        return "evaluation pcaps are built per rule"
+    if sconf.getScan():
+        return "scan attacks are not supported"
+    if sconf.getBackgroundTraffic() > 0 or \
+       sconf.getBackgroundTrafficRule() is not None:
+        return "background traffic is not supported"
+    if sconf.getIPV6Percent() > 0:
+        return "IPv6 is not supported"
+    if sconf.getMacAddrDef():
+        return "MAC definition files are not supported"
+    if sconf.getHostCount() > 0:
+        return "host populations are not supported"
+    if sconf.getBi():
+        return "bi-directional data is not supported"
+    if sconf.getWriteRegEx():
+        return "no traffic is generated with -w"
+    if sconf.getNanosecond():
+        return "nanosecond timestamps are not supported"
+    if sconf.getPcapng():
+        return "pcapng output is not supported"
+    if sconf.getFlowMode() != 'fill' or sconf.getMaxFlows() > 0:
+        return "flow modes and caps are not supported"
+    if sconf.getCheckpoint() is not None or sconf.getResume():
+        return "checkpoints are not supported"
+    if sconf.getRate() is not None:
+        return "target rates are not supported"
+    if sconf.getProgress() > 0 or sconf.getMetricsFile() is not None:
+        return "metrics are not supported"
+    return None
+
+
+def sample_spec(spec, count, rng):
+    """
+        Vectorized version of RangeSpec.get_value(): draws count values
+        from a compiled PortSpec or IPSpec.
+    """
+    values = np.zeros(count, dtype=np.int64)
+    if spec.num_choices == 1:
+        picks = np.zeros(count, dtype=np.int64)
+    else:
+        picks = rng.integers(0, spec.num_choices, size=count)
+    for i, (bases, ends, total) in enumerate(spec.choices):
+        mask = picks == i
+        r = rng.integers(0, total, size=int(mask.sum()))
+        slot = np.searchsorted(np.asarray(ends), r, side='right')
+        values[mask] = np.asarray(bases, dtype=np.int64)[slot] + r
+    return values
+
+
+def fold_checksum(sums):
+    while (sums >> 16).any():
+        sums = (sums & 0xffff) + (sums >> 16)
+    return (~sums) & 0xffff
+
+
+def word_sum(value):
+    return (value >> 16) + (value & 0xffff)
+
+
+class BatchGenerator:
+    """
+        Generates random streams in batches of batch_size streams.  Each
+        stream follows the layout of a random TrafficStream: an optional
+        handshake (SYN, SYN-ACK, then the first data packet carries the
+        ACK), the data packets each optionally followed by an ACK from
+        the server (-a), and an optional four packet teardown.  UDP and
+        ICMP streams carry data packets only.
+
+        Timestamps are integer microseconds.  Streams in a batch start
+        at a random offset from the last timestamp of the previous batch
+        and the packets of a batch are written in timestamp order.
+    """
+
+    def __init__(self, sconf, batch_size=None):
+        self.sconf = sconf
+        self.batch_size = batch_size
+        if self.batch_size is None:
+            self.batch_size = max(1, sconf.getConcurrentFlows())
+        self.rng = np.random.default_rng(random.getrandbits(64))
+        self.current_usec = sconf.getFirstTimestamp() * 1000000
+        self.handshake = sconf.getTCPHandshake()
+        self.teardown = sconf.getTCPTeardown()
+        self.acks = sconf.getTCPACK()
+        self.ouis = np.array(VENDOR_MAC_OUI, dtype=np.uint8)
+        self.sip_spec = get_ip_spec('any', 4, True)
+        self.dip_spec = get_ip_spec('any', 4, False)
+        proto = sconf.getProto().lower()
+        if proto in SUPPORTED_PROTOCOLS:
+            self.protocols = [proto]
+            self.proto_weights = [1.0]
+        else:
+            self.protocols = [name for name, _ in RANDOM_PROTOCOLS]
+            weights = [share for _, share in RANDOM_PROTOCOLS]
+            self.proto_weights = [w / sum(weights) for w in weights]
+
+    def build_batch(self, num_streams=None):
+        """
+            Builds num_streams streams and returns a tuple of the
+            serialized pcap records, the number of packets and the
+            timestamp (sec, usec) of the last packet.
+        """
+        if num_streams is None:
+            num_streams = self.batch_size
+        rng = self.rng
+        sconf = self.sconf
+        n = num_streams
+
+        # Per stream columns.
+        proto = rng.choice(
+            np.array([SUPPORTED_PROTOCOLS[p] for p in self.protocols]),
+            size=n, p=self.proto_weights)
+        is_tcp = proto == SUPPORTED_PROTOCOLS['tcp']
+        sip = sample_spec(self.sip_spec, n, rng)
+        dip = sample_spec(self.dip_spec, n, rng)
+        sport = rng.integers(0, 65536, size=n)
+        dport = rng.integers(0, 65536, size=n)
+        s_mac = self.random_macs(n)
+        d_mac = self.random_macs(n)
+        isn_c = rng.integers(0, 4000000001, size=n)
+        isn_s = rng.integers(0, 4000000001, size=n)
+        if sconf.getLatency() > 0:
+            latency = np.full(n, float(sconf.getLatency()))
+        else:
+            latency = rng.integers(1, 201, size=n).astype(np.float64)
+        start = self.current_usec + rng.integers(
+            1, sconf.getConcurrentFlows() + 100001, size=n)
+        pkts_per_stream = sconf.getPktsPerStream()
+        if pkts_per_stream < 0:
+            data_pkts = rng.integers(1, abs(pkts_per_stream) + 1, size=n)
+        else:
+            data_pkts = np.full(n, max(1, pkts_per_stream), dtype=np.int64)
+
+        hs = (is_tcp & self.handshake).astype(np.int64)
+        td = (is_tcp & self.teardown).astype(np.int64)
+        acks = (is_tcp & self.acks).astype(np.int64)
+        per_stream = 2 * hs + data_pkts * (1 + acks) + 4 * td
+        total = int(per_stream.sum())
+
+        # Expand to per packet columns.  p is the index of the packet
+        # within its stream.
+        stream = np.repeat(np.arange(n), per_stream)
+        first = np.cumsum(per_stream) - per_stream
+        p = np.arange(total) - first[stream]
+        hs_p = hs[stream]
+        acks_p = acks[stream]
+        data_end = 2 * hs_p + data_pkts[stream] * (1 + acks_p)
+        in_data = (p >= 2 * hs_p) & (p < data_end)
+        q = p - 2 * hs_p
+        is_data = in_data & ((acks_p == 0) | (q % 2 == 0))
+        tear = np.where(p >= data_end, p - data_end, -1)
+
+        pkt_len = sconf.getPktLength()
+        if pkt_len >= 0:
+            lengths = np.where(is_data, pkt_len, 0)
+        else:
+            lengths = np.where(is_data,
+                               rng.integers(10, 1401, size=total), 0)
+
+        # Direction: True when the packet goes from server to client.
+        to_client = (((p == 1) & (hs_p == 1)) |
+                     (in_data & ~is_data) |
+                     (tear == 1) | (tear == 2))
+
+        # Sequence numbers.  sent is the client data sent before each
+        # packet, sent_after includes the packet itself.
+        sent_after = np.cumsum(lengths)
+        stream_base = sent_after[first] - lengths[first]
+        sent_after = sent_after - stream_base[stream]
+        sent = sent_after - lengths
+        c_seq = isn_c[stream] + hs_p
+        s_seq = isn_s[stream] + hs_p
+        seq = np.where(to_client, s_seq, c_seq + sent)
+        ack_no = np.where(to_client, c_seq + sent_after,
+                          np.where(hs_p == 1, s_seq, 0))
+        flags = np.full(total, ACK, dtype=np.int64)
+        syn = (hs_p == 1) & (p == 0)
+        syn_ack = (hs_p == 1) & (p == 1)
+        seq = np.where(syn, isn_c[stream], seq)
+        ack_no = np.where(syn, 0, ack_no)
+        flags = np.where(syn, SYN, flags)
+        seq = np.where(syn_ack, isn_s[stream], seq)
+        ack_no = np.where(syn_ack, isn_c[stream] + 1, ack_no)
+        flags = np.where(syn_ack, SYN + ACK, flags)
+        flags = np.where((tear == 0) | (tear == 2), FIN + ACK, flags)
+        ack_no = np.where(tear == 1, ack_no + 1, ack_no)
+        ack_no = np.where(tear == 2, ack_no + 1, ack_no)
+        seq = np.where(tear == 3, seq + 1, seq)
+        ack_no = np.where(tear == 3, s_seq + 1, ack_no)
+        seq &= 0xffffffff
+        ack_no &= 0xffffffff
+
+        # Timestamps: each packet follows the previous one in its
+        # stream by an exponential gap with the stream's latency.
+        gaps = np.rint(rng.exponential(latency[stream])).astype(
+            np.int64) + 1
+        elapsed = np.cumsum(gaps)
+        elapsed = elapsed - (elapsed[first] - gaps[first])[stream] - \
+            gaps
+        ts = start[stream] + elapsed
+
+        order = np.argsort(ts, kind='stable')
+        data = self.serialize(order, stream, proto, sip, dip, sport, dport,
+                              s_mac, d_mac, to_client, seq, ack_no, flags,
+                              lengths, ts)
+        last = int(ts.max())
+        self.current_usec = last
+        return data, total, (last // 1000000, last % 1000000)
+
+    def random_macs(self, count):
+        macs = np.empty((count, 6), dtype=np.uint8)
+        macs[:, :3] = self.ouis[self.rng.integers(0, len(self.ouis),
+                                                  size=count)]
+        macs[:, 3:] = self.rng.integers(0, 256, size=(count, 3),
+                                        dtype=np.uint8)
+        return macs
+
+    def serialize(self, order, stream, proto, sip, dip, sport, dport,
+                  s_mac, d_mac, to_client, seq, ack_no, flags, lengths, ts):
+        """
+            Lays the packets out (in the given order) as pcap records in
+            one contiguous buffer and returns it as bytes.
+        """
+        rng = self.rng
+        total = len(order)
+        stream = stream[order]
+        to_client = to_client[order]
+        lengths = lengths[order]
+        seq = seq[order]
+        ack_no = ack_no[order]
+        flags = flags[order]
+        ts = ts[order]
+        proto_p = proto[stream]
+        tcp = proto_p == SUPPORTED_PROTOCOLS['tcp']
+        udp = proto_p == SUPPORTED_PROTOCOLS['udp']
+        icmp = proto_p == SUPPORTED_PROTOCOLS['icmp']
+
+        src = np.where(to_client, dip[stream], sip[stream])
+        dst = np.where(to_client, sip[stream], dip[stream])
+        src_port = np.where(to_client, dport[stream], sport[stream])
+        dst_port = np.where(to_client, sport[stream], dport[stream])
+        l4_size = np.where(tcp, TCP_HDR_SIZE, UDP_HDR_SIZE)
+        l4_length = l4_size + lengths
+        ip_length = IPV4_HDR_SIZE + l4_length
+        frame_len = ETHERNET_HDR_SIZE + ip_length
+        ttl = np.clip(np.rint(rng.normal(45, 7, size=total)), 1, 255)
+
+        base = np.zeros(total, dtype=BASE_HDR)
+        base['ts_sec'] = ts // 1000000
+        base['ts_usec'] = ts % 1000000
+        base['incl_len'] = frame_len
+        base['orig_len'] = frame_len
+        base['d_mac'] = np.where(to_client[:, None], s_mac[stream],
+                                 d_mac[stream])
+        base['s_mac'] = np.where(to_client[:, None], d_mac[stream],
+                                 s_mac[stream])
+        base['e_type'] = 0x0800
+        base['vhl'] = 0x45
+        base['length'] = ip_length
+        base['ttl'] = ttl
+        base['protocol'] = proto_p
+        base['sip'] = src
+        base['dip'] = dst
+        ip_sum = (0x4500 + ip_length + (ttl.astype(np.int64) << 8) +
+                  proto_p + word_sum(src) + word_sum(dst))
+        base['checksum'] = fold_checksum(ip_sum)
+
+        # Payload bytes and their contribution to the transport
+        # checksum: bytes at even offsets are the high byte of a word.
+        payload_size = int(lengths.sum())
+        payload = rng.integers(0, 256, size=payload_size, dtype=np.uint8)
+        owner = np.repeat(np.arange(total), lengths)
+        offset = np.arange(payload_size) - \
+            np.repeat(np.cumsum(lengths) - lengths, lengths)
+        weights = np.where(offset % 2 == 0, 256.0, 1.0)
+        data_sum = np.bincount(owner, weights=payload * weights,
+                               minlength=total).astype(np.int64)
+        pseudo_sum = word_sum(src) + word_sum(dst) + proto_p + l4_length
+
+        hdr_len = PCAP_RECORD_SIZE + ETHERNET_HDR_SIZE + IPV4_HDR_SIZE + \
+            l4_size
+        max_hdr = PCAP_RECORD_SIZE + ETHERNET_HDR_SIZE + IPV4_HDR_SIZE + \
+            TCP_HDR_SIZE
+        headers = np.zeros((total, max_hdr), dtype=np.uint8)
+        headers[:, :BASE_HDR.itemsize] = base.view(np.uint8).reshape(
+            total, BASE_HDR.itemsize)
+        start = BASE_HDR.itemsize
+
+        if tcp.any():
+            hdr = np.zeros(int(tcp.sum()), dtype=TCP_HDR)
+            hdr['sport'] = src_port[tcp]
+            hdr['dport'] = dst_port[tcp]
+            hdr['seq'] = seq[tcp]
+            hdr['ack'] = ack_no[tcp]
+            hdr['flags_n_offset'] = (5 << 12) + flags[tcp]
+            hdr['window'] = 65000
+            l4_sum = (src_port[tcp] + dst_port[tcp] + word_sum(seq[tcp]) +
+                      word_sum(ack_no[tcp]) + (5 << 12) + flags[tcp] +
+                      65000)
+            hdr['checksum'] = fold_checksum(
+                l4_sum + pseudo_sum[tcp] + data_sum[tcp])
+            headers[tcp, start:start + TCP_HDR_SIZE] = hdr.view(
+                np.uint8).reshape(-1, TCP_HDR_SIZE)
+        if udp.any():
+            hdr = np.zeros(int(udp.sum()), dtype=UDP_HDR)
+            hdr['sport'] = src_port[udp]
+            hdr['dport'] = dst_port[udp]
+            hdr['length'] = l4_length[udp]
+            l4_sum = src_port[udp] + dst_port[udp] + l4_length[udp]
+            hdr['checksum'] = fold_checksum(
+                l4_sum + pseudo_sum[udp] + data_sum[udp])
+            headers[udp, start:start + UDP_HDR_SIZE] = hdr.view(
+                np.uint8).reshape(-1, UDP_HDR_SIZE)
+        if icmp.any():
+            # Same header as ICMP(1, 0) builds; no checksum is computed.
+            hdr = np.zeros(int(icmp.sum()), dtype=ICMP_HDR)
+            hdr['type'] = 1
+            hdr['code'] = 1
+            headers[icmp, start:start + ICMP_HDR_SIZE] = hdr.view(
+                np.uint8).reshape(-1, ICMP_HDR_SIZE)
+
+        # Scatter headers and payloads into the output buffer.
+        record_len = hdr_len + lengths
+        record_start = np.cumsum(record_len) - record_len
+        out = np.empty(int(record_len.sum()), dtype=np.uint8)
+        columns = np.arange(max_hdr)
+        used = columns[None, :] < hdr_len[:, None]
+        out[(record_start[:, None] + columns[None, :])[used]] = \
+            headers[used]
+        out[np.repeat(record_start + hdr_len, lengths) + offset] = payload
+        return out.tobytes()
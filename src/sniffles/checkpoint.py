@@ -0,0 +1,133 @@
+"""
+    Checkpoints of long generation runs.
+
+    With --checkpoint, the standard generator saves its whole state
+    every so many packets (or seconds) to <output>.ckpt: the random
+    number generator, the flow table with every open conversation, the
+    packets held in the MergeBuffer, the pacer, the global address
+    state, and the lengths of the pcap and the result file at that
+    point.  The pcap and the result file are flushed first, so
+    everything up to those lengths is on disk.  The checkpoint is
+    written to a temporary file and renamed over the old one, so a
+    crash leaves either the old or the new checkpoint, never half of
+    one.
+
+    --resume loads the checkpoint, cuts the pcap and the result file
+    back to the saved lengths and carries on from there, appending.
+    Given the same options, the result is the same as a run that was
+    never interrupted.  The checkpoint is removed when a run ends.
+"""
+import ast
+import copyreg
+import io
+import itertools
+import os
+import pickle
+import time
+
+CHECKPOINT_SUFFIX = '.ckpt'
+CHECKPOINT_VERSION = 1
+
+
+def parse_checkpoint_interval(spec):
+    """
+        Returns (packets, seconds) for a --checkpoint interval: a number
+        of packets, or a number of seconds followed by 's'.  The other
+        one is 0.  Raises ValueError for a bad interval.
+    """
+    spec = spec.strip().lower()
+    if spec.endswith('s'):
+        seconds = float(spec[:-1])
+        if not seconds > 0:
+            raise ValueError("The checkpoint interval must be above 0.")
+        return 0, seconds
+    packets = int(spec)
+    if packets <= 0:
+        raise ValueError("The checkpoint interval must be above 0.")
+    return packets, 0
+
+
+def reduce_count(counter):
+    # itertools.count stops being picklable in Python 3.14; its repr
+    # gives the arguments to rebuild it.
+    return itertools.count, ast.literal_eval(repr(counter)[6:-1] + ',')
+
+
+def reduce_memoryview(view):
+    # Bulk payloads and fragments are read-only memoryview slices, which
+    # cannot be pickled; each is saved as a copy of the bytes it shows.
+    return memoryview, (view.tobytes(),)
+
+
+class CheckpointPickler(pickle.Pickler):
+    dispatch_table = copyreg.dispatch_table.copy()
+    dispatch_table[itertools.count] = reduce_count
+    dispatch_table[memoryview] = reduce_memoryview
+
+
+class Checkpointer:
+    """
+        Saves checkpoints to path every interval (see
+        parse_checkpoint_interval()).
+
+          due(packets): True if a checkpoint is due after packets
+          packets in total.
+          save(state, packets): write state (a dict) atomically,
+          after packets packets in total.
+          remove(): delete the checkpoint.
+    """
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.packets, self.seconds = parse_checkpoint_interval(interval)
+        self.last_packets = 0
+        self.last_time = time.monotonic()
+
+    def due(self, packets):
+        if self.packets:
+            return packets - self.last_packets >= self.packets
+        return time.monotonic() - self.last_time >= self.seconds
+
+    def save(self, state, packets):
+        state['version'] = CHECKPOINT_VERSION
+        state['interval'] = self.interval
+        data = io.BytesIO()
+        CheckpointPickler(data, pickle.HIGHEST_PROTOCOL).dump(state)
+        temp = self.path + '.tmp'
+        with open(temp, 'wb') as checkpoint:
+            checkpoint.write(data.getvalue())
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        os.replace(temp, self.path)
+        self.last_packets = packets
+        self.last_time = time.monotonic()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def load_checkpoint(path):
+    """
+        Returns the state saved in the checkpoint at path.  Raises
+        ValueError if it is not a checkpoint of this version.
+    """
+    with open(path, 'rb') as checkpoint:
+        try:
+            state = pickle.load(checkpoint)
+        except (pickle.UnpicklingError, EOFError) as err:
+            raise ValueError("Bad checkpoint " + path + ": " + str(err))
+    if not isinstance(state, dict) or \
+            state.get('version') != CHECKPOINT_VERSION:
+        raise ValueError(path + " is not a checkpoint of this version.")
+    return state
+
+
+def sync_file(handle):
+    """
+        Flushes handle to disk and returns its length.
+    """
+    handle.flush()
+    os.fsync(handle.fileno())
+    return handle.tell()
@@ -0,0 +1,183 @@
+"""
+    The table of open flows (conversations) of a generator run.
+
+    FlowTable wraps a scheduler (see scheduler.py): conversations are
+    opened with add(), go back and forth through push() and pop() while
+    they send their packets, and are closed with close() after their
+    last packet.  The table keeps count of the conversations alive in
+    memory, and of the flows concurrent in capture time (a flow is
+    concurrent from its first to its last packet), and can cap the
+    number of live conversations.
+
+    How flows are opened is chosen with a spec string (see
+    parse_flow_mode()):
+
+      fill           Open flows until -C are waiting, then send packets
+                     until half of them are done (the default, and how
+                     earlier versions worked).  Concurrency swings
+                     between -C/2 and -C.
+      steady         Keep exactly -C flows open: a new flow starts when
+                     one ends, at the time it ends.
+      poisson:rate   Flows arrive at rate flows per second, with
+                     exponential gaps between their starts.  By
+                     Little's law, about rate times the mean flow
+                     duration are open at a time.  -C is not used.
+"""
+import heapq
+import sys
+from collections import deque
+
+FLOW_MODES = ['fill', 'steady', 'poisson']
+# The memory of every FLOW_SIZE_SAMPLE-th flow opened is measured.
+FLOW_SIZE_SAMPLE = 256
+# Objects of these modules are shared between flows (rules, timing
+# distributions, the configuration) and are not counted in their size.
+SHARED_MODULES = ('sniffles.rulereader', 'sniffles.timing',
+                  'sniffles.snifflesconfig')
+
+
+def parse_flow_mode(spec=None):
+    """
+        Returns (mode, arrival rate) for a flow mode spec.  The rate is
+        None except for poisson.  Raises ValueError for a bad spec.
+    """
+    if not spec:
+        return 'fill', None
+    name, _, param = spec.partition(':')
+    name = name.strip().lower()
+    if name not in FLOW_MODES:
+        raise ValueError("Unknown flow mode: " + name)
+    if name != 'poisson':
+        if param:
+            raise ValueError("The " + name + " flow mode takes no rate.")
+        return name, None
+    rate = float(param) if param else 0
+    if not rate > 0:
+        raise ValueError("The poisson flow mode needs a rate above 0.")
+    return name, rate
+
+
+def deep_size(obj):
+    """
+        Returns the approximate number of bytes used by obj and the
+        objects it holds, leaving out the objects it shares with other
+        flows.
+    """
+    seen = set()
+    pending = [obj]
+    total = 0
+    while pending:
+        item = pending.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        if isinstance(item, type) or callable(item) or \
+                type(item).__module__ in SHARED_MODULES:
+            continue
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            pending.extend(item.keys())
+            pending.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset, deque)):
+            pending.extend(item)
+        elif hasattr(item, '__dict__'):
+            pending.append(item.__dict__)
+    return total
+
+
+class FlowTable:
+    """
+        The open flows, ordered by the time of their next packet.
+
+          add(conversation): open a flow and schedule it.
+          push(time_ns, conversation), pop(), peek_time(), len(table):
+          as for the scheduler.
+          close(conversation): the flow has sent its last packet.
+          get_open(): the number of live flows.
+          full(): True if max_flows (if above 0) flows are live.
+          report(): concurrency and memory statistics.
+    """
+
+    def __init__(self, scheduler, max_flows=0):
+        self.scheduler = scheduler
+        self.max_flows = max_flows
+        self.opened = 0
+        self.closed = 0
+        self.peak_live = 0
+        # Start times of the flows not yet concurrent, and the start of
+        # every flow until it closes.
+        self.starts = []
+        self.start_of = {}
+        self.active = 0
+        self.peak_active = 0
+        self.first_ns = -1
+        self.last_ns = -1
+        self.duration_ns = 0
+        self.sampled = 0
+        self.sampled_bytes = 0
+
+    def __bool__(self):
+        return bool(self.scheduler)
+
+    def __len__(self):
+        return len(self.scheduler)
+
+    def get_open(self):
+        return self.opened - self.closed
+
+    def full(self):
+        return self.max_flows > 0 and self.get_open() >= self.max_flows
+
+    def add(self, conversation):
+        time_ns = conversation.getNextTime()
+        if self.opened % FLOW_SIZE_SAMPLE == 0:
+            self.sampled += 1
+            self.sampled_bytes += deep_size(conversation)
+        self.opened += 1
+        self.peak_live = max(self.peak_live, self.get_open())
+        self.start_of[conversation] = time_ns
+        heapq.heappush(self.starts, time_ns)
+        if self.first_ns < 0 or time_ns < self.first_ns:
+            self.first_ns = time_ns
+        self.scheduler.push(time_ns, conversation)
+
+    def push(self, time_ns, conversation):
+        self.scheduler.push(time_ns, conversation)
+
+    def pop(self):
+        time_ns, conversation = self.scheduler.pop()
+        starts = self.starts
+        while starts and starts[0] <= time_ns:
+            heapq.heappop(starts)
+            self.active += 1
+        self.peak_active = max(self.peak_active, self.active)
+        return time_ns, conversation
+
+    def peek_time(self):
+        return self.scheduler.peek_time()
+
+    def close(self, conversation):
+        self.closed += 1
+        start_ns = self.start_of.pop(conversation)
+        end_ns = max(conversation.last_ns, start_ns)
+        self.active -= 1
+        self.duration_ns += end_ns - start_ns
+        self.last_ns = max(self.last_ns, end_ns)
+
+    def report(self):
+        lines = [str(self.opened) + " flows, at most " +
+                 str(self.peak_live) + " live at a time" +
+                 (" (cap " + str(self.max_flows) + ")"
+                  if self.max_flows > 0 else "") + "."]
+        if self.closed:
+            span = max(self.last_ns - self.first_ns, 1)
+            lines.append("Concurrent flows: peak %d, mean %.1f; mean flow "
+                         "duration %.6fs." % (
+                             self.peak_active, self.duration_ns / span,
+                             self.duration_ns / self.closed / 1e9))
+        if self.sampled:
+            per_flow = self.sampled_bytes // self.sampled
+            lines.append("About " + str(per_flow) + " bytes per live flow (" +
+                         str(per_flow * self.peak_live // 1024) +
+                         " KiB at the peak).")
+        return "\n".join(lines)
@@ -0,0 +1,233 @@
+"""
+    Time ordering of the packets written to a pcap.
+
+    MergeBuffer sits between the generator and a TrafficWriter.  Packets
+    go through a heap of at most window packets and leave it earliest
+    first, so packets that arrive up to window packets late are put back
+    in order.  A packet that arrives even later than that is written
+    with the timestamp of the packet before it.  Either way, the pcap
+    timestamps never go backwards, and memory is bounded by the window.
+
+    merge_pcaps() merges time-ordered pcaps (such as the shards written
+    by --workers or --shard) into one, reading each of them as a stream.
+    It is also available as the sniffles-merge command (see main()).
+"""
+import argparse
+import heapq
+import mmap
+import struct
+import time
+from itertools import count
+
+from sniffles.traffic_writer import (NSEC_PER_SEC, NSEC_PER_USEC,
+                                     PCAP_MAGIC_NSEC, RECORD_HEADER,
+                                     WRITE_BUFFER_SIZE, PcapngWriter)
+
+MERGE_WINDOW = 1024
+
+
+class MergeBuffer:
+    """
+        Buffers packets for a TrafficWriter and writes them in
+        non-decreasing time order.
+
+          add(time_ns, data, note): queue a serialized packet.  If
+          fd_result is set and note is not None, the line
+          "Pkt <number>" + note is written to it when the packet is
+          written, so the numbers follow the pcap order.
+          flush(): write every buffered packet.
+          report(): a summary of the corrections made, or None.
+          get_state(), set_state(state): the buffered packets and
+          counters, for checkpoints.
+
+        bytes_out and write_time are the bytes of the packets written
+        and the time spent writing them (and their result lines).
+
+        If pacer is given (see rate.py), the packets are written at the
+        times it gives them, in the order they leave the buffer.  If
+        traffic_writer is a PcapngWriter, the notes are written as the
+        comments of the packets instead.
+    """
+
+    def __init__(self, traffic_writer, window=MERGE_WINDOW, fd_result=None,
+                 pacer=None):
+        self.traffic_writer = traffic_writer
+        self.pacer = pacer
+        self.window = max(window, 0)
+        self.fd_result = fd_result
+        self.comments = isinstance(traffic_writer, PcapngWriter)
+        self.heap = []
+        self.seq = count()
+        self.last_in_ns = -1
+        self.last_out_ns = -1
+        self.reordered = 0
+        self.clamped = 0
+        self.bytes_out = 0
+        self.write_time = 0.0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, time_ns, data, note=None):
+        if time_ns < self.last_in_ns:
+            self.reordered += 1
+        else:
+            self.last_in_ns = time_ns
+        heapq.heappush(self.heap, (time_ns, next(self.seq), data, note))
+        if len(self.heap) > self.window:
+            self.write_next()
+
+    def flush(self):
+        while self.heap:
+            self.write_next()
+
+    def get_state(self):
+        return (self.heap, self.seq, self.last_in_ns, self.last_out_ns,
+                self.reordered, self.clamped)
+
+    def set_state(self, state):
+        (self.heap, self.seq, self.last_in_ns, self.last_out_ns,
+         self.reordered, self.clamped) = state
+
+    def get_last_ns(self):
+        """
+            Returns the time of the latest packet added, or the writer's
+            current time if there is none.
+        """
+        if self.last_in_ns >= 0:
+            return self.last_in_ns
+        return self.traffic_writer.get_timestamp_ns()
+
+    def report(self):
+        if not self.reordered and not self.clamped:
+            return None
+        return str(self.reordered) + " packets arrived out of order (" + \
+            str(self.clamped) + " too late for the window of " + \
+            str(self.window) + " and moved forward in time)."
+
+    def write_next(self):
+        time_ns, _, data, note = heapq.heappop(self.heap)
+        if self.pacer is not None:
+            time_ns = self.pacer.place(len(data))
+            if time_ns is None:
+                return
+        if time_ns < self.last_out_ns:
+            self.clamped += 1
+            time_ns = self.last_out_ns
+        self.last_out_ns = time_ns
+        begin = time.perf_counter()
+        if self.comments:
+            self.traffic_writer.write_packet_ns(len(data), data, time_ns,
+                                                note)
+        else:
+            self.traffic_writer.write_packet_ns(len(data), data, time_ns)
+        if self.fd_result is not None and note is not None:
+            self.fd_result.write("Pkt " +
+                                 str(self.traffic_writer.get_total_pkts()) +
+                                 note)
+        self.write_time += time.perf_counter() - begin
+        self.bytes_out += len(data)
+
+
+def read_pcap_records(path):
+    """
+        Yields (time_ns, record) for every packet of a pcap written by
+        TrafficWriter, where record is the record header followed by
+        the packet.  The file is mapped into memory rather than read,
+        so only the pages being merged are resident, and the kernel can
+        drop them again at will.
+    """
+    with open(path, 'rb') as pcap:
+        try:
+            data = mmap.mmap(pcap.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # An empty file cannot be mapped.
+            return
+    with data:
+        size = len(data)
+        if size < 24:
+            return
+        if struct.unpack_from('<I', data)[0] == PCAP_MAGIC_NSEC:
+            scale = 1
+        else:
+            scale = NSEC_PER_USEC
+        offset = 24
+        while offset + 16 <= size:
+            sec, frac, incl, _ = RECORD_HEADER.unpack_from(data, offset)
+            end = offset + 16 + incl
+            yield sec * NSEC_PER_SEC + frac * scale, data[offset:end]
+            offset = end
+
+
+def tag_records(index, path):
+    for time_ns, record in read_pcap_records(path):
+        yield time_ns, index, record
+
+
+def merge_pcaps(inputs, output, result_inputs=None, result_output=None):
+    """
+        Merges the time-ordered pcaps in inputs into output with a
+        streaming k-way merge, keeping only one packet per input in
+        memory.  Packets with equal timestamps are taken from the inputs
+        in order.  All inputs must have the same timestamp resolution;
+        output gets the file header of the first one.  If result_inputs
+        (one result file per input, one line per packet) and
+        result_output are given, the result lines are merged along with
+        the packets and renumbered.  Returns the number of packets.
+    """
+    with open(inputs[0], 'rb') as first:
+        header = first.read(24)
+    streams = [tag_records(index, path) for index, path in enumerate(inputs)]
+    results = []
+    if result_inputs and result_output:
+        results = [open(path) for path in result_inputs]
+        fd_result = open(result_output, 'w')
+    total_pkts = 0
+    with open(output, 'wb', buffering=WRITE_BUFFER_SIZE) as merged:
+        merged.write(header)
+        # The (time_ns, index) pairs of the entries are distinct, so
+        # the records themselves are never compared.
+        for _, index, record in heapq.merge(*streams):
+            merged.write(record)
+            total_pkts += 1
+            if results:
+                line = results[index].readline()
+                fd_result.write("Pkt " + str(total_pkts) +
+                                line[line.find(" :"):])
+    if results:
+        for result in results:
+            result.close()
+        fd_result.close()
+    return total_pkts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''
+    Merge pcaps written by sniffles --shard (or any time-ordered pcaps
+    written with the same timestamp resolution) into one time-ordered
+    pcap, and optionally their result files into one result file.
+    ''')
+    parser.add_argument('-o', '--output', default='sniffles.pcap',
+                        help='merged pcap (default: sniffles.pcap)')
+    parser.add_argument('-r', '--result',
+                        help='merged result file (needs -R)')
+    parser.add_argument('-R', '--results',
+                        help='''comma-separated result files of the
+                        shards, in the same order as the pcaps''')
+    parser.add_argument('pcaps', nargs='+', help='shard pcaps')
+    args = parser.parse_args()
+    result_inputs = None
+    if args.result or args.results:
+        if not args.result or not args.results:
+            parser.error("-r and -R must be given together.")
+        result_inputs = args.results.split(',')
+        if len(result_inputs) != len(args.pcaps):
+            parser.error("-R needs one result file per pcap.")
+    total_pkts = merge_pcaps(args.pcaps, args.output, result_inputs,
+                             args.result)
+    print("Merged " + str(total_pkts) + " packets from " +
+          str(len(args.pcaps)) + " pcaps into " + args.output + ".")
+
+
+if __name__ == '__main__':
+    main()
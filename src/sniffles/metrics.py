@@ -0,0 +1,181 @@
+"""
+    Live metrics of a generator run.
+
+    Metrics holds the counters and timers of a run of the standard
+    generator.  Some are added to by the generator as it goes (count()
+    and add_time()); the others belong to the objects of the run (the
+    flow table, the MergeBuffer, the NFA cache) and are read from them
+    only when a snapshot is taken (watch()).  A snapshot is a dict of
+    all of them, with the packet and byte rates since the snapshot
+    before it and, when the size of the run is known, the fraction done
+    and an estimate of the time left.
+
+    The generator calls tick() regularly, which takes a snapshot:
+
+      - every --progress seconds, printed on stderr as a progress line,
+      - every --progress seconds (every second without --progress), as
+        a JSON line in --metricsfile,
+      - after the process got SIGUSR1 (see request_snapshot()), printed
+        on stderr and written to --metricsfile,
+
+    and close() writes the final snapshot at the end of the run.
+"""
+import datetime
+import json
+import sys
+import time
+
+METRICS_INTERVAL = 1.0
+# write_packets() calls tick() every TICK_PACKETS packets.
+TICK_PACKETS = 256
+COUNTERS = ['packets', 'streams']
+TIMERS = ['payload']
+
+
+def parse_progress_interval(spec):
+    """
+        Returns the --progress interval in seconds.  Raises ValueError
+        for a bad interval.
+    """
+    seconds = float(spec)
+    if not seconds > 0:
+        raise ValueError("The progress interval must be above 0.")
+    return seconds
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return "?"
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+class Metrics:
+    """
+        The metrics of one run (or shard, if label is given).
+
+          count(name, amount): add to a counter.
+          add_time(name, seconds): add to a timer.
+          watch(name, get): get() gives the value of name in snapshots.
+          set_progress(get): get() gives (done, total) for the ETA.
+          tick(): take the snapshots that are due.
+          request_snapshot(): have the next tick() print a snapshot
+          (safe to call from a signal handler).
+          snapshot(final): the current values, as a dict.
+          close(): write the final snapshot and close metrics_file.
+
+        With interval (in seconds) above 0, a progress line is printed
+        every interval seconds.  metrics_file is an open text file for
+        the JSON lines, or None.
+    """
+
+    def __init__(self, interval=0, metrics_file=None, label=None):
+        self.progress = interval > 0
+        self.interval = interval if interval > 0 else METRICS_INTERVAL
+        self.metrics_file = metrics_file
+        self.label = label
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.timers = dict.fromkeys(TIMERS, 0.0)
+        self.watched = {}
+        self.get_progress = None
+        self.requested = False
+        self.start = time.monotonic()
+        self.next_time = self.start + self.interval
+        # Time, packets and bytes at the previous periodic snapshot and
+        # at the latest one, and the fraction done at the start (the
+        # run may be resumed).
+        self.previous = self.taken = (self.start, 0, 0)
+        self.first_done = 0.0
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def add_time(self, name, seconds):
+        self.timers[name] += seconds
+
+    def watch(self, name, get):
+        self.watched[name] = get
+
+    def set_progress(self, get):
+        self.get_progress = get
+        done, total = get()
+        self.first_done = done / total if total > 0 else 0.0
+
+    def request_snapshot(self):
+        self.requested = True
+
+    def tick(self):
+        if self.requested:
+            self.requested = False
+            snapshot = self.snapshot()
+            print("Metrics: " + json.dumps(snapshot), file=sys.stderr)
+            self.write(snapshot)
+        if (self.progress or self.metrics_file is not None) and \
+                time.monotonic() >= self.next_time:
+            snapshot = self.snapshot()
+            if self.progress:
+                print(self.progress_line(snapshot), file=sys.stderr)
+            self.write(snapshot)
+            # Rates are taken since the previous periodic snapshot.
+            self.previous = self.taken
+            self.next_time = time.monotonic() + self.interval
+
+    def snapshot(self, final=False):
+        now = time.monotonic()
+        snapshot = {'time': round(time.time(), 3),
+                    'elapsed': round(now - self.start, 3)}
+        if self.label is not None:
+            snapshot['shard'] = self.label
+        snapshot.update(self.counters)
+        for name, get in self.watched.items():
+            snapshot[name] = get()
+        for name, seconds in self.timers.items():
+            snapshot[name + '_seconds'] = round(seconds, 6)
+        last_time, last_packets, last_bytes = self.previous
+        if final:
+            last_time, last_packets, last_bytes = self.start, 0, 0
+        span = max(now - last_time, 1e-9)
+        packets = self.counters['packets']
+        written = snapshot.get('bytes', 0)
+        snapshot['pps'] = round((packets - last_packets) / span, 1)
+        snapshot['mbps'] = round((written - last_bytes) / span / 1e6, 3)
+        self.taken = (now, packets, written)
+        snapshot['done'] = None
+        snapshot['eta'] = None
+        if self.get_progress is not None:
+            done, total = self.get_progress()
+            if total > 0:
+                fraction = min(max(done / total, 0.0), 1.0)
+                snapshot['done'] = round(fraction, 4)
+                if fraction >= 1.0:
+                    snapshot['eta'] = 0.0
+                elif fraction > self.first_done:
+                    snapshot['eta'] = round(
+                        (now - self.start) * (1 - fraction) /
+                        (fraction - self.first_done), 1)
+        snapshot['final'] = final
+        return snapshot
+
+    def progress_line(self, snapshot):
+        line = "" if self.label is None else \
+            "shard " + str(self.label) + ": "
+        if snapshot['done'] is not None:
+            line += "%5.1f%% " % (snapshot['done'] * 100)
+        line += "%d packets, %.0f pps, %.2f MB/s" % (
+            snapshot['packets'], snapshot['pps'], snapshot['mbps'])
+        if snapshot['done'] is not None:
+            line += ", ETA " + format_eta(snapshot['eta'])
+        return line
+
+    def write(self, snapshot):
+        if self.metrics_file is not None:
+            self.metrics_file.write(json.dumps(snapshot) + "\n")
+
+    def close(self):
+        snapshot = self.snapshot(True)
+        if self.progress:
+            print(self.progress_line(snapshot), file=sys.stderr)
+        if self.metrics_file is not None:
+            self.write(snapshot)
+            self.metrics_file.close()
+            self.metrics_file = None
+        return snapshot
@@ -0,0 +1,215 @@
+"""
+    The stages between packet generation and the pcap.
+
+    Generated packets go through three stages:
+
+      generate    Conversations build the packets (the caller's thread).
+      serialize   Packets are serialized and their result file line (or
+                  pcapng comment) is built.
+      write       Packets go through the MergeBuffer into the pcap and
+                  the result file.
+
+    With threads=True, serialize and write each run on their own thread.
+    Packets are handed over in batches through bounded queues, so a slow
+    stage blocks (backpressures) the stages before it instead of letting
+    memory grow.  Each stage records the time it spent working and the
+    time it spent blocked on its queues; a stage that is busy nearly all
+    the time while the others block is the bottleneck.  Without threads
+    the stages run inline, one packet at a time.
+"""
+import queue
+import threading
+import time
+
+PIPELINE_BATCH = 256
+PIPELINE_DEPTH = 8
+
+
+def packet_comment(pkt):
+    """
+        Returns the rule a packet was built from, its traffic stream
+        index and its content set flags, as "rule = <name>, ts idx =
+        <index>[, content_set [(truncated)]]", or None if the packet
+        was not built from a rule.
+    """
+    pkt_rule = None
+    pkt_rule_idx = 0
+    pkt_ts_rule = pkt.get_ts_rule()
+    if pkt_ts_rule:
+        pkt_rule = pkt_ts_rule.getRule()
+        pkt_rule_idx = pkt_ts_rule.getRuleIndex()
+    if pkt_rule:
+        comment = "rule = " + pkt_rule.getRuleName() + \
+            ", ts idx = " + str(pkt_rule_idx)
+        if pkt.get_content_set():
+            comment += ", content_set"
+            if pkt.get_content_truncated():
+                comment += " (truncated)"
+        return comment
+    return None
+
+
+def result_note(pkt):
+    """
+        Returns the result file line for a packet, without the leading
+        "Pkt <number>" that is added when the packet is written.
+    """
+    comment = packet_comment(pkt)
+    if comment is None:
+        return " : (rule none)\n"
+    if pkt.get_content_set() and not pkt.get_content_truncated():
+        # The result file has always had a space here.
+        comment += " "
+    return " : " + comment + "\n"
+
+
+class StageTimer:
+    """
+        Time spent working and blocked by one pipeline stage, and the
+        number of packets it handled.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.packets = 0
+
+    def __str__(self):
+        return "%-10s %10d packets, busy %8.3fs, blocked %8.3fs" % (
+            self.name, self.packets, self.busy, self.blocked)
+
+
+class PacketPipeline:
+    """
+        Carries generated packets to a MergeBuffer.
+
+          put(time_ns, pkt): hand over the next packet.
+          close(): push every packet through and stop the threads.
+          Exceptions raised by a stage are raised again here.
+          sync(): wait until every packet handed over is in the
+          MergeBuffer (which is not flushed).
+          get_last_ns(): the time of the latest packet handed over.
+          report(): per-stage timing, one line per stage.
+
+        Each packet goes to the MergeBuffer with note(pkt) as its note
+        (result_note() by default).
+    """
+
+    def __init__(self, merge_buffer, threads=False,
+                 batch_size=PIPELINE_BATCH, depth=PIPELINE_DEPTH,
+                 note=result_note):
+        self.merge_buffer = merge_buffer
+        self.note = note
+        self.threads = threads
+        self.batch_size = max(batch_size, 1)
+        self.batch = []
+        self.last_ns = -1
+        self.error = None
+        self.start = time.perf_counter()
+        self.timers = [StageTimer('generate'), StageTimer('serialize'),
+                       StageTimer('write')]
+        self.workers = []
+        if threads:
+            self.serialize_queue = queue.Queue(depth)
+            self.write_queue = queue.Queue(depth)
+            self.workers = [
+                threading.Thread(target=self.run_stage, daemon=True,
+                                 args=(self.timers[1], self.serialize_queue,
+                                       self.serialize, self.write_queue)),
+                threading.Thread(target=self.run_stage, daemon=True,
+                                 args=(self.timers[2], self.write_queue,
+                                       self.write, None))]
+            for worker in self.workers:
+                worker.start()
+
+    def put(self, time_ns, pkt):
+        self.last_ns = max(self.last_ns, time_ns)
+        if not self.threads:
+            self.merge_buffer.add(time_ns, pkt.get_packet(), self.note(pkt))
+            return
+        self.batch.append((time_ns, pkt))
+        if len(self.batch) >= self.batch_size:
+            self.send(self.batch)
+            self.batch = []
+
+    def send(self, batch):
+        timer = self.timers[0]
+        if batch:
+            timer.packets += len(batch)
+        begin = time.perf_counter()
+        self.serialize_queue.put(batch)
+        timer.blocked += time.perf_counter() - begin
+
+    def close(self):
+        if self.threads and self.workers:
+            if self.batch:
+                self.send(self.batch)
+                self.batch = []
+            self.send(None)
+            for worker in self.workers:
+                worker.join()
+            self.workers = []
+        self.timers[0].busy = time.perf_counter() - self.start - \
+            self.timers[0].blocked
+        if self.error is not None:
+            raise self.error
+        self.merge_buffer.flush()
+
+    def sync(self):
+        if self.threads and self.workers:
+            if self.batch:
+                self.send(self.batch)
+                self.batch = []
+            self.serialize_queue.join()
+            self.write_queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def get_last_ns(self):
+        if self.last_ns >= 0:
+            return self.last_ns
+        return self.merge_buffer.get_last_ns()
+
+    def report(self):
+        return "\n".join(str(timer) for timer in self.timers)
+
+    def run_stage(self, timer, in_queue, work, out_queue):
+        # A None batch ends the stage and is passed on to the next one.
+        # After an error the stage keeps draining its queue so the
+        # stages before it never block for good.  A batch is marked
+        # done once it is on the next queue, for sync().
+        while True:
+            begin = time.perf_counter()
+            batch = in_queue.get()
+            now = time.perf_counter()
+            timer.blocked += now - begin
+            if batch is None:
+                if out_queue is not None:
+                    out_queue.put(None)
+                in_queue.task_done()
+                return
+            if self.error is None:
+                try:
+                    batch = work(batch)
+                except Exception as err:
+                    self.error = err
+            if self.error is None:
+                timer.packets += len(batch)
+                begin = time.perf_counter()
+                timer.busy += begin - now
+                if out_queue is not None:
+                    out_queue.put(batch)
+                    timer.blocked += time.perf_counter() - begin
+            in_queue.task_done()
+
+    def serialize(self, batch):
+        note = self.note
+        return [(time_ns, pkt.get_packet(), note(pkt))
+                for time_ns, pkt in batch]
+
+    def write(self, batch):
+        add = self.merge_buffer.add
+        for time_ns, data, note in batch:
+            add(time_ns, data, note)
+        return batch
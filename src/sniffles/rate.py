@@ -0,0 +1,230 @@
+"""
+    Target rate pacing of the capture.
+
+    Without a target rate, the traffic volume per second follows from -C,
+    the stream latencies and the flow start offsets.  With --rate, the
+    packets leaving the MergeBuffer (already in time order) are placed
+    on the capture timeline by a Pacer so that the capture follows the
+    requested rate exactly: each packet starts where the one before it
+    ended, and takes 1/rate seconds (for a packet rate) or its length
+    in bits / rate seconds (for a bit rate).  The packets keep their
+    order, so every stream keeps its packet order and the
+    conversations still overlap as generated; only the gaps are
+    stretched or squeezed to the rate.
+
+    Rates are given with a spec string (see parse_rate()):
+
+      <number><unit>      A constant rate, e.g. 500pps, 20kpps, 2Gbps.
+      profile:file        A rate that changes over time.  Each line of
+                          file is "<offset> <rate>": from offset seconds
+                          into the capture on, the rate is <rate> (all
+                          with the same unit, pps or bps).  The last
+                          rate holds until the end; a last rate of 0
+                          ends the capture.
+"""
+import math
+
+from sniffles.traffic_writer import NSEC_PER_SEC
+
+RATE_UNITS = {
+    'pps': ('pps', 1), 'kpps': ('pps', 10 ** 3), 'mpps': ('pps', 10 ** 6),
+    'bps': ('bps', 1), 'kbps': ('bps', 10 ** 3), 'mbps': ('bps', 10 ** 6),
+    'gbps': ('bps', 10 ** 9),
+}
+
+
+def parse_rate_value(text):
+    """
+        Returns (rate, unit) for a rate such as '2Gbps', where unit is
+        'pps' or 'bps'.  Raises ValueError if it cannot be read.
+    """
+    text = text.strip().lower()
+    number = text.rstrip('abcdefghijklmnopqrstuvwxyz')
+    suffix = text[len(number):]
+    if suffix not in RATE_UNITS:
+        raise ValueError("Unknown rate unit in " + text +
+                         " (use pps, kpps, Mpps, bps, kbps, Mbps or Gbps)")
+    unit, scale = RATE_UNITS[suffix]
+    rate = float(number) * scale
+    if rate < 0 or math.isinf(rate) or math.isnan(rate):
+        raise ValueError("Bad rate: " + text)
+    return rate, unit
+
+
+class RateProfile:
+    """
+        A target rate over the capture: segments is a list of
+        (offset_sec, rate), sorted by offset and starting at 0, and
+        unit is 'pps' or 'bps'.
+    """
+
+    def __init__(self, segments, unit):
+        if not segments or segments[0][0] != 0:
+            raise ValueError("The rate profile must start at offset 0.")
+        for (first, _), (second, _) in zip(segments, segments[1:]):
+            if second <= first:
+                raise ValueError("The rate profile offsets must increase.")
+        if not any(rate > 0 for _, rate in segments):
+            raise ValueError("The rate profile has no traffic.")
+        self.segments = segments
+        self.unit = unit
+
+    def __str__(self):
+        if len(self.segments) == 1:
+            return "%g %s" % (self.segments[0][1], self.unit)
+        return "a profile of %d rates (%s)" % (len(self.segments), self.unit)
+
+    def scaled(self, factor):
+        return RateProfile([(offset, rate * factor)
+                            for offset, rate in self.segments], self.unit)
+
+    def get_end(self):
+        """
+            Returns the offset (in seconds) at which the rate drops to 0
+            for good, or None.
+        """
+        if self.segments[-1][1] > 0:
+            return None
+        return self.segments[-1][0]
+
+    def requested(self, second):
+        """
+            Returns the amount (packets or bits) requested between
+            second and second + 1 of the capture.
+        """
+        total = 0.0
+        for index, (offset, rate) in enumerate(self.segments):
+            if index + 1 < len(self.segments):
+                end = self.segments[index + 1][0]
+            else:
+                end = float('inf')
+            overlap = min(end, second + 1) - max(offset, second)
+            if overlap > 0:
+                total += overlap * rate
+        return total
+
+
+def read_rate_profile(path):
+    segments = []
+    units = set()
+    with open(path) as profile:
+        for line in profile:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            fields = line.split()
+            if len(fields) != 2:
+                raise ValueError("Bad rate profile line: " + line)
+            rate, unit = parse_rate_value(fields[1])
+            segments.append((float(fields[0]), rate))
+            units.add(unit)
+    if len(units) > 1:
+        raise ValueError("A rate profile cannot mix pps and bps.")
+    return RateProfile(segments, units.pop() if units else 'pps')
+
+
+def parse_rate(spec):
+    """
+        Builds the RateProfile for a --rate spec.  Raises ValueError
+        for a bad spec.
+    """
+    name, _, param = spec.partition(':')
+    if name.strip().lower() == 'profile':
+        if not param:
+            raise ValueError("The rate profile needs a file.")
+        return read_rate_profile(param)
+    rate, unit = parse_rate_value(spec)
+    return RateProfile([(0, rate)], unit)
+
+
+class Pacer:
+    """
+        Places packets on the capture timeline at the rate of profile,
+        starting at start_ns.  Packets that would start at or after
+        end_ns (or after the profile ends) are dropped.
+
+          place(length): the time of the next packet, or None if it is
+          dropped.
+          report(): requested against achieved rate for every second of
+          the capture.
+    """
+
+    def __init__(self, profile, start_ns=0, end_ns=None):
+        self.profile = profile
+        self.bits = profile.unit == 'bps'
+        self.start_ns = start_ns
+        # Offsets from start_ns, in (float) seconds.  The position is
+        # kept as base plus the amount used at the rate of the current
+        # segment since then, so that rounding errors do not add up.
+        self.position = 0.0
+        self.base = 0.0
+        self.used = 0.0
+        self.end = float('inf')
+        if end_ns is not None:
+            self.end = (end_ns - start_ns) / NSEC_PER_SEC
+        if profile.get_end() is not None:
+            self.end = min(self.end, profile.get_end())
+        self.segment = 0
+        self.achieved = []
+        self.dropped = 0
+
+    def get_time_ns(self):
+        return self.start_ns + int(min(self.position, self.end) *
+                                   NSEC_PER_SEC)
+
+    def place(self, length):
+        segments = self.profile.segments
+        # Move on to the segment the position is in, and skip the ones
+        # where the rate is 0: nothing is sent in them.
+        while self.segment + 1 < len(segments) and \
+                (segments[self.segment][1] <= 0 or
+                 self.position >= segments[self.segment + 1][0]):
+            self.segment += 1
+            self.position = max(self.position, segments[self.segment][0])
+            self.base = self.position
+            self.used = 0.0
+        if self.position >= self.end:
+            self.dropped += 1
+            return None
+        time_ns = self.start_ns + int(self.position * NSEC_PER_SEC)
+        second = int(self.position)
+        if second >= len(self.achieved):
+            self.achieved.extend([0] * (second + 1 - len(self.achieved)))
+        cost = length * 8 if self.bits else 1
+        self.achieved[second] += cost
+        self.advance(cost)
+        return time_ns
+
+    def advance(self, cost):
+        segments = self.profile.segments
+        while cost > 0:
+            rate = segments[self.segment][1]
+            if self.segment + 1 < len(segments):
+                boundary = segments[self.segment + 1][0]
+            else:
+                boundary = float('inf')
+            if rate > 0 and \
+                    self.base + (self.used + cost) / rate <= boundary:
+                self.used += cost
+                self.position = self.base + self.used / rate
+                return
+            if boundary == float('inf'):
+                # Only a last rate of 0 gets here; the capture is over.
+                self.position = float('inf')
+                return
+            cost -= (boundary - self.position) * rate
+            self.position = self.base = boundary
+            self.used = 0.0
+            self.segment += 1
+
+    def report(self):
+        lines = ["%8s %16s %16s" % ("second", "requested " +
+                                    self.profile.unit,
+                                    "achieved " + self.profile.unit)]
+        for second, achieved in enumerate(self.achieved):
+            lines.append("%8d %16.0f %16d" % (
+                second, self.profile.requested(second), achieved))
+        if self.dropped:
+            lines.append(str(self.dropped) + " packets past the end of the" +
+                         " capture were dropped.")
+        return "\n".join(lines)
@@ -16,6 +16,9 @@ CONTENT_TAGS = ['content', 'pcre', 'uricontent']
 VALID_DIRECTIONS = ['to server', 'to client']
 SYN_SCAN = 0
 OPEN_PORT_CHANCE = 20
+BULK_TOTAL_BYTES = 1048576
+BULK_MSS = 1460
+BULK_ACK_EVERY = 2
 
 
 def get_all_subclasses(myCls):
@@ -28,7 +31,32 @@ def get_all_subclasses(myCls):
     return all_subclasses
 
 
-class Rule:
+class RuleObject:
+    """
+        Base class of the rule object model.  Rule objects keep their
+        attributes in __slots__ and are frozen once the rules have been
+        read: assigning to any attribute of a frozen object raises an
+        AttributeError.  Streams keep their progress to themselves, so
+        a frozen rule set can be shared by all the streams generated
+        from it, and by forked workers, without being copied.
+    """
+
+    __slots__ = ('frozen',)
+
+    def __setattr__(self, name, value):
+        if getattr(self, 'frozen', False):
+            raise AttributeError("Cannot set " + name + " on a frozen " +
+                                 type(self).__name__)
+        object.__setattr__(self, name, value)
+
+    def freeze(self):
+        object.__setattr__(self, 'frozen', True)
+
+    def isFrozen(self):
+        return getattr(self, 'frozen', False)
+
+
+class Rule(RuleObject):
     """
         The Rule class marks the base class for any rule.
         If a rule is to have added features, then this class must
@@ -52,8 +80,11 @@ class Rule:
           getTS(): get a list of the TrafficStreamRules for this
               Rule intance.
           setRuleName(name):  self-explanatory
+          freeze(): freeze this rule and all of its TrafficStreamRules.
     """
 
+    __slots__ = ('name', 'ts')
+
     def __init__(self, name=None, ts=None):
         self.name = name
         self.ts = []
@@ -78,6 +109,14 @@ class Rule:
             self.ts.append(stream)
             stream.setRule(self, len(self.ts) - 1)
 
+    def freeze(self):
+        if self.isFrozen():
+            return
+        self.ts = tuple(self.ts)
+        for t in self.ts:
+            t.freeze()
+        super().freeze()
+
     def getRuleName(self):
         return self.name
 
@@ -175,7 +214,7 @@ class RuleParser:
         return True
 
 
-class RuleContent:
+class RuleContent(RuleObject):
     """
         The RuleContent object is a means of storing multiple
         content strings for a single rule.  This is necessary for
@@ -189,6 +228,8 @@ class RuleContent:
         a container of convenience.
     """
 
+    __slots__ = ('name', 'type', 'content')
+
     def __init__(self, type=None, content=None):
         self.name = "Basic Regex Rule Content"
         self.type = type
@@ -217,7 +258,7 @@ class RuleContent:
         self.type = type
 
 
-class RulePkt:
+class RulePkt(RuleObject):
     """
         Define individual packet rules.  These rules can play across multiple
         packets.
@@ -261,6 +302,9 @@ class RulePkt:
                  this with IP fragments has not been tested.
     """
 
+    __slots__ = ('ts_rule', 'index', 'dir', 'content', 'fragment', 'times',
+                 'length', 'ack_this', 'ooo', 'split', 'ttl', 'ttl_expiry')
+
     def __init__(self, dir="to server", content=None, fragment=0, times=1,
                  length=-1, ack_this=False, ooo=False, split=0, ttl=256,
                  ttl_expiry=0):
@@ -342,6 +386,15 @@ class RulePkt:
             else:
                 self.content = [tempcon]
 
+    def freeze(self):
+        if self.isFrozen():
+            return
+        if self.content:
+            self.content = tuple(self.content)
+            for c in self.content:
+                c.freeze()
+        super().freeze()
+
     def setTsRule(self, rule, index):
         self.ts_rule = rule
         self.index = index
@@ -374,7 +427,7 @@ class RulePkt:
         self.ttl_expiry = ttl_expiry
 
 
-class TrafficStreamRule:
+class TrafficStreamRule(RuleObject):
     """
         The TrafficStreamRule defines all of the particulars
         necessary to build a traffic stream in the rule traffic
@@ -407,6 +460,11 @@ class TrafficStreamRule:
         in the ruletrafficgenerator.
     """
 
+    __slots__ = ('rule', 'index', 'ack', 'content', 'dport', 'dst_ip',
+                 'flow', 'handshake', 'ipv', 'latency', 'length', 'loss',
+                 'ooo', 'ooo_prob', 'proto', 'sport', 'src_ip', 'synch',
+                 'tcp_overlap', 'teardown', 'typets')
+
     def __init__(self, proto="any", sip="$EXTERNAL_NET", dip="$HOME_NET",
                  sport="any", dport="any", length=-1, ipv=4, synch=False,
                  handshake=False, teardown=False, ooo=False,
@@ -547,6 +605,14 @@ class TrafficStreamRule:
                 self.content = [pktrule]
             pktrule.setTsRule(self, len(self.content) - 1)
 
+    def freeze(self):
+        if self.isFrozen():
+            return
+        self.content = tuple(self.content)
+        for p in self.content:
+            p.freeze()
+        super().freeze()
+
     def setRule(self, rule, index):
         self.rule = rule
         self.index = index
@@ -606,67 +672,65 @@ class TrafficStreamRule:
         self.teardown = td
 
 
-# Create Background Traffic rules
+# Create Background Traffic rules.  A new one is built, and its content
+# regenerated, for every background conversation, so it is never frozen.
+# The protocols and their codes are shared by all of them.
 class BackgroundTrafficRule(TrafficStreamRule):
+
+    __slots__ = ('absent_protocol', 'backgroundPercent', 'background_traffic',
+                 'contentString', 'distribution', 'probability_list',
+                 'request', 'response', 'ruleContent', 'url')
+
+    # List of Application Protocols
+    application_protocol = ['http', 'ftp', 'pop', 'smtp', 'imap']
+    # HTTP codes & URL
+    # Retrieved from SimilarWeb top 10
+    httpURL = ['www.facebook.com', 'www.google.com', 'www.youtube.com',
+               'www.vk.com', 'www.amazon.com', 'www.instagram.com',
+               'www.wikipedia.org', 'www.twitter.com', 'www.live.com',
+               'www.yahoo.com']
+    httpRequestCodes = ['GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'CONNECT']
+    httpResponseCodes = ['100 Continue', '101 Switching Protocols', '200 OK',
+                         '201 Created', '202 Accepted', '204 No Content',
+                         '301 Moved Permanently', '302 Found',
+                         '400 Bad Request', '403 Forbidden', '404 Not Found',
+                         '405 Method Not Allowed', '406 Not Acceptable',
+                         '408 Request Timedout', '500 Internal Server Error',
+                         '501 Not Implemented', '502 Bad Gateway',
+                         '503 Service Unavailable', '504 Gateway Timeout']
+    # FTP codes
+    ftpResponseCodes = ['125', '150', '200', '211', '212', '213', '214', '220',
+                        '221', '225', '226', '230', '250', '331', '332', '350',
+                        '421', '425', '426', '450', '451', '452', '500', '501',
+                        '503', '504', '530', '532', '550', '551', '552', '553']
+    ftpRequestCodes = ['ABOR', 'ACCT', 'ALLO', 'APPE', 'CDUP', 'DELE', 'HELP',
+                       'LIST', 'MODE', 'NOOP', 'PASS', 'PASV', 'PORT', 'QUIT',
+                       'REIN', 'REST', 'RETR', 'SMNT', 'STAT', 'STOR', 'STRU',
+                       'TYPE', 'USER']
+    # POP3 codes
+    popResponseCodes = ['+OK', '-ERR']
+    popRequestCodes = ['DELE', 'LIST', 'NOOP', 'PASS', 'QUIT', 'RETR', 'RSET',
+                       'STAT', 'USER']
+    # SMTP codes
+    smtpResponseCodes = ['211', '214', '220', '221', '250', '251', '354',
+                         '421', '450', '451', '452', '500', '501', '502',
+                         '503', '504', '550', '552', '553', '554']
+    smtpRequestCodes = ['DATA', 'EHLO', 'EXPN', 'HELO', 'HELP', 'MAIL', 'NOOP',
+                        'QUIT', 'RCPT', 'RSET', 'SAML', 'SEND', 'SOML', 'TURN',
+                        'VRFY']
+    # IMAP codes
+    imapResponseCodes = ['OK', 'BAD', 'NO']
+    imapRequestCodes = ['APPEND', 'AUTHENTICATE', 'CAPABILITY', 'CHECK',
+                        'CLOSE', 'COPY', 'CREATE', 'DELTE', 'LOGIN', 'LOGOUT',
+                        'NOOP', 'SEARCH', 'SELECT', 'STARTTLS', 'STORE']
+
     def __init__(self):
         super().__init__()
-        # List of Application Protocols
-        self.application_protocol = ['http', 'ftp', 'pop', 'smtp', 'imap']
         self.backgroundPercent = None
         self.distribution = {}
         self.probability_list = []
         self.absent_protocol = []
         self.proto = 'tcp'
-        # HTTP codes & URL
-        # Retrieved from SimilarWeb top 10
-        self.httpURL = ['www.facebook.com', 'www.google.com',
-                        'www.youtube.com', 'www.vk.com', 'www.amazon.com',
-                        'www.instagram.com', 'www.wikipedia.org',
-                        'www.twitter.com', 'www.live.com', 'www.yahoo.com']
-        self.httpRequestCodes = ['GET', 'HEAD', 'POST', 'PUT', 'DELETE',
-                                 'CONNECT']
-        self.httpResponseCodes = ['100 Continue', '101 Switching Protocols',
-                                  '200 OK', '201 Created', '202 Accepted',
-                                  '204 No Content', '301 Moved Permanently',
-                                  '302 Found', '400 Bad Request',
-                                  '403 Forbidden', '404 Not Found',
-                                  '405 Method Not Allowed',
-                                  '406 Not Acceptable',
-                                  '408 Request Timedout',
-                                  '500 Internal Server Error',
-                                  '501 Not Implemented', '502 Bad Gateway',
-                                  '503 Service Unavailable',
-                                  '504 Gateway Timeout']
-        # FTP codes
-        self.ftpResponseCodes = ['125', '150', '200', '211', '212', '213',
-                                 '214', '220', '221', '225', '226', '230',
-                                 '250', '331', '332', '350', '421', '425',
-                                 '426', '450', '451', '452', '500', '501',
-                                 '503', '504', '530', '532', '550', '551',
-                                 '552', '553']
-        self.ftpRequestCodes = ['ABOR', 'ACCT', 'ALLO', 'APPE', 'CDUP',
-                                'DELE', 'HELP', 'LIST', 'MODE', 'NOOP',
-                                'PASS', 'PASV', 'PORT', 'QUIT', 'REIN',
-                                'REST', 'RETR', 'SMNT', 'STAT', 'STOR',
-                                'STRU', 'TYPE', 'USER']
-        # POP3 codes
-        self.popResponseCodes = ['+OK', '-ERR']
-        self.popRequestCodes = ['DELE', 'LIST', 'NOOP', 'PASS', 'QUIT',
-                                'RETR', 'RSET', 'STAT', 'USER']
-        # SMTP codes
-        self.smtpResponseCodes = ['211', '214', '220', '221', '250', '251',
-                                  '354', '421', '450', '451', '452', '500',
-                                  '501', '502', '503', '504', '550', '552',
-                                  '553', '554']
-        self.smtpRequestCodes = ['DATA', 'EHLO', 'EXPN', 'HELO', 'HELP',
-                                 'MAIL', 'NOOP', 'QUIT', 'RCPT', 'RSET',
-                                 'SAML', 'SEND', 'SOML', 'TURN', 'VRFY']
-        # IMAP codes
-        self.imapResponseCodes = ['OK', 'BAD', 'NO']
-        self.imapRequestCodes = ['APPEND', 'AUTHENTICATE', 'CAPABILITY',
-                                 'CHECK', 'CLOSE', 'COPY', 'CREATE', 'DELTE',
-                                 'LOGIN', 'LOGOUT', 'NOOP', 'SEARCH',
-                                 'SELECT', 'STARTTLS', 'STORE']
 
     def createContent(self, protocol):
         self.content = []
@@ -824,6 +888,9 @@ class BackgroundTrafficRule(TrafficStreamRule):
 
 class ScanAttackRule(TrafficStreamRule):
 
+    __slots__ = ('scan_type', 'target', 'target_ports', 'src_port',
+                 'duration', 'intensity', 'offset', 'reply_chance')
+
     def __init__(self, scan_type=SYN_SCAN, target=None,
                  target_ports=None, src_port=None, duration=1,
                  intensity=5, offset=0.0, reply_chance=OPEN_PORT_CHANCE):
@@ -891,7 +958,70 @@ class ScanAttackRule(TrafficStreamRule):
         self.offset = value
 
 
+class BulkTransferRule(TrafficStreamRule):
+    """
+        A single large transfer in one direction.  The payload is
+        total_bytes long and is sent in segments of at most mss bytes.
+        The content of the pkt rules is embedded in the payload, at the
+        matching entry of match_offsets if given, or at a random offset
+        otherwise.  When ACKs are on, the receiver ACKs every ack_every
+        segments.
+    """
+
+    __slots__ = ('total_bytes', 'mss', 'ack_every', 'match_offsets')
+
+    def __init__(self, total_bytes=BULK_TOTAL_BYTES, mss=BULK_MSS,
+                 ack_every=BULK_ACK_EVERY, match_offsets=None):
+        super().__init__('tcp')
+        self.total_bytes = total_bytes
+        self.mss = mss
+        self.ack_every = ack_every
+        self.match_offsets = match_offsets
+
+    def testTypeRule(self, value):
+        if value == "BulkTransfer":
+            return True
+        return False
+
+    def getAckEvery(self):
+        return self.ack_every
+
+    def setAckEvery(self, value):
+        if value < 1:
+            value = 1
+        self.ack_every = value
+
+    def getMatchOffsets(self):
+        return self.match_offsets
+
+    def setMatchOffsets(self, value):
+        self.match_offsets = value
+
+    def getMSS(self):
+        return self.mss
+
+    def setMSS(self, value):
+        if value < 1:
+            value = 1
+        self.mss = value
+
+    def getTotalBytes(self):
+        return self.total_bytes
+
+    def setTotalBytes(self, value):
+        if value < 0:
+            value = 0
+        self.total_bytes = value
+
+
 class SnortRuleContent(RuleContent):
+
+    __slots__ = ('distance', 'offset', 'depth', 'within', 'fast_pattern',
+                 'nocase', 'http_client_body', 'http_cookie',
+                 'http_raw_cookie', 'http_header', 'http_raw_header',
+                 'http_method', 'http_uri', 'http_raw_uri', 'http_stat_code',
+                 'http_stat_msg', 'http_encode')
+
     def __init__(self, type=None, content=None):
         self.name = "Snort Rule Content"
         self.type = type
@@ -1100,7 +1230,7 @@ class SnortRuleContent(RuleContent):
         self.fast_pattern = fp
 
     def setNoCase(self, nc=False):
-        self.no_case = nc
+        self.nocase = nc
 
     def setHttpClientBody(self, h=False):
         self.http_client_body = h
@@ -1320,6 +1450,18 @@ class PetabiRuleParser(RuleParser):
                     else:
                         portList = [values]
                     mytsrule.setTargetPorts(portList)
+                if 'totalbytes' in ts.attrib:
+                    mytsrule.setTotalBytes(int(ts.attrib['totalbytes']))
+                if 'mss' in ts.attrib:
+                    mytsrule.setMSS(int(ts.attrib['mss']))
+                if 'ackevery' in ts.attrib:
+                    mytsrule.setAckEvery(int(ts.attrib['ackevery']))
+                if 'matchoffsets' in ts.attrib:
+                    values = ts.attrib['matchoffsets'].strip()
+                    if values[0] == "[":
+                        values = values[1:-1]
+                    mytsrule.setMatchOffsets(
+                        [int(v) for v in values.split(",") if v.strip()])
                 if 'proto' in ts.attrib:
                     mytsrule.setProto(ts.attrib['proto'])
                 if 'src' in ts.attrib:
@@ -1,6 +1,7 @@
 import calendar
 import copy
 import datetime
+import heapq
 import math
 import random
 import re
@@ -9,33 +10,57 @@ import struct
 import sys
 import time
 import warnings
-from collections import OrderedDict
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, deque, namedtuple
+from itertools import accumulate, count
 from os import listdir
 from os.path import isfile, join
 
-from sortedcontainers import SortedDict
-
 from sniffles.nfa import NSYMBOLS, E, pcre2nfa
+from sniffles.timing import ConstantTiming, ExponentialTiming, parse_timing
 from sniffles.vendor_mac_list import VENDOR_MAC_OUI
 
 ETHERNET_HDR_GEN_RANDOM = 0
 ETHERNET_HDR_GEN_DISTRIBUTION = 1
-MAC_IP_MAP = dict()
+ETHERNET_HDR_SIZE = 14
+MAC_IP_MAP = OrderedDict()
+MAC_IP_MAP_SIZE = 65536
 OPEN_PORT_CHANCE = 20
+BULK_TOTAL_BYTES = 1048576
+BULK_MSS = 1460
+BULK_ACK_EVERY = 2
 VENDOR_MAC_DIST_DOMAIN = {}
 VENDOR_MAC_DIST = {}
 HOME_IP_PREFIXES = []
 HOME_IP_PREFIXESv6 = []
+HOST_POPULATION = None
+TIMING_DISTRIBUTION = ExponentialTiming()
 FIN = 0x01
 SYN = 0x02
 ACK = 0x10
 MORE_FRAGMENTS = 0x2000
+IPV6_FRAGMENT_HEADER = 44
+IPV6_FRAGMENT_HEADER_SIZE = 8
+NSEC_PER_SEC = 1000000000
+NSEC_PER_USEC = 1000
 SUPPORTED_PROTOCOLS = {'icmp': 1, 'tcp': 6, 'udp': 17}
 
 # Scan attack types
 SYN_SCAN = 0
 CONNECTION_SCAN = 1
 
+# Kinds of steps in a packet plan
+PLAN_NORMAL = 0
+PLAN_SPLIT = 1
+PLAN_FRAG = 2
+PLAN_OOO = 3
+PLAN_LOSS = 4
+
+# Packet plans by (TrafficStreamRule, protocol).  See get_packet_plan().
+PACKET_PLANS = {}
+PlanStep = namedtuple('PlanStep', ['pkt', 'kind', 'ack_dir'])
+
 HTTP_CONTENT = ['http_client_body', 'http_cookie',
                 'http_raw_cookie', 'http_header', 'http_raw_header',
                 'http_method', 'http_uri', 'http_raw_uri', 'http_stat_code',
@@ -61,6 +86,101 @@ NNTP_PORTS = [119]
 DNS_PORTS = [53]
 ORACLE_PORTS = [1024]
 
+# Port groups matched by keyword against Snort port variables
+# (e.g. $HTTP_PORTS or 'http').  Order matters: the first keyword
+# found in the variable name wins.
+PORT_GROUPS = OrderedDict([('http', HTTP_PORTS), ('ftp', FTP_PORTS),
+                           ('mail', MAIL_PORTS), ('pop', POP_PORTS),
+                           ('smb', SMB_PORTS), ('nbt', NBT_PORTS),
+                           ('nntp', NNTP_PORTS), ('dns', DNS_PORTS),
+                           ('file', FILE_PORTS), ('oracle', ORACLE_PORTS)])
+
+# Variables read from a Snort style vars file (see read_vars_file()).
+PORT_VARS = {}
+IP_VARS = {}
+
+# Compiled port specifications keyed by the raw Snort port value and
+# address specifications keyed by (value, IP version, home).
+PORT_SPECS = {}
+IP_SPECS = {}
+
+# NFAs of pcre contents keyed by the pattern, with their depths
+# calculated.  Walking an NFA does not change it, so each pattern is
+# compiled once and shared by every packet built from it.
+NFA_CACHE = {}
+NFA_CACHE_HITS = 0
+
+# Range of addresses used for random IPv6 addresses: 2001:0400::/23
+# through 2001:05f8::/32, the regional registry allocations.
+IPV6_ANY_RANGE = (0x20010400 << 96, (0x200105f8 << 96) | ((1 << 96) - 1))
+IPV4_ADDR = struct.Struct('!I')
+
+
+def clear_mac_ip_map():
+    """
+        Forget every IP to MAC address binding in MAC_IP_MAP.
+    """
+    MAC_IP_MAP.clear()
+
+
+def set_mac_ip_map_size(size):
+    """
+        Set the maximum number of IP to MAC address bindings kept in
+        MAC_IP_MAP.  When full, the least recently used binding is
+        dropped so memory stays flat during long runs (open streams
+        keep the MAC addresses they resolved, see
+        TrafficStream.getDatalinkHdr()).  A size of zero or less keeps
+        every binding.
+    """
+    global MAC_IP_MAP_SIZE
+    MAC_IP_MAP_SIZE = size
+    if size > 0:
+        while len(MAC_IP_MAP) > size:
+            MAC_IP_MAP.popitem(last=False)
+
+
+def set_host_population(size=0, skew=1.0, mac_def_file=None):
+    """
+        Build the fixed population of hosts (see HostPopulation) used for
+        unconstrained addresses.  Call after the home prefixes and vars
+        have been set.  A size of zero or less turns the population off
+        so every stream gets fresh random addresses.
+    """
+    global HOST_POPULATION
+    if size > 0:
+        HOST_POPULATION = HostPopulation(size, skew, mac_def_file)
+    else:
+        HOST_POPULATION = None
+
+
+def get_generator_state():
+    """
+        Returns the module state that changes as traffic is generated
+        (the IP to MAC bindings and the host population), for
+        checkpoints.
+    """
+    return MAC_IP_MAP, HOST_POPULATION
+
+
+def set_generator_state(state):
+    """
+        Restore the state returned by get_generator_state().
+    """
+    global HOST_POPULATION
+    mac_ip_map, HOST_POPULATION = state
+    MAC_IP_MAP.clear()
+    MAC_IP_MAP.update(mac_ip_map)
+
+
+def set_timing_distribution(spec=None):
+    """
+        Set the distribution of the gaps between the packets of a stream
+        from a spec such as 'lognormal:1.5' (see sniffles.timing).
+        Raises ValueError for a bad spec.
+    """
+    global TIMING_DISTRIBUTION
+    TIMING_DISTRIBUTION = parse_timing(spec)
+
 
 def set_ipv4_home(list):
     """
@@ -71,6 +191,7 @@ def set_ipv4_home(list):
     """
     global HOME_IP_PREFIXES
     HOME_IP_PREFIXES = list
+    IP_SPECS.clear()
 
 
 def set_ipv6_home(list):
@@ -82,6 +203,188 @@ def set_ipv6_home(list):
     """
     global HOME_IP_PREFIXESv6
     HOME_IP_PREFIXESv6 = list
+    IP_SPECS.clear()
+
+
+def read_vars_file(path):
+    """
+        Read a Snort style vars file.  Lines of the form:
+            portvar HTTP_PORTS [80,8080,8000:8010]
+            ipvar HOME_NET [10.0.0.0/8,192.168.0.0/16]
+            var DNS_SERVERS $HOME_NET
+        define the values substituted for $NAME in rule headers.
+        Port variables named after a port group (e.g. HTTP_PORTS)
+        replace the built-in list for that group.  Lines starting
+        with the # symbol are ignored.
+    """
+    try:
+        fd = open(path, 'r')
+    except Exception:
+        raise ValueError("Could not open vars file: " + path)
+    with fd:
+        for line in fd:
+            line = line.strip()
+            if not line or line[0] == '#':
+                continue
+            fields = line.split(None, 2)
+            if len(fields) < 3:
+                raise ValueError("Could not parse line in vars file: " +
+                                 line)
+            kind, name, value = fields
+            kind = kind.lower()
+            name = name.lstrip('$').upper()
+            if kind == 'portvar':
+                PORT_VARS[name] = value.strip()
+            elif kind in ['ipvar', 'var']:
+                IP_VARS[name] = value.strip()
+            else:
+                raise ValueError("Unknown variable type in vars file: " +
+                                 kind)
+    PORT_SPECS.clear()
+    IP_SPECS.clear()
+
+
+def clear_vars():
+    PORT_VARS.clear()
+    IP_VARS.clear()
+    PORT_SPECS.clear()
+    IP_SPECS.clear()
+
+
+def get_ip_spec(snort_ip_val='any', version=4, home=False):
+    """
+        Return the compiled IPSpec for a Snort address value.  Each
+        distinct value is compiled once per IP version and home setting
+        and then shared by every stream using it.
+    """
+    key = (snort_ip_val, version, home)
+    spec = IP_SPECS.get(key)
+    if spec is None:
+        spec = IPSpec(snort_ip_val, version, home)
+        IP_SPECS[key] = spec
+    return spec
+
+
+def pack_ip(ip):
+    """
+        Return the network order bytes of an address given either in
+        text form or already packed (as IPSpec.get_packed_ip() returns
+        it).
+    """
+    if isinstance(ip, str):
+        if ':' in ip:
+            return socket.inet_pton(socket.AF_INET6, ip)
+        return socket.inet_pton(socket.AF_INET, ip)
+    return ip
+
+
+def format_ip(ip):
+    """
+        Return the text form of a packed (or text) address.
+    """
+    if isinstance(ip, str):
+        return ip
+    if len(ip) == 16:
+        return socket.inet_ntop(socket.AF_INET6, ip)
+    return socket.inet_ntop(socket.AF_INET, ip)
+
+
+def get_port_spec(snort_port_val='any'):
+    """
+        Return the compiled PortSpec for a Snort port value.  Each
+        distinct value is compiled once and then shared by every stream
+        using it.
+    """
+    spec = PORT_SPECS.get(snort_port_val)
+    if spec is None:
+        spec = PortSpec(snort_port_val)
+        PORT_SPECS[snort_port_val] = spec
+    return spec
+
+
+def get_nfa(pcre):
+    """
+        Returns the NFA for a pcre pattern, compiling it on first use.
+    """
+    global NFA_CACHE_HITS
+    nfa = NFA_CACHE.get(pcre)
+    if nfa is None:
+        nfa = pcre2nfa(pcre, True)
+        nfa.calculate_depth()
+        NFA_CACHE[pcre] = nfa
+    else:
+        NFA_CACHE_HITS += 1
+    return nfa
+
+
+def get_nfa_cache_stats():
+    """
+        Returns the hits and misses of the NFA cache.
+    """
+    return NFA_CACHE_HITS, len(NFA_CACHE)
+
+
+def compile_packet_plan(rule=None, proto='tcp'):
+    """
+        Builds the packet plan of a traffic stream rule: one step per
+        pkt rule, in order, with the way the packet is to be built
+        (split, fragmented, out of order, lossy or normal) decided once.
+        The plan is a tuple and is never modified, so all the streams
+        created from the rule can share it.
+    """
+    steps = []
+    for p in rule.getPkts():
+        if p.getDir() == "to server":
+            ack_dir = "to client"
+        else:
+            ack_dir = "to server"
+        if p.getSplit() > 0:
+            kind = PLAN_SPLIT
+        elif p.getFragment() > 0:
+            kind = PLAN_FRAG
+        elif (p.getOutOfOrder() or rule.getOutOfOrder()) and proto == 'tcp':
+            kind = PLAN_OOO
+        elif rule.getPacketLoss() > 0:
+            kind = PLAN_LOSS
+        else:
+            kind = PLAN_NORMAL
+        steps.append(PlanStep(p, kind, ack_dir))
+    return tuple(steps)
+
+
+def get_packet_plan(rule=None, proto='tcp'):
+    """
+        Returns the packet plan for the rule and protocol, compiling it
+        on first use.
+    """
+    key = (rule, proto)
+    plan = PACKET_PLANS.get(key)
+    if plan is None:
+        plan = compile_packet_plan(rule, proto)
+        PACKET_PLANS[key] = plan
+    return plan
+
+
+def compile_rule_specs(rules=None):
+    """
+        Compile the header specifications (ports and addresses) and the
+        packet plans for every traffic stream in the given rules so that
+        no parsing happens while generating traffic.
+    """
+    if not rules:
+        return
+    for rule in rules:
+        for ts in rule.getTS():
+            if ts.getProto() and ts.getProto().lower() in SUPPORTED_PROTOCOLS:
+                get_packet_plan(ts, ts.getProto().lower())
+            for port in [ts.getSport(), ts.getDport()]:
+                if port is not None:
+                    get_port_spec(port)
+            version = 6 if ts.getIPV() == 6 else 4
+            if ts.getSrcIp() is not None:
+                get_ip_spec(ts.getSrcIp(), version, True)
+            if ts.getDstIp() is not None:
+                get_ip_spec(ts.getDstIp(), version, False)
 
 
 def get_all_subclasses(myCls):
@@ -110,11 +413,23 @@ class Conversation:
     """
         Dictates rules for a particular communication or series of
         communications.
+
+        Streams wait in order in self.ts until they are activated.  The
+        active streams sit in a heap keyed by (next time in ns, sequence
+        number), so streams with equal timestamps keep their activation
+        order.  Only streams with packets are ever active, and a stream
+        is released as soon as it sends its last packet.  When no stream
+        is active, the waiting streams are activated up to and including
+        the next synch stream, and start no earlier than one gap after
+        the last packet sent.  Thus, the conversation has packets
+        exactly when a stream is active.
     """
 
     def __init__(self, con, sconf, sec=-1, usec=0):
-        self.ts = []
-        self.ts_active = SortedDict()
+        self.ts = deque()
+        self.ts_active = []
+        self.ts_seq = count()
+        self.last_ns = -1
         self.started = False
         current_sec = sec
         if current_sec < 0:
@@ -124,23 +439,25 @@ class Conversation:
         else:
             tsrules = [None]
 
-        while tsrules:
-            myrule = tsrules.pop(0)
+        for myrule in tsrules:
             if myrule:
                 if myrule.testTypeRule("BackgroundTraffic"):
                     myts = BackgroundTraffic(myrule, sconf, sec, usec)
                 elif myrule.testTypeRule("ScanAttack"):
                     myts = ScanAttack(myrule, sconf, sec, usec)
+                elif myrule.testTypeRule("BulkTransfer"):
+                    myts = BulkTransfer(myrule, sconf, sec, usec)
                 else:
                     myts = TrafficStream(myrule, sconf, sec, usec)
             else:
                 myts = TrafficStream(None, sconf, sec, usec)
             self.ts.append(myts)
+        self.num_streams = len(self.ts)
         self.updateStreams()
 
     def __str__(self):
         mystr = "Active TS:\n"
-        for ts in self.ts_active.values():
+        for _, _, ts in sorted(self.ts_active):
             mystr += str(ts)
         mystr += "Waiting TS:"
         for ts in self.ts:
@@ -150,65 +467,61 @@ class Conversation:
     # Returns the timestamp and the packet of the next packet to
     # send among the streams for this particular conversation.
     def getNextPacket(self):
-        if not self.hasPackets():
+        next_pkt = self.getNextPacketNs()
+        if next_pkt is None:
             return None
-        pkt = None
-        _, ts = self.ts_active.popitem()
-        sec = 0
-        usec = 0
-        if ts.hasPackets():
-            sec, usec = ts.getNextTimeStamp()
-            pkt = ts.getNextPacket()
-            next_sec, next_usec = ts.getNextTimeStamp()
-            if ts.hasPackets():
-                self.ts_active[(next_sec + (next_usec / 1000000))] = ts
-        self.updateStreams()
+        time_ns, pkt = next_pkt
+        sec, usec = divmod(time_ns // NSEC_PER_USEC, 1000000)
         return sec, usec, pkt
 
+    # Same as getNextPacket(), with the timestamp in integer nanoseconds.
+    def getNextPacketNs(self):
+        if not self.ts_active:
+            return None
+        time_ns, _, ts = self.ts_active[0]
+        pkt = ts.getNextPacket()
+        self.last_ns = time_ns
+        if ts.hasPackets():
+            heapq.heapreplace(self.ts_active,
+                              (ts.getNextTime(), next(self.ts_seq), ts))
+        else:
+            heapq.heappop(self.ts_active)
+            self.updateStreams()
+        return time_ns, pkt
+
     def getNumberOfStreams(self):
-        return len(self.ts_active) + len(self.ts)
+        return self.num_streams
 
     def getNextTimeStamp(self):
-        next_sec = -1
-        next_usec = 0
+        time_ns = self.getNextTime()
+        if time_ns < 0:
+            return -1, 0
+        return divmod(time_ns // NSEC_PER_USEC, 1000000)
+
+    # Returns the time of the next packet in integer nanoseconds, or -1
+    # if the conversation has no more packets.
+    def getNextTime(self):
         if self.ts_active:
-            next_sec, next_usec = self.ts_active[
-                self.ts_active.iloc[0]
-            ].getNextTimeStamp()
-        else:
-            self.updateStreams()
-            if self.ts_active:
-                return self.getNextTimeStamp()
-        return next_sec, next_usec
+            return self.ts_active[0][0]
+        return -1
 
     def hasPackets(self):
-        if self.ts_active:
-            for value in self.ts_active.values():
-                if value.hasPackets():
-                    return True
-        if self.ts:
-            for ts in self.ts:
-                if ts.hasPackets():
-                    return True
-        return False
+        return bool(self.ts_active)
 
     def updateStreams(self):
-        if self.ts_active and len(self.ts_active) > 0:
-            for value in self.ts_active.values():
-                if value.isFinished():
-                    del(value)
-        if not self.ts_active or len(self.ts_active) < 1:
-            if self.ts and len(self.ts) > 0:
-                while self.ts:
-                    myts = self.ts.pop(0)
-                    sec, usec = myts.getNextTimeStamp()
-                    timekey = sec + usec / 1000000
-                    while timekey in self.ts_active:
-                        usec += 1
-                        timekey = sec + usec / 1000000
-                    self.ts_active[timekey] = myts
-                    if myts.getSynch():
-                        break
+        while not self.ts_active and self.ts:
+            while self.ts:
+                myts = self.ts.popleft()
+                if myts.hasPackets():
+                    if self.last_ns >= 0:
+                        myts.startAfter(self.last_ns)
+                    self.activateStream(myts)
+                if myts.getSynch():
+                    break
+
+    def activateStream(self, myts):
+        heapq.heappush(self.ts_active,
+                       (myts.getNextTime(), next(self.ts_seq), myts))
 
 
 class TrafficStream:
@@ -240,13 +553,17 @@ class TrafficStream:
         self.advance_pkt = False
         self.bi = False
         self.content_string = None
+        self.datalink_hdrs = {}
         self.eval_pkts = []
         self.flow_ack = False
         self.footer = 0
         self.frag_con_size = 0
         self.frag_id = 0
+        self.frag_template = None
         self.fragments = []
         self.full_eval = False
+        self.gap_index = 0
+        self.gaps = []
         self.full_match = False
         self.header = 0
         self.ip_type = 4
@@ -256,12 +573,12 @@ class TrafficStream:
         self.lost_pkt_string = None
         self.mac_def_file = None
         self.mac_gen = ETHERNET_HDR_GEN_RANDOM
-        self.myp = None
         self.next_is_ack = False
-        self.next_time_sec = 0
-        self.next_time_usec = 0
+        self.next_time_ns = 0
         self.order = None
         self.p_count = 0
+        self.plan = None
+        self.plan_index = 0
         self.pkt_len = -1
         self.packets_in_stream = 1
         self.rand = False
@@ -271,6 +588,7 @@ class TrafficStream:
         self.stream_ooo = False
         self.synch = False
         self.tcp_overlap = False
+        self.timing = TIMING_DISTRIBUTION
         self.window = 0
 
         # Get values from sconf that affect stream generation
@@ -310,7 +628,6 @@ class TrafficStream:
             if rule.getAck():
                 self.flow_ack = True
             flow_opts = rule.getFlowOptions()
-            self.myp = rule.getPkts()
             if len(rule.getPkts()) > self.packets_in_stream:
                 self.packets_in_stream = len(rule.getPkts())
             self.proto = rule.getProto()
@@ -333,6 +650,9 @@ class TrafficStream:
         else:
             self.proto = self.proto.lower()
 
+        if rule:
+            self.plan = get_packet_plan(rule, self.proto)
+
         if self.proto != 'tcp':
             handshake = False
             teardown = False
@@ -378,17 +698,7 @@ class TrafficStream:
                 self.sport = temp
 
         # Get initial time stamp
-        if start_sec > 0:
-            self.next_time_sec = start_sec
-        else:
-            if sconf:
-                self.next_time_sec = sconf.getFirstTimestamp()
-            else:
-                self.next_time_sec = int(calendar.timegm(time.gmtime()))
-        self.next_time_usec = start_usec
-        while self.next_time_usec >= 1000000:
-            self.next_time_sec += 1
-            self.next_time_usec -= 1000000
+        self.setStartTime(sconf, start_sec, start_usec)
 
     def testTypeTS(self, value):
         return True
@@ -396,8 +706,8 @@ class TrafficStream:
     def __str__(self):
         mystr = "Traffic Stream\n"
         mystr += "  PROTO: " + self.proto + "\n"
-        mystr += "  SIP: " + self.sip + "\n"
-        mystr += "  DIP: " + self.dip + "\n"
+        mystr += "  SIP: " + format_ip(self.sip) + "\n"
+        mystr += "  DIP: " + format_ip(self.dip) + "\n"
         mystr += "  SPORT: " + str(self.sport) + "\n"
         mystr += "  DPORT: " + str(self.dport) + "\n"
         mystr += "  #Pkt Rules: " + str(self.packets_in_stream) + "\n"
@@ -410,9 +720,18 @@ class TrafficStream:
         if dir == "to client":
             sip = self.dip
             dip = self.sip
+        network_hdr = None
+        datalink_hdr = self.getDatalinkHdr(sip, dip)
+        if self.frag_template:
+            # Every fragment of a packet shares the Ethernet header and
+            # a copy of the IP header of the unfragmented packet.
+            network_hdr = copy.copy(self.frag_template[0])
+            datalink_hdr = self.frag_template[1]
         pkt = Packet(self.proto, sip, dip, self.ip_type, self.sport,
                      self.dport, 0, 0, 0, self.mac_gen, self.mac_def_file,
-                     frag, self.frag_id, offset, mf)
+                     frag, self.frag_id, offset, mf, None, network_hdr,
+                     datalink_hdr)
+        self.datalink_hdrs[(sip, dip)] = pkt.datalink_hdr
         return pkt
 
     def buildPkt(self, dir="to server", flags=ACK, content=None, seq=None,
@@ -452,10 +771,12 @@ class TrafficStream:
             content = Content(newContent, len(content.data) + 1)
 
         pkt = Packet(self.proto, sip, dip, self.ip_type, sport, dport, flags,
-                     seq_no, ack_no, self.mac_gen, self.mac_def_file, content)
+                     seq_no, ack_no, self.mac_gen, self.mac_def_file, content,
+                     datalink_hdr=self.getDatalinkHdr(sip, dip))
+        self.datalink_hdrs[(sip, dip)] = pkt.datalink_hdr
         if self.proto == 'tcp' or self.proto == 'udp':
-            pkt.transport_hdr.set_checksum(pkt.network_hdr.get_sip(),
-                                           pkt.network_hdr.get_dip(),
+            pkt.transport_hdr.set_checksum(pkt.network_hdr.get_packed_sip(),
+                                           pkt.network_hdr.get_packed_dip(),
                                            SUPPORTED_PROTOCOLS[self.proto],
                                            pkt.transport_hdr.get_size() +
                                            pkt.content.get_size(),
@@ -463,65 +784,13 @@ class TrafficStream:
         return pkt
 
     def calculateIP(self, ip="", home=True):
-        ip_generator = None
-        ip = ip.split(',')[0]
-        if self.ip_type == 6:
-            ip_generator = IPV6()
-        else:
-            ip_generator = IPV4()
-        if (ip.lower() == 'any' or ip == '*'):
-            return ip_generator.gen_ip(home)
-        elif ip.find('/') > 0:
-            ip = ip[:ip.find('/')]
-            mynewip = ""
-            splitter = '.'
-            if self.ip_type == 6:
-                splitter = ':'
-            vals = ip.split(splitter)
-            spcounter = 0
-            while vals:
-                v = vals.pop(0)
-                v = v.strip('[')
-                v = v.strip(']')
-                not_ip = False
-                if v.startswith('!'):
-                    v = v.strip('!')
-                    not_ip=True
-                if int(v) > 0:
-                    if spcounter > 0:
-                        mynewip += splitter
-                    if not_ip:
-                        mynewip += str(int(v) + 1)
-                    else:
-                        mynewip += v
-
-                else:
-                    break
-                spcounter += 1
-            return ip_generator.gen_ip(home, mynewip)
-        elif ip.lower() == '$HOME_NET':
-            return ip_generator.gen_ip(True)
-        elif ip.lower() == '$HTTP_SERVERS':
-            return ip_generator.gen_ip(True)
-        elif ip.lower() == '$EXTERNAL_NET':
-            return ip_generator.gen_ip(False)
-        elif ',' in ip:
-            mychoices = ip.split(',')
-            target = random.choice(mychoices)
-            if target == '$HOME_NET':
-                return ip_generator.gen_ip(True)
-            elif target == '$HTTP_SERVERS':
-                return ip_generator.gen_ip(True)
-            elif target == '$EXTERNAL_NET':
-                return ip_generator.gen_ip(False)
-            else:
-                return ip_generator.gen_ip(target)
-        elif '.' in ip and self.ip_type == 4:
-            return ip_generator.gen_ip(True, ip)
-        elif ':' in ip and self.ip_type == 6:
-            return ip_generator.gen_ip(True, ip)
-        else:
-            return ip_generator.gen_ip(home)
+        if not ip:
+            ip = 'any'
+        if HOST_POPULATION is not None:
+            host_ip = HOST_POPULATION.get_ip(ip, self.ip_type, home)
+            if host_ip is not None:
+                return host_ip
+        return get_ip_spec(ip, self.ip_type, home).get_packed_ip()
 
     def createFragments(self, dir="to server", content=None, myfrags=1,
                         ttlexpiry=0):
@@ -529,21 +798,25 @@ class TrafficStream:
         myoffset = 0
         myindex = 0
         whole_pkt = self.buildPkt(dir, ACK, content)
-        data = whole_pkt.get_packet()
-        frag_content = Content(data[34:], len(data[34:]), False, True)
-        possible_frags = math.ceil(frag_content.get_size() / 8)
+        self.frag_template = (whole_pkt.network_hdr, whole_pkt.datalink_hdr)
+
+        # Fragments are slices of the serialized transport segment.
+        hdr_size = whole_pkt.datalink_hdr.get_datalink_hdr_size() + \
+            whole_pkt.network_hdr.get_size()
+        segment = memoryview(whole_pkt.get_packet())[hdr_size:]
+        possible_frags = math.ceil(len(segment) / 8)
         if myfrags > possible_frags:
             myfrags = possible_frags
         frag_size = int(possible_frags / myfrags)
         for i in range(0, myfrags):
             myend = myindex + (frag_size * 8)
             if i == (myfrags - 1):
-                myend = frag_content.get_size()
+                myend = len(segment)
             self.last_off = myoffset
 
             self.fragments.append(
                 (myoffset,
-                 frag_content.get_fragment(myindex, myend),
+                 FragmentContent(segment[myindex:myend]),
                  False)
             )
 
@@ -590,6 +863,20 @@ class TrafficStream:
             pkt = self.buildPkt(dir, ACK, con, seq, ack)
         return pkt
 
+    def getDatalinkHdr(self, sip, dip):
+        """
+            Returns the Ethernet header of the earlier packets from sip to
+            dip (or the one from dip to sip reversed), or None for the
+            first packet between them.  The MAC addresses are resolved
+            once per stream, so a binding dropped from MAC_IP_MAP while
+            the stream is open cannot change them mid-flow.
+        """
+        frame = self.datalink_hdrs.get((sip, dip))
+        if frame is None and (dip, sip) in self.datalink_hdrs:
+            frame = self.datalink_hdrs[(dip, sip)].reverse()
+            self.datalink_hdrs[(sip, dip)] = frame
+        return frame
+
     def getLatency(self):
         return self.latency
 
@@ -603,12 +890,10 @@ class TrafficStream:
             return pkt
 
         # Handle complex rules such as fragments, out-of-order, etc.
-        if self.myp:
-            p = self.myp[0]
-            if p.getDir() == "to server":
-                self.ack_dir = "to client"
-            else:
-                self.ack_dir = "to server"
+        step = self.getPlanStep()
+        if step:
+            p = step.pkt
+            self.ack_dir = step.ack_dir
             if self.p_count == 0:
                 self.p_count = p.getTimes()
 
@@ -622,20 +907,18 @@ class TrafficStream:
 
             # Split packets (i.e. data is spread across multiple
             # valid packets--No fragments).
-            elif p.getSplit() > 0:
+            elif step.kind == PLAN_SPLIT:
                 pkt = self.handleSplitPacket(p)
 
             # handle fragmented packets
-            elif p.getFragment() > 0:
+            elif step.kind == PLAN_FRAG:
                 pkt, isMalicious = self.handleFragPacket(p)
 
             # Out of order packets
-            elif ((
-                p.getOutOfOrder() or self.stream_ooo) and self.proto == 'tcp'
-            ):
+            elif step.kind == PLAN_OOO:
                 pkt = self.handleOOOPacket(p)
 
-            elif self.rule and self.rule.getPacketLoss() > 0:
+            elif step.kind == PLAN_LOSS:
                 pkt = self.handleLostPacket(p)
 
             # Just a normal packet
@@ -655,11 +938,14 @@ class TrafficStream:
                 pkt.set_ttl(p.getTTL())
 
             # If p_count is zero, then we have finished with this pkt rule.
+            # The last step of the plan is repeated while the stream
+            # still has packets to send.
             if self.p_count <= 0:
                 self.packets_in_stream -= 1
-                if len(self.myp) > 1 or len(self.myp) == 1 and \
+                remaining = len(self.plan) - self.plan_index
+                if remaining > 1 or remaining == 1 and \
                    self.packets_in_stream == 0:
-                    self.myp.pop(0)
+                    self.plan_index += 1
                 if self.content_string is not None:
                     self.content_string = None
 
@@ -693,8 +979,9 @@ class TrafficStream:
             pkt = self.buildPkt("to client", SYN + ACK)
             self.updateSequence("to client", 1)
         elif self.header == 1:
-            if self.myp is None or (self.myp and
-                                    self.myp[0].getDir() == "to server"):
+            step = self.getPlanStep()
+            if self.plan is None or (step and
+                                     step.pkt.getDir() == "to server"):
                 pkt = self.getNextContentPacket()
             else:
                 pkt = self.buildPkt("to server", ACK)
@@ -717,8 +1004,7 @@ class TrafficStream:
             pass
             # Nothing left.
         # Increment time stamp for next packet
-        self.incrementTime(
-            int(round(random.expovariate(1 / self.latency))) + 1)
+        self.incrementTime(self.getNextGap())
         if pkt is not None and self.rule:
             pkt.set_ts_rule(self.rule)
         return pkt
@@ -746,14 +1032,48 @@ class TrafficStream:
     # packets will still have a next packet time.  Use the hasPackets()
     # to make certain there are really packets remaining.
     def getNextTimeStamp(self):
-        return self.next_time_sec, self.next_time_usec
+        return divmod(self.next_time_ns // NSEC_PER_USEC, 1000000)
+
+    # Same as getNextTimeStamp(), in integer nanoseconds.
+    def getNextTime(self):
+        return self.next_time_ns
+
+    def getNextGap(self):
+        if self.gap_index >= len(self.gaps):
+            self.sampleTimeline()
+        gap = self.gaps[self.gap_index]
+        self.gap_index += 1
+        return gap
 
     def getPacketsRemaining(self):
         return self.header + self.packets_in_stream + self.footer
 
+    def getPlanStep(self):
+        """
+            Returns the current step of the packet plan, or None if the
+            stream has no plan or has gone through all of it.
+        """
+        if self.plan and self.plan_index < len(self.plan):
+            return self.plan[self.plan_index]
+        return None
+
     def getSynch(self):
         return self.synch
 
+    def getTimeline(self):
+        """
+            Returns the (sec, usec) timestamps of the next packets of the
+            stream, as far as they have been sampled, starting with the
+            next packet.  Call sampleTimeline() first to sample the whole
+            stream.
+        """
+        time_ns = self.next_time_ns
+        timeline = [divmod(time_ns // NSEC_PER_USEC, 1000000)]
+        for gap in self.gaps[self.gap_index:]:
+            time_ns += gap * NSEC_PER_USEC
+            timeline.append(divmod(time_ns // NSEC_PER_USEC, 1000000))
+        return timeline
+
     def handleFragPacket(self, p=None):
         pkt = None
 
@@ -988,8 +1308,14 @@ class TrafficStream:
             return False
 
     def incrementTime(self, usec):
-        sec, self.next_time_usec = divmod(self.next_time_usec + usec, 1000000)
-        self.next_time_sec += sec
+        self.next_time_ns += usec * NSEC_PER_USEC
+
+    # Moves the next packet to one gap after time_ns if it would be
+    # sent before then.  Used for streams that wait on a synch stream.
+    def startAfter(self, time_ns):
+        if self.next_time_ns <= time_ns:
+            self.next_time_ns = time_ns
+            self.incrementTime(self.getNextGap())
 
     def isFinished(self):
         if not self.hasPackets():
@@ -997,6 +1323,27 @@ class TrafficStream:
         else:
             return False
 
+    def setStartTime(self, sconf=None, start_sec=-1, start_usec=0):
+        if start_sec <= 0:
+            if sconf:
+                start_sec = sconf.getFirstTimestamp()
+            else:
+                start_sec = int(calendar.timegm(time.gmtime()))
+        self.next_time_ns = start_sec * NSEC_PER_SEC + \
+            start_usec * NSEC_PER_USEC
+
+    def sampleTimeline(self, count=None):
+        """
+            Draws the gaps after each of the next count packets in one
+            call to the timing distribution.  By default, count is the
+            number of packets the stream has left.  Streams that end up
+            sending more packets (ACKs, fragments) draw more as needed.
+        """
+        if count is None:
+            count = self.getPacketsRemaining()
+        self.gaps = self.timing.sample(self.latency, max(count, 1))
+        self.gap_index = 0
+
     def updateSequence(self, dir="to server", data_len=1):
         if self.tcp_overlap and self.shift_seq and \
            data_len > 0:
@@ -1024,17 +1371,7 @@ class BackgroundTraffic(TrafficStream):
         self.current_seq_b_to_a = random.randint(0, 4000000000)
         self.current_ack_b_to_a = 0
 
-        if start_sec > 0:
-            self.next_time_sec = start_sec
-        else:
-            if sconf:
-                self.next_time_sec = sconf.getFirstTimestamp()
-            else:
-                self.next_time_sec = int(calendar.timegm(time.gmtime()))
-        self.next_time_usec = start_usec
-        while self.next_time_usec >= 1000000:
-            self.next_time_sec += 1
-            self.next_time_usec -= 1000000
+        self.setStartTime(sconf, start_sec, start_usec)
 
     def isBackgroundTS(self, value):
         if value == "BackgroundTraffic":
@@ -1069,8 +1406,7 @@ class ScanAttack(TrafficStream):
         self.mac_def_file = None
         self.mac_gen = ETHERNET_HDR_GEN_RANDOM
         self.next_is_ack = False
-        self.next_time_sec = 0
-        self.next_time_usec = 0
+        self.next_time_ns = 0
         self.num_packets = self.intensity * self.duration
         self.offset = 0.0
         self.proto = 'tcp'
@@ -1089,7 +1425,8 @@ class ScanAttack(TrafficStream):
                 self.mac_def_file = sconf.getMacAddrDef()
             self.num_packets = self.intensity * self.duration
             self.scan_type = sconf.getScanType()
-            self.t_ports = sconf.getTargetPorts()
+            if sconf.getTargetPorts():
+                self.t_ports = list(sconf.getTargetPorts())
 
         if rule:
             src_ip = rule.getSrcIp()
@@ -1103,8 +1440,10 @@ class ScanAttack(TrafficStream):
             self.reply_chance = rule.getReplyChance()
             self.scan_type = rule.getScanType()
             self.targets = rule.getTarget()
+            # getNextPort() rotates the list, so work on a copy and
+            # leave the rule untouched.
             if rule.getTargetPorts():
-                self.t_ports = rule.getTargetPorts()
+                self.t_ports = list(rule.getTargetPorts())
 
         if not self.t_ports:
             self.t_ports = [str(random.randint(1, 65535))]
@@ -1127,20 +1466,21 @@ class ScanAttack(TrafficStream):
         # set initial time
         if start_sec < 0:
             if sconf:
-                self.next_time_sec = sconf.getFirstTimestamp()
+                start_sec = sconf.getFirstTimestamp()
             else:
-                self.next_time_sec = int(calendar.timegm(time.gmtime()))
-        else:
-            self.next_time_sec = start_sec
+                start_sec = int(calendar.timegm(time.gmtime()))
+        self.next_time_ns = start_sec * NSEC_PER_SEC
         if self.offset > 0:
-            self.next_time_sec += self.offset
+            self.next_time_ns += int(self.offset * NSEC_PER_SEC)
         self.latency = int(1000000 / self.intensity)
+        # Scan packets are evenly spaced.
+        self.timing = ConstantTiming()
 
     def __str__(self):
         mystr = "Scan Attack Traffic Stream\n"
-        mystr += "  Src IP: " + self.sip + "\n"
+        mystr += "  Src IP: " + format_ip(self.sip) + "\n"
         mystr += "  Src Port: " + self.sport + "\n"
-        mystr += "  Target IP: " + self.dip + "\n"
+        mystr += "  Target IP: " + format_ip(self.dip) + "\n"
         mystr += "  Target Ports: "
         for p in self.t_ports:
             mystr += p + ", "
@@ -1175,13 +1515,13 @@ class ScanAttack(TrafficStream):
                     self.num_packets -= 1
                 if self.scan_type is CONNECTION_SCAN:
                     self.finish_handshake = True
-                self.incrementTime(self.latency)
+                self.incrementTime(self.getNextGap())
             elif self.finish_handshake:
                 pkt = self.buildPkt("to server", ACK)
                 self.updateSequence("to server", 1)
                 self.num_packets -= 1
                 self.finish_handshake = False
-                self.incrementTime(self.latency)
+                self.incrementTime(self.getNextGap())
             else:
                 next_port = self.getNextPort(self.t_ports)
                 pkt = self.scanPacket(self.dip, next_port, self.mac_gen,
@@ -1189,10 +1529,10 @@ class ScanAttack(TrafficStream):
                 pick = random.randint(0, 100)
                 if pick <= self.reply_chance:
                     self.next_is_ack = True
-                    self.incrementTime(self.latency)
+                    self.incrementTime(self.getNextGap())
                 else:
                     self.num_packets -= 1
-                    self.incrementTime(self.latency)
+                    self.incrementTime(self.getNextGap())
         return pkt
 
     def getNextPort(self, target_ports=None):
@@ -1237,6 +1577,111 @@ class ScanAttack(TrafficStream):
         return pkt
 
 
+class BulkTransfer(TrafficStream):
+    """
+        A long flow pushing one large payload in a single direction.  The
+        payload is built once (random filler with the content of the pkt
+        rules embedded in it) and sent as segments of at most MSS bytes,
+        each one a memoryview slice of the payload.  If ACKs are on, the
+        receiver ACKs every ack_every segments and the final one.
+    """
+
+    def __init__(self, rule=None, sconf=None, start_sec=-1, start_usec=0):
+        super().__init__(rule, sconf, start_sec, start_usec)
+        self.ack_every = BULK_ACK_EVERY
+        self.bulk_dir = "to server"
+        self.bulk_offset = 0
+        self.mss = BULK_MSS
+        self.segments_unacked = 0
+        self.total_bytes = BULK_TOTAL_BYTES
+        match_offsets = None
+        if rule:
+            self.ack_every = rule.getAckEvery()
+            self.mss = rule.getMSS()
+            self.total_bytes = rule.getTotalBytes()
+            match_offsets = rule.getMatchOffsets()
+            if rule.getPkts():
+                self.bulk_dir = rule.getPkts()[0].getDir()
+        if self.bulk_dir == "to server":
+            self.ack_dir = "to client"
+        else:
+            self.ack_dir = "to server"
+        self.payload = self.buildPayload(match_offsets)
+
+        segments = math.ceil(len(self.payload) / self.mss)
+        self.packets_in_stream = segments
+        if self.flow_ack and self.proto == 'tcp':
+            self.packets_in_stream += math.ceil(segments / self.ack_every)
+        else:
+            self.flow_ack = False
+
+    def __str__(self):
+        mystr = "Bulk Transfer Traffic Stream\n"
+        mystr += "  PROTO: " + self.proto + "\n"
+        mystr += "  SIP: " + format_ip(self.sip) + "\n"
+        mystr += "  DIP: " + format_ip(self.dip) + "\n"
+        mystr += "  SPORT: " + str(self.sport) + "\n"
+        mystr += "  DPORT: " + str(self.dport) + "\n"
+        mystr += "  Direction: " + self.bulk_dir + "\n"
+        mystr += "  Bytes: " + str(self.total_bytes) + "\n"
+        mystr += "  MSS: " + str(self.mss) + "\n"
+        return mystr
+
+    def testTypeTS(self, value):
+        if value == "BulkTransfer":
+            return True
+        return False
+
+    def buildPayload(self, match_offsets=None):
+        """
+            Returns the payload as a memoryview.  Rule content is placed
+            at its entry in match_offsets, or at a random offset if no
+            entry is given.  Content that does not fit is truncated.
+        """
+        size = self.total_bytes
+        payload = bytearray(size)
+        if size > 0:
+            # getrandbits(0) raises ValueError before Python 3.9.
+            payload[:] = random.getrandbits(size * 8).to_bytes(size, 'little')
+        pkts = []
+        if self.rule:
+            pkts = self.rule.getPkts()
+        for index, p in enumerate(pkts):
+            if size < 1:
+                break
+            cg = ContentGenerator(p, -1, self.rand, self.full_match,
+                                  False)
+            data = cg.get_next_published_content().get_data()
+            if not data:
+                continue
+            if match_offsets and index < len(match_offsets):
+                offset = min(max(match_offsets[index], 0), size - 1)
+            else:
+                offset = random.randint(0, max(size - len(data), 0))
+            data = data[:size - offset]
+            payload[offset:offset + len(data)] = data
+        return memoryview(bytes(payload))
+
+    def getNextContentPacket(self):
+        if self.next_is_ack:
+            pkt = self.buildPkt(self.ack_dir, ACK)
+            self.next_is_ack = False
+        else:
+            end = self.bulk_offset + self.mss
+            segment = FragmentContent(self.payload[self.bulk_offset:end])
+            pkt = self.buildPkt(self.bulk_dir, ACK, segment)
+            self.updateSequence(self.bulk_dir, segment.get_size())
+            self.bulk_offset += segment.get_size()
+            self.segments_unacked += 1
+            if self.flow_ack and \
+               (self.segments_unacked >= self.ack_every or
+                    self.bulk_offset >= len(self.payload)):
+                self.next_is_ack = True
+                self.segments_unacked = 0
+        self.packets_in_stream -= 1
+        return pkt
+
+
 class Packet:
     """
         Container and generator for packets.  Will build headers and content
@@ -1248,17 +1693,26 @@ class Packet:
                  ipv=4, sport=None, dport=None, flags=None, seq=0,
                  ack=0, mac_gen=ETHERNET_HDR_GEN_RANDOM,
                  dist_file=None, content=None, frag_id=0,
-                 offset=0, mf=False, ttl=None):
+                 offset=0, mf=False, ttl=None, network_hdr=None,
+                 datalink_hdr=None):
         self.ts_rule = None  # ref to TrafficStreamRule
         self.transport_hdr = None
         self.proto = proto
-        if ipv == 6:
+        # Serialized packet and the layer buffers it was built from.
+        self.packet = None
+        self.packet_parts = None
+        if network_hdr is not None:
+            self.network_hdr = network_hdr
+        elif ipv == 6:
             self.network_hdr = IPV6(sip, dip, ttl)
         else:
             self.network_hdr = IPV4(sip, dip, ttl)
-        self.datalink_hdr = EthernetFrame(self.network_hdr.get_sip(),
-                                          self.network_hdr.get_dip(),
-                                          mac_gen, dist_file, ipv)
+        if datalink_hdr is not None:
+            self.datalink_hdr = datalink_hdr
+        else:
+            self.datalink_hdr = EthernetFrame(
+                self.network_hdr.get_packed_sip(),
+                self.network_hdr.get_packed_dip(), mac_gen, dist_file, ipv)
 
         self.content_set = False
         if content is not None:
@@ -1304,13 +1758,28 @@ class Packet:
         return self.content.get_truncated()
 
     def get_packet(self):
-        packet = self.datalink_hdr.get_ethernet_header() + \
-            self.network_hdr.get_ip_header()
+        """
+            Serialize the packet.  Each layer caches its own packed
+            header, so the packet is only rebuilt (with a single join)
+            when one of the layers has been changed since the last call.
+        """
+        parts = [self.datalink_hdr.get_ethernet_header(),
+                 self.network_hdr.get_ip_header()]
         if self.transport_hdr:
-            packet += self.transport_hdr.get_transport_header()
+            parts.append(self.transport_hdr.get_transport_header())
         if self.content and self.content.get_size() > 0:
-            packet += self.content.get_data()
-        return packet
+            data = self.content.get_data()
+            if data:
+                parts.append(data)
+        if self.packet is not None and len(parts) == len(self.packet_parts):
+            for new, old in zip(parts, self.packet_parts):
+                if new is not old:
+                    break
+            else:
+                return self.packet
+        self.packet = b''.join(parts)
+        self.packet_parts = parts
+        return self.packet
 
     def get_size(self):
         size = self.network_hdr.get_size() + self.content.get_size() + \
@@ -1362,15 +1831,19 @@ class Packet:
 
     def set_ack_num(self, ack=0):
         self.transport_hdr.set_ack_num(ack)
+        self.packet = None
 
     def set_seq_num(self, seq=0):
         self.transport_hdr.set_seq_num(seq)
+        self.packet = None
 
     def set_content(self, content=None):
         self.content = content
+        self.packet = None
 
     def set_ttl(self, ttl):
         self.network_hdr.set_ttl(ttl)
+        self.packet = None
 
     def get_seq_num(self):
         return self.transport_hdr.get_seq_num()
@@ -1396,6 +1869,7 @@ class Content:
         self.frag = frag
         self.rand = rand
         self.data = []
+        self.packed = None
         self.truncated = False  # this should come before set_data
         if data:
             self.set_data(data)
@@ -1406,9 +1880,10 @@ class Content:
 
     def get_data(self):
         if self.data and self.length > 0:
-            pack_string = "!" + str(self.length) + "s"
-            packed_data = struct.pack(pack_string, bytearray(self.data))
-            return packed_data
+            if self.packed is None:
+                pack_string = "!" + str(self.length) + "s"
+                self.packed = struct.pack(pack_string, bytearray(self.data))
+            return self.packed
         else:
             return None
 
@@ -1459,14 +1934,43 @@ class Content:
 
     def set_data(self, data=None):
         self.data = data
+        self.packed = None
         if self.length > 0:
             self.adjust_length()
 
     def set_length(self, length):
         self.length = length
+        self.packed = None
         self.adjust_length
 
 
+class FragmentContent(Content):
+    """
+        Content holding a slice (memoryview) of an already serialized
+        packet.  Used for IP fragments so that fragmenting a packet does
+        not copy its data.
+    """
+
+    def __init__(self, data=None):
+        super().__init__(None, 0, False, True)
+        self.set_data(data)
+
+    def get_data(self):
+        if self.length > 0:
+            return self.data
+        return None
+
+    def set_data(self, data=None):
+        if data is None:
+            data = memoryview(b'')
+        self.data = data
+        self.packed = None
+        self.length = len(data)
+
+    def set_length(self, length):
+        self.set_data(self.data[:length])
+
+
 class ContentGenerator:
     """
         Class for generating content.  Will build content derived from a rule,
@@ -1602,8 +2106,7 @@ class ContentGenerator:
             content_options = rule.getContent()
             for con in content_options:
                 if con.getType() == 'pcre':
-                    nfa = pcre2nfa(con.getContentString(), True)
-                    nfa.calculate_depth()
+                    nfa = get_nfa(con.getContentString())
                     path = []
                     self.follow_all_branches(nfa, nfa.start, path)
 
@@ -1817,8 +2320,7 @@ class ContentGenerator:
     def generate_from_regex(self, pcre=None):
         generated = []
         if pcre:
-            nfa = pcre2nfa(pcre, True)
-            nfa.calculate_depth()
+            nfa = get_nfa(pcre)
             state = nfa.start
             visited = []
             while state != nfa.accept:
@@ -1906,6 +2408,134 @@ class ContentGenerator:
         return False
 
 
+class HostPopulation:
+    """
+        A fixed population of hosts used in place of fresh random
+        addresses for every stream (see --hosts).  Each host has an IPv4
+        address, an IPv6 address and a MAC address and is either a home
+        host (drawn from the home prefixes) or an external host (drawn
+        from $EXTERNAL_NET).  Half of the hosts are home hosts.  MACs
+        follow the MAC definition file if one is given.
+
+        Hosts within a group are picked with a Zipf popularity skew: the
+        k-th host is chosen with weight 1/k^skew, so a skew of 0 picks
+        uniformly and larger values concentrate traffic on fewer hosts.
+        Only unconstrained addresses (any, $HOME_NET, $EXTERNAL_NET and
+        other undefined $ variables) are taken from the population;
+        addresses fixed by a rule are generated as before.
+
+        The hosts are held in flat arrays indexed by host number: IPv4
+        addresses as integers, IPv6 addresses and MACs as packed bytes.
+        A drawn address is returned packed, ready for the IP header, and
+        lookup maps a packed address back to its host for get_mac().
+    """
+
+    def __init__(self, size=1000, skew=1.0, mac_def_file=None):
+        self.skew = skew
+        self.ipv4 = array('L')
+        self.ipv6 = bytearray()
+        self.macs = bytearray()
+        self.lookup = {}
+        self.members = {True: array('L'), False: array('L')}
+        self.weights = {}
+
+        ether = EthernetFrame(type=None)
+        if mac_def_file:
+            ether.load_vendor_mac_dist(mac_def_file)
+        origin = None
+        for name in ['src', 'dest']:
+            if name in VENDOR_MAC_DIST:
+                origin = name
+                break
+
+        for i in range(0, size):
+            home = (i % 2) == 0
+            ipv4 = self.gen_unique_ip(4, home)
+            ipv6 = self.gen_unique_ip(6, home)
+            if ipv4 is None or ipv6 is None:
+                continue
+            if origin:
+                oui = ether.get_dist_mac_oui(origin)
+            else:
+                oui = random.choice(VENDOR_MAC_OUI)
+            index = len(self.ipv4)
+            self.ipv4.append(IPV4_ADDR.unpack(ipv4)[0])
+            self.ipv6.extend(ipv6)
+            self.macs.extend(ether.get_random_octets(oui))
+            self.lookup[ipv4] = index
+            self.lookup[ipv6] = index
+            self.members[home].append(index)
+        if len(self.ipv4) < size:
+            warnings.warn("Only " + str(len(self.ipv4)) + " distinct hosts "
+                          "fit the home and external address ranges.",
+                          UserWarning)
+
+        for home, members in self.members.items():
+            self.weights[home] = array('d', accumulate(
+                [1.0 / ((rank + 1) ** skew) for rank in
+                 range(0, len(members))]))
+
+    def __str__(self):
+        return "Host population of " + str(self.get_size()) + \
+            " hosts with a skew of " + str(self.skew)
+
+    def gen_unique_ip(self, version, home):
+        if home:
+            spec = get_ip_spec('any', version, True)
+        else:
+            spec = get_ip_spec('$EXTERNAL_NET', version, False)
+        for _ in range(0, 10):
+            ip = spec.get_packed_ip()
+            if ip not in self.lookup:
+                return ip
+        return None
+
+    def get_ip(self, snort_ip_val='any', version=4, home=False):
+        """
+            Returns the address of a host picked from the population, or
+            None if the value constrains the address (e.g. a CIDR block)
+            and should be generated from its IPSpec instead.
+        """
+        value = snort_ip_val.strip()
+        if value.startswith('$'):
+            name = value[1:].upper()
+            if name in IP_VARS:
+                return None
+            if name == 'EXTERNAL_NET':
+                home = False
+            elif name == 'HOME_NET' or name.endswith('_SERVERS'):
+                home = True
+        elif value.lower() not in ['any', '*']:
+            return None
+        index = self.pick_host(home)
+        if index is None:
+            return None
+        if version == 6:
+            return bytes(self.ipv6[index * 16:index * 16 + 16])
+        return IPV4_ADDR.pack(self.ipv4[index])
+
+    def get_mac(self, ip=None):
+        if ip is None:
+            return None
+        index = self.lookup.get(pack_ip(ip))
+        if index is None:
+            return None
+        return list(self.macs[index * 6:index * 6 + 6])
+
+    def get_size(self):
+        return len(self.ipv4)
+
+    def pick_host(self, home=False):
+        members = self.members[home]
+        if not members:
+            return None
+        weights = self.weights[home]
+        i = bisect_right(weights, random.random() * weights[-1])
+        if i >= len(members):
+            i = len(members) - 1
+        return members[i]
+
+
 class EthernetFrame:
     """Defines the methods for creating randomized ethernet headers.  All
     Ethernet headers are mapped to distinct IP addressses and stored
@@ -1928,8 +2558,10 @@ class EthernetFrame:
         fix up to all six bytes in the MAC address.  Any bytes not fixed will
         be random generated.  Further, it is possible to use a domain larger
         than 100 (1000 for example) or smaller.  Just note that the prefix = n
-        will set a probability for that prefix of n/domain.  If you do set a
-        domain it should be the first value set in the file.  Finally,
+        will set a probability for that prefix of n/domain.  If the
+        probabilities sum to less than the domain, the remainder goes to
+        the last prefix in the file.  If you do set a domain it should be
+        the first value set in the file (the default is 100).  Finally,
         prefixes can be writen as hex values, or just a straight string
         (like 008012).  However, they cannot be written as string values
         separated by spaces (i.e. 00 80 12).  If spaces are used, hex notation
@@ -1941,6 +2573,7 @@ class EthernetFrame:
                  dist_file=None, ipv=4):
         self.d_mac = []
         self.s_mac = []
+        self.header = None
 
         if ipv == 6:
             self.e_type = 0x86dd
@@ -1965,7 +2598,7 @@ class EthernetFrame:
         global MAC_IP_MAP
         global VENDOR_MAC_DIST_DOMAIN
         global VENDOR_MAC_DIST
-        MAC_IP_MAP = dict()
+        MAC_IP_MAP = OrderedDict()
         VENDOR_MAC_DIST_DOMAIN = {}
         VENDOR_MAC_DIST = {}
 
@@ -1986,7 +2619,13 @@ class EthernetFrame:
                     raise ValueError("Could not open mac definition file: " +
                                      path)
 
-                VENDOR_MAC_DIST[origin] = OrderedDict()
+                # Stored as the cumulative upper bound of each prefix's
+                # share of the domain and the prefixes themselves so
+                # that get_dist_mac_oui() can bisect.
+                bounds = []
+                prefixes = []
+                VENDOR_MAC_DIST[origin] = (bounds, prefixes)
+                VENDOR_MAC_DIST_DOMAIN[origin] = 100
 
                 line = fd.readline()
                 base_prob = 0
@@ -2012,8 +2651,9 @@ class EthernetFrame:
                                 while i < len(prefix):
                                     octets.append(int(prefix[i:i + 2], 16))
                                     i += 2
-                            VENDOR_MAC_DIST[origin][base_prob] = octets
                             base_prob += int(percent)
+                            bounds.append(base_prob)
+                            prefixes.append(octets)
                             if VENDOR_MAC_DIST_DOMAIN[origin] and \
                                base_prob > VENDOR_MAC_DIST_DOMAIN[origin]:
                                 break
@@ -2025,25 +2665,7 @@ class EthernetFrame:
         global VENDOR_MAC_DIST
 
         if not VENDOR_MAC_DIST:
-            paths = dist_file.split(":")
-            lenPaths = len(paths)
-            source = None
-            dest = None
-            if lenPaths == 1:
-                source = dest = paths[0]
-            elif lenPaths == 2:
-                if paths[0] != "?" and paths[1] != "?":
-                    source = paths[0]
-                    dest = paths[1]
-                elif paths[0] != "?":
-                    source = paths[0]
-                elif paths[1] != "?":
-                    dest = paths[1]
-            else:
-                raise ValueError("Invalid format for mac distribution file: " +
-                                 dist_file)
-
-            self.create_vendor_mac_dist(source, dest)
+            self.load_vendor_mac_dist(dist_file)
 
         if 'src' in VENDOR_MAC_DIST and 'dest' in VENDOR_MAC_DIST:
             option = -1
@@ -2086,27 +2708,28 @@ class EthernetFrame:
         return self.d_mac
 
     def get_dist_mac_oui(self, origin):
-        dist_map = VENDOR_MAC_DIST[origin].keys()
-        pick = random.randint(1, VENDOR_MAC_DIST_DOMAIN[origin])
-        prefix = []
-
-        for i in dist_map:
-            prefix = VENDOR_MAC_DIST[origin][i]
-            if i >= pick:
-                break
-        return prefix
+        bounds, prefixes = VENDOR_MAC_DIST[origin]
+        if not prefixes:
+            return []
+        pick = random.randrange(VENDOR_MAC_DIST_DOMAIN[origin])
+        i = bisect_right(bounds, pick)
+        if i >= len(prefixes):
+            i = len(prefixes) - 1
+        return prefixes[i]
 
     def get_datalink_hdr_size(self):
-        return len(self.get_ethernet_header())
+        return ETHERNET_HDR_SIZE
 
     def get_ethernet_header(self):
         """
             This marks the primary function for returning a packed binary
             string representing the Ethernet Header portion of a packet.
+            The header is packed once and cached.
         """
-        e_header = struct.pack('!6s6sH', bytearray(self.d_mac),
-                               bytearray(self.s_mac), self.e_type)
-        return e_header
+        if self.header is None:
+            self.header = struct.pack('!6s6sH', bytearray(self.d_mac),
+                                      bytearray(self.s_mac), self.e_type)
+        return self.header
 
     def get_ether_type(self):
         return self.e_type
@@ -2121,6 +2744,32 @@ class EthernetFrame:
             random_octets.append(random.randint(0, 255))
         return random_octets
 
+    def load_vendor_mac_dist(self, dist_file):
+        """
+            Read the MAC definition file(s) into VENDOR_MAC_DIST.  The
+            value is either one path used for both directions or
+            'src_path:dest_path' where either may be '?' for random.
+        """
+        paths = dist_file.split(":")
+        lenPaths = len(paths)
+        source = None
+        dest = None
+        if lenPaths == 1:
+            source = dest = paths[0]
+        elif lenPaths == 2:
+            if paths[0] != "?" and paths[1] != "?":
+                source = paths[0]
+                dest = paths[1]
+            elif paths[0] != "?":
+                source = paths[0]
+            elif paths[1] != "?":
+                dest = paths[1]
+        else:
+            raise ValueError("Invalid format for mac distribution file: " +
+                             dist_file)
+
+        self.create_vendor_mac_dist(source, dest)
+
     def map_mac_addr_to_ip(self, mac, ip=None):
         global MAC_IP_MAP
         if ip is None:
@@ -2130,21 +2779,51 @@ class EthernetFrame:
             print("MAC address is None! Cannot be mapped!")
             return
         MAC_IP_MAP[ip] = mac
+        MAC_IP_MAP.move_to_end(ip)
+        if MAC_IP_MAP_SIZE > 0 and len(MAC_IP_MAP) > MAC_IP_MAP_SIZE:
+            MAC_IP_MAP.popitem(last=False)
+
+    def reverse(self):
+        """
+            Returns a frame for the opposite direction, with the source
+            and destination MAC addresses swapped.
+        """
+        frame = EthernetFrame(type=None)
+        frame.e_type = self.e_type
+        frame.s_mac = self.d_mac
+        frame.d_mac = self.s_mac
+        return frame
 
     def test_mac_addr_exists(self, sip=None, dip=None):
         global MAC_IP_MAP
+        if HOST_POPULATION is not None:
+            mac = HOST_POPULATION.get_mac(sip)
+            if mac:
+                self.s_mac = mac
+                sip = None
+            mac = HOST_POPULATION.get_mac(dip)
+            if mac:
+                self.d_mac = mac
+                dip = None
         if sip is not None:
             if sip in MAC_IP_MAP:
                 self.s_mac = MAC_IP_MAP[sip]
+                MAC_IP_MAP.move_to_end(sip)
         if dip is not None:
             if dip in MAC_IP_MAP:
                 self.d_mac = MAC_IP_MAP[dip]
+                MAC_IP_MAP.move_to_end(dip)
 
 
 class IP:
     """
         Base class for generating IP headers.  Should not be instantiated.
         Provides the shared functionality for IP headers.
+
+        Addresses may be given in text form but are held packed (network
+        order bytes), so they go into the header as they are; get_sip()
+        and get_dip() return the text form, get_packed_sip() and
+        get_packed_dip() the packed one.
     """
 
     def __init__(self, sip=None, dip=None, ttl=None):
@@ -2155,12 +2834,12 @@ class IP:
             home_or_not = not home_or_not
             self.sip = self.gen_ip(home_or_not)
         else:
-            self.sip = sip
+            self.sip = pack_ip(sip)
         if not dip:
             home_or_not = not home_or_not
             self.dip = self.gen_ip(home_or_not)
         else:
-            self.dip = dip
+            self.dip = pack_ip(dip)
         if not ttl:
             self.ttl = int(random.normalvariate(45, 7))
         else:
@@ -2168,6 +2847,7 @@ class IP:
         self.protocol = 0x00
         self.length = 0x0000
         self.size = 20
+        self.header = None
 
     def __str__(self):
         bytes = bytearray(self.get_ip_header())
@@ -2177,6 +2857,7 @@ class IP:
     def clear_hope_ip_prefixes(self):
         global HOME_IP_PREFIXES
         HOME_IP_PREFIXES = []
+        IP_SPECS.clear()
 
     def gen_ip(self, home=False, target=None):
         return None
@@ -2188,9 +2869,15 @@ class IP:
         return None
 
     def get_sip(self):
-        return self.sip
+        return format_ip(self.sip)
 
     def get_dip(self):
+        return format_ip(self.dip)
+
+    def get_packed_sip(self):
+        return self.sip
+
+    def get_packed_dip(self):
         return self.dip
 
     def get_protocol(self):
@@ -2210,11 +2897,13 @@ class IP:
            in SUPPORTED_PROTOCOLS.values():
             print("Unsupported Protocol")
         self.protocol = protocol
+        self.header = None
 
     def set_length(self, length):
         if length < 0:
             print("Incorrect length")
         self.length = length
+        self.header = None
 
     def set_home_ip_prefixes(self, ip_prefixes):
         global HOME_IP_PREFIXES
@@ -2222,6 +2911,7 @@ class IP:
             return
         for prefix in ip_prefixes:
             HOME_IP_PREFIXES.append(prefix)
+        IP_SPECS.clear()
         self.home_or_not = True
 
     def get_size(self):
@@ -2229,6 +2919,7 @@ class IP:
 
     def set_ttl(self, ttl):
         self.ttl = ttl
+        self.header = None
 
 
 class IPV4(IP):
@@ -2238,8 +2929,9 @@ class IPV4(IP):
         HOME_IP_PREFIXES data structure contains IP prefixes definining
         the protected network.
 
-        NOTE: currently no effort is made to ensure external addresses do
-        not match home addresses.
+        Addresses are drawn from the compiled IPSpec for the value (see
+        get_ip_spec()).  NOTE: random external addresses may still match
+        home addresses; only $EXTERNAL_NET excludes the home prefixes.
     """
 
     def __init__(self, sip=None, dip=None, ttl=None):
@@ -2252,12 +2944,11 @@ class IPV4(IP):
         self.size = 20
 
     def calculate_checksum(self):
-        sip = socket.inet_pton(socket.AF_INET, self.sip)
-        dip = socket.inet_pton(socket.AF_INET, self.dip)
         self.checksum = 0
         ip_hdr_bin = struct.pack('!BBHHHBBH4s4s', self.vhl, self.tos,
                                  self.length, self.id, self.frag, self.ttl,
-                                 self.protocol, self.checksum, sip, dip)
+                                 self.protocol, self.checksum, self.sip,
+                                 self.dip)
         bytes = bytearray(ip_hdr_bin)
         sum = 0
         count = 0
@@ -2274,35 +2965,22 @@ class IPV4(IP):
         self.checksum = sum
 
     def gen_ip(self, home=False, target=None):
-        myip = []
-        start = 0
-        if home and (HOME_IP_PREFIXES or target):
-            prefix = ""
-            if target is not None:
-                prefix = target
-            else:
-                prefix = random.choice(HOME_IP_PREFIXES)
-            bytes = prefix.split('.')
-            for b in bytes:
-                if b:
-                    b=b.strip('[')
-                    b=b.strip(']')
-                    if b.startswith('!'):
-                        b=str(int(b.strip('!'))+1)
-                    myip.append(int(b))
-            start = len(myip)
-        for _ in range(start, 4):
-            myip.append(random.randint(0, 255))
-        return '.'.join(['%d' % byte for byte in myip])
+        if target is None or not home:
+            target = 'any'
+            if HOST_POPULATION is not None:
+                host_ip = HOST_POPULATION.get_ip(target, 4, home)
+                if host_ip is not None:
+                    return host_ip
+        return get_ip_spec(target, 4, home).get_packed_ip()
 
     def get_ip_header(self):
-        self.calculate_checksum()
-        sip = socket.inet_pton(socket.AF_INET, self.sip)
-        dip = socket.inet_pton(socket.AF_INET, self.dip)
-        ip_hdr_bin = struct.pack('!BBHHHBBH4s4s', self.vhl, self.tos,
-                                 self.length, self.id, self.frag, self.ttl,
-                                 self.protocol, self.checksum, sip, dip)
-        return ip_hdr_bin
+        if self.header is None:
+            self.calculate_checksum()
+            self.header = struct.pack('!BBHHHBBH4s4s', self.vhl, self.tos,
+                                      self.length, self.id, self.frag,
+                                      self.ttl, self.protocol, self.checksum,
+                                      self.sip, self.dip)
+        return self.header
 
     def get_version(self):
         return 4
@@ -2318,6 +2996,7 @@ class IPV4(IP):
         self.frag = offset
         if more_frags:
             self.frag += MORE_FRAGMENTS
+        self.header = None
 
 
 class IPV6(IP):
@@ -2335,44 +3014,419 @@ class IPV6(IP):
         self.length = 0
         self.protocol = 0
         self.size = 40
+        self.fragmented = False
+        self.id = 0
+        self.frag = 0x0000
 
     def gen_ip(self, home=False, target=None):
-        myip = [0x2001, random.randint(0x0000, 0x01F8) + 0x400]
-        start = 2
-        if home and (HOME_IP_PREFIXESv6 or target):
-            prefix = []
-            myip = []
-            start = 0
-            if target is not None:
-                prefix = target
-            else:
-                prefix = random.choice(HOME_IP_PREFIXESv6)
-            bytes = prefix.split(':')
-            for b in bytes:
-                if b:
-                    myip.append(int(b, 16))
-            start = len(myip)
-        for _ in range(start, 8):
-            myip.append(random.randint(0, 65535))
-        return ':'.join(['%04x' % byte for byte in myip])
+        if target is None or not home:
+            target = 'any'
+            if HOST_POPULATION is not None:
+                host_ip = HOST_POPULATION.get_ip(target, 6, home)
+                if host_ip is not None:
+                    return host_ip
+        return get_ip_spec(target, 6, home).get_packed_ip()
 
     def get_ip_header(self):
-        sip = socket.inet_pton(socket.AF_INET6, self.sip)
-        dip = socket.inet_pton(socket.AF_INET6, self.dip)
-        ip_hdr_bin = struct.pack('!HHHBB16s16s', self.vtc,
-                                 self.flow_label, self.length,
-                                 self.protocol, self.ttl, sip, dip)
-        return ip_hdr_bin
+        """
+            The length set on the header is the length of the whole IP
+            packet, while the IPv6 header carries the payload length
+            (everything after the 40 byte fixed header).  Fragments
+            carry a Fragment extension header after the fixed header.
+        """
+        if self.header is None:
+            next_header = self.protocol
+            if self.fragmented:
+                next_header = IPV6_FRAGMENT_HEADER
+            self.header = struct.pack('!HHHBB16s16s', self.vtc,
+                                      self.flow_label,
+                                      max(self.length - 40, 0),
+                                      next_header, self.ttl, self.sip,
+                                      self.dip)
+            if self.fragmented:
+                self.header += struct.pack('!BBHI', self.protocol, 0,
+                                           self.frag, self.id)
+        return self.header
 
     def get_version(self):
         return 6
 
+    def get_frag_id(self):
+        return self.id
+
+    def get_frag_offset(self):
+        return self.frag
+
+    def set_frag(self, id=0, offset=0, more_frags=False):
+        """
+            Turns this header into the header of a fragment by adding
+            an IPv6 Fragment extension header.  The offset is in 8 byte
+            units as for IPv4.
+        """
+        self.fragmented = True
+        self.size = 40 + IPV6_FRAGMENT_HEADER_SIZE
+        self.id = id
+        self.frag = offset << 3
+        if more_frags:
+            self.frag |= 1
+        self.header = None
+
+
+class RangeSpec:
+    """
+        Base class for compiled Snort header values (ports and
+        addresses).  A value is parsed once into a list of choices, each
+        choice being a set of integer ranges.  get_value() picks a choice
+        uniformly and then a value uniformly from that choice's ranges.
+        Negated values are removed from every choice; a list holding only
+        negated values selects from every other value.  Subclasses
+        provide parse_value() for single values and get_any() for the
+        full value space.
+    """
+
+    kind = 'value'
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.choices = []
+        choices, excluded = self.parse(spec, 0)
+        choices = [c for c in choices if c]
+        if not choices:
+            choices = [self.get_any()]
+        for ranges in choices:
+            ranges = self.subtract(ranges, excluded)
+            if ranges:
+                self.choices.append(self.build_choice(ranges))
+        if not self.choices:
+            warnings.warn(self.kind.capitalize() + " excludes every " +
+                          self.kind + ": " + str(spec) + " using any " +
+                          self.kind + ".", UserWarning)
+            self.choices.append(self.build_choice(self.get_any()))
+        self.num_choices = len(self.choices)
+
+    def __str__(self):
+        return str(self.spec)
+
+    def build_choice(self, ranges):
+        # Each range is stored with a base such that a uniform draw r
+        # in [0, total) maps to base + r for the range holding r.
+        bases = []
+        ends = []
+        total = 0
+        for start, end in ranges:
+            bases.append(start - total)
+            total += end - start + 1
+            ends.append(total)
+        return bases, ends, total
+
+    def get_any(self):
+        return []
+
+    def get_value(self):
+        if self.num_choices == 1:
+            bases, ends, total = self.choices[0]
+        else:
+            bases, ends, total = self.choices[
+                random.randrange(self.num_choices)]
+        r = random.randrange(total)
+        if len(ends) == 1:
+            return bases[0] + r
+        return bases[bisect_right(ends, r)] + r
+
+    def get_ranges(self):
+        ranges = []
+        for bases, ends, _ in self.choices:
+            start = 0
+            for base, end in zip(bases, ends):
+                ranges.append((base + start, base + end - 1))
+                start = end
+        return self.merge(ranges)
+
+    def merge(self, ranges):
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1] + 1:
+                if end > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], end)
+            else:
+                merged.append((start, end))
+        return merged
+
+    def parse(self, value, depth):
+        """
+            Returns the list of choices (each a list of ranges) and the
+            list of excluded ranges for a value.
+        """
+        if depth > 16:
+            raise ValueError(self.kind.capitalize() +
+                             " variables nested too deeply: " +
+                             str(self.spec))
+        value = str(value).strip()
+        negate = False
+        if value.startswith('!'):
+            negate = True
+            value = value[1:].strip()
+        if value.startswith('[') and value.endswith(']'):
+            choices = []
+            excluded = []
+            for item in self.split_list(value[1:-1]):
+                item_choices, item_excluded = self.parse(item, depth + 1)
+                choices.extend(item_choices)
+                excluded.extend(item_excluded)
+        elif self.split_list(value) != [value]:
+            return self.parse('!' * negate + '[' + value + ']', depth)
+        else:
+            choices = [self.parse_value(value, depth)]
+            excluded = []
+        if negate:
+            ranges = []
+            for c in choices:
+                ranges.extend(c)
+            return [], ranges + excluded
+        return choices, excluded
+
+    def parse_value(self, value, depth):
+        return self.get_any()
+
+    def split_list(self, value):
+        items = []
+        level = 0
+        current = ''
+        for c in value:
+            if c == '[':
+                level += 1
+            elif c == ']':
+                level -= 1
+            if c == ',' and level == 0:
+                items.append(current.strip())
+                current = ''
+            else:
+                current += c
+        if current.strip():
+            items.append(current.strip())
+        return items
+
+    def subtract(self, ranges, excluded):
+        if not excluded:
+            return ranges
+        result = []
+        excluded = self.merge(excluded)
+        for start, end in self.merge(ranges):
+            for ex_start, ex_end in excluded:
+                if ex_end < start or ex_start > end:
+                    continue
+                if ex_start > start:
+                    result.append((start, ex_start - 1))
+                start = ex_end + 1
+                if start > end:
+                    break
+            if start <= end:
+                result.append((start, end))
+        return result
+
+
+class PortSpec(RangeSpec):
+    """
+        Compiled form of a Snort port value (see RangeSpec).
+        Supported forms:
+            80, any, 1024:, :1024, 10:20, $HTTP_PORTS,
+            [80,443,8000:8080], !80, [1:1024,!80], ![80,443]
+    """
+
+    kind = 'port'
+
+    def get_any(self):
+        return [(0, 65535)]
+
+    def get_port_value(self):
+        return self.get_value()
+
+    def parse_value(self, port_val, depth):
+        if port_val.find(":") >= 0:
+            low, _, high = port_val.partition(":")
+            try:
+                start = int(low) if low else 0
+            except ValueError:
+                start = 0
+            try:
+                end = int(high) if high else 65535
+            except ValueError:
+                end = 65535
+            if end <= start:
+                end = 65535
+            return [(start, min(end, 65535))]
+        if port_val.isdigit():
+            return [(int(port_val), int(port_val))]
+        name = port_val.lstrip('$').upper()
+        if name in PORT_VARS:
+            ranges = []
+            choices, excluded = self.parse(PORT_VARS[name], depth + 1)
+            for c in choices:
+                ranges.extend(c)
+            return self.subtract(self.merge(ranges), excluded)
+        lower = port_val.lower()
+        for keyword, ports in PORT_GROUPS.items():
+            if lower.find(keyword) >= 0:
+                var_name = keyword.upper() + '_PORTS'
+                if var_name in PORT_VARS:
+                    return self.parse_value('$' + var_name, depth + 1)
+                return self.merge([(p, p) for p in ports])
+        if lower.find("any") >= 0:
+            return [(0, 65535)]
+        warnings.warn("unknown port value: " + port_val +
+                      " using random value.", UserWarning)
+        return [(0, 65535)]
+
+
+class IPSpec(RangeSpec):
+    """
+        Compiled form of a Snort address value for one IP version (see
+        RangeSpec).  Addresses are held as integers so sampling is a
+        couple of integer operations; get_packed_ip() returns the
+        network order bytes and get_ip() the printable address.
+        Supported forms:
+            any, 10.1.2.3, 10.0.0.0/8, 10.1 (prefix of whole octets),
+            2001:db8::/32, 2001:db8 (prefix of whole groups),
+            $HOME_NET, $EXTERNAL_NET, $*_SERVERS, [list], !negation
+        'any' with home set and $HOME_NET/$*_SERVERS select from the
+        home prefixes (HOME_IP_PREFIXES or HOME_IP_PREFIXESv6) while
+        $EXTERNAL_NET selects any address outside of them.  ipvar
+        definitions from a vars file take precedence.  Addresses of the
+        other IP version are ignored, falling back to any address.
+    """
+
+    kind = 'address'
+
+    def __init__(self, snort_ip_val='any', version=4, home=False):
+        self.version = version
+        self.home = home
+        if version == 6:
+            self.family = socket.AF_INET6
+        else:
+            self.family = socket.AF_INET
+        super().__init__(snort_ip_val)
+
+    def get_any(self):
+        if self.version == 6:
+            return [IPV6_ANY_RANGE]
+        return [(0, 0xffffffff)]
+
+    def get_home_prefixes(self):
+        if self.version == 6:
+            return HOME_IP_PREFIXESv6
+        return HOME_IP_PREFIXES
+
+    def get_ip(self):
+        return socket.inet_ntop(self.family, self.get_packed_ip())
+
+    def get_packed_ip(self):
+        if self.version == 6:
+            return self.get_value().to_bytes(16, 'big')
+        return IPV4_ADDR.pack(self.get_value())
+
+    def parse(self, value, depth):
+        # Substitute variables and home prefixes as lists so that each
+        # prefix is an equally likely choice.
+        value = str(value).strip()
+        negate = ''
+        if value.startswith('!'):
+            negate = '!'
+            value = value[1:].strip()
+        alias = self.resolve(value)
+        if alias is not None:
+            return super().parse(negate + '[' + alias + ']', depth + 1)
+        return super().parse(negate + value, depth)
+
+    def parse_address(self, value):
+        addr, _, prefix_len = value.partition('/')
+        addr = addr.strip()
+        if self.version == 6:
+            if ':' not in addr:
+                return None
+            if '::' in addr or addr.count(':') == 7:
+                groups = 8
+                num = int.from_bytes(
+                    socket.inet_pton(socket.AF_INET6, addr), 'big')
+            else:
+                parts = addr.strip(':').split(':')
+                groups = len(parts)
+                num = 0
+                for part in parts:
+                    group = int(part, 16)
+                    if group > 0xffff or groups > 8:
+                        raise ValueError(value)
+                    num = (num << 16) | group
+                num <<= 16 * (8 - groups)
+            bits = 128
+            default_len = 16 * groups
+        else:
+            if ':' in addr:
+                return None
+            parts = addr.strip('.').split('.')
+            if len(parts) > 4:
+                raise ValueError(value)
+            num = 0
+            for part in parts:
+                octet = int(part)
+                if octet < 0 or octet > 255:
+                    raise ValueError(value)
+                num = (num << 8) | octet
+            num <<= 8 * (4 - len(parts))
+            bits = 32
+            default_len = 8 * len(parts)
+        if prefix_len:
+            prefix_len = int(prefix_len)
+            if prefix_len < 0 or prefix_len > bits:
+                raise ValueError(value)
+        else:
+            prefix_len = default_len
+        host_mask = (1 << (bits - prefix_len)) - 1
+        low = num & ~host_mask
+        return low, low | host_mask
+
+    def parse_value(self, ip_val, depth):
+        if ip_val.lower() in ['any', '*'] or ip_val.startswith('$'):
+            return self.get_any()
+        try:
+            ip_range = self.parse_address(ip_val)
+        except (ValueError, OSError):
+            warnings.warn("unknown address value: " + ip_val +
+                          " using random value.", UserWarning)
+            return self.get_any()
+        if ip_range is None:
+            return []
+        return [ip_range]
+
+    def resolve(self, value):
+        """
+            Returns the replacement list for 'any' and $ variables, or
+            None if the value is parsed as is.
+        """
+        prefixes = ','.join(self.get_home_prefixes())
+        if value.lower() in ['any', '*']:
+            if self.home and prefixes:
+                return prefixes
+            return None
+        if not value.startswith('$'):
+            return None
+        name = value[1:].upper()
+        if name in IP_VARS:
+            return IP_VARS[name]
+        if not prefixes:
+            return None
+        if name == 'HOME_NET' or name.endswith('_SERVERS'):
+            return prefixes
+        if name == 'EXTERNAL_NET':
+            return '![' + prefixes + ']'
+        return None
+
 
 class Port:
     """
-        Container and Generator for port values.  Will take a Snort
-        port value listing, parse it, and randomly select a potential
-        option.  Call get_port_value() to get the port value chosen.
+        Container for a port value.  Will take a Snort port value
+        listing and select a potential option using the compiled
+        PortSpec for that listing (see get_port_spec()).
+        Call get_port_value() to get the port value chosen.
         If the constructor is called with no value, will randomly choose
         a port using the 'any' category.
     """
@@ -2380,17 +3434,15 @@ class Port:
     def __init__(self, snort_port_val=None):
         if snort_port_val is None:
             snort_port_val = 'any'
-        snort_port_val = snort_port_val.strip()
-
-        # Strip away brackets
-        if snort_port_val[0] == '[':
-            snort_port_val = snort_port_val[1:-1]
-
-        # Contains a list
-        if snort_port_val.find(',') > -1:
-            self.process_list(snort_port_val)
+        if isinstance(snort_port_val, int):
+            self.port_value = snort_port_val
+        elif isinstance(snort_port_val, PortSpec):
+            self.port_value = snort_port_val.get_port_value()
+        elif snort_port_val.isdigit():
+            self.port_value = int(snort_port_val)
         else:
-            self.process_port_val(snort_port_val)
+            self.port_value = get_port_spec(
+                snort_port_val).get_port_value()
 
     def __str__(self):
         return str(self.get_port_value())
@@ -2398,57 +3450,6 @@ class Port:
     def get_port_value(self):
         return self.port_value
 
-    def process_list(self, list):
-
-        values = list.split(',')
-        chosen_value = random.choice(values)
-        self.process_port_val(chosen_value)
-
-    def process_port_val(self, port_val=None):
-        print(port_val)
-        if port_val.find(":") >= 0:
-            range = port_val.partition(":")
-            if range[0]:
-                try:
-                    start = int(range[0])
-                except:
-                    start = 0
-            else:
-                start = 0
-            if range[2] and int(range[2]) > start:
-                end = int(range[2])
-            else:
-                end = 65535
-            chosen = random.randint(0, end - start)
-            self.port_value = chosen + start
-        elif port_val.lower().find("http") >= 0:
-            self.port_value = random.choice(HTTP_PORTS)
-        elif port_val.lower().find("ftp") >= 0:
-            self.port_value = random.choice(FTP_PORTS)
-        elif port_val.lower().find("mail") >= 0:
-            self.port_value = random.choice(MAIL_PORTS)
-        elif port_val.lower().find("pop") >= 0:
-            self.port_value = random.choice(POP_PORTS)
-        elif port_val.lower().find("smb") >= 0:
-            self.port_value = random.choice(SMB_PORTS)
-        elif port_val.lower().find("nbt") >= 0:
-            self.port_value = random.choice(NBT_PORTS)
-        elif port_val.lower().find("nntp") >= 0:
-            self.port_value = random.choice(NNTP_PORTS)
-        elif port_val.lower().find("dns") >= 0:
-            self.port_value = random.choice(DNS_PORTS)
-        elif port_val.lower().find("file") >= 0:
-            self.port_value = random.choice(FILE_PORTS)
-        elif port_val.lower().find("oracle") >= 0:
-            self.port_value = random.choice(ORACLE_PORTS)
-        elif port_val.lower().find("any") >= 0:
-            self.port_value = random.randint(0, 65535)
-        elif port_val.isdigit():
-            self.port_value = int(port_val)
-        else:
-            print("unknown port value: ", port_val, " returning random value.")
-            self.port_value = random.randint(0, 65535)
-
 
 class TransportLayer:
     """
@@ -2459,6 +3460,7 @@ class TransportLayer:
     def __init__(self, proto, size, sport=None, dport=None):
         self.proto = proto
         self.size = size
+        self.header = None
         if sport and type(sport) == Port:
             self.sport = sport
         elif sport and type(sport) != Port:
@@ -2492,17 +3494,16 @@ class TransportLayer:
     def set_checksum(self, sip=None, dip=None, proto=None, length=0,
                      data=None):
         self.checksum = 0
+        self.header = None
         hdr = None
 
         # build pseudo header
         if sip and dip:
-            if sip.find(":") >= 0:
-                sip = socket.inet_pton(socket.AF_INET6, sip)
-                dip = socket.inet_pton(socket.AF_INET6, dip)
+            sip = pack_ip(sip)
+            dip = pack_ip(dip)
+            if len(sip) == 16:
                 hdr = struct.pack('!16s16sHH', sip, dip, proto, length)
             else:
-                sip = socket.inet_pton(socket.AF_INET, sip)
-                dip = socket.inet_pton(socket.AF_INET, dip)
                 hdr = struct.pack('!4s4sHH', sip, dip, proto, length)
         else:
             print("Missing IP address in transport pseudo header.")
@@ -2522,12 +3523,15 @@ class TransportLayer:
             sum = (sum & 0xffff) + (sum >> 16)
         sum = (sum ^ 0xffff)
         self.checksum = sum
+        self.header = None
 
     def set_src_port(self, sport):
         self.sport = Port(sport)
+        self.header = None
 
     def set_dst_port(self, dport):
         self.dport = Port(dport)
+        self.header = None
 
 
 class ICMP(TransportLayer):
@@ -2546,9 +3550,10 @@ class ICMP(TransportLayer):
         self.checksum = 0
 
     def get_transport_header(self):
-        icmp_bin = struct.pack('!BBHI', self.type, self.code,
-                               self.checksum, self.rest_of_header)
-        return icmp_bin
+        if self.header is None:
+            self.header = struct.pack('!BBHI', self.type, self.code,
+                                      self.checksum, self.rest_of_header)
+        return self.header
 
 
 class TCP(TransportLayer):
@@ -2568,13 +3573,14 @@ class TCP(TransportLayer):
         self.checksum = 0
 
     def get_transport_header(self):
-        flags_n_offset = (self.offset << 12) + self.flags
-        tcp_hdr = struct.pack('!HHIIHHHH',
-                              self.sport.get_port_value(),
-                              self.dport.get_port_value(), self.seq,
-                              self.ack, flags_n_offset, self.window,
-                              self.checksum, self.urg)
-        return tcp_hdr
+        if self.header is None:
+            flags_n_offset = (self.offset << 12) + self.flags
+            self.header = struct.pack('!HHIIHHHH',
+                                      self.sport.get_port_value(),
+                                      self.dport.get_port_value(), self.seq,
+                                      self.ack, flags_n_offset, self.window,
+                                      self.checksum, self.urg)
+        return self.header
 
     def get_flags(self):
         return self.flags
@@ -2587,12 +3593,15 @@ class TCP(TransportLayer):
 
     def set_seq_num(self, seq=0):
         self.seq = seq
+        self.header = None
 
     def set_ack_num(self, ack=0):
         self.ack = ack
+        self.header = None
 
     def set_flags(self, flags=0):
         self.flags = flags
+        self.header = None
 
 
 class UDP(TransportLayer):
@@ -2603,10 +3612,12 @@ class UDP(TransportLayer):
         self.checksum = 0
 
     def get_transport_header(self):
-        udp_hdr = struct.pack('!HHHH', self.sport.get_port_value(),
-                              self.dport.get_port_value(), self.length,
-                              self.checksum)
-        return udp_hdr
+        if self.header is None:
+            self.header = struct.pack('!HHHH', self.sport.get_port_value(),
+                                      self.dport.get_port_value(),
+                                      self.length, self.checksum)
+        return self.header
 
     def set_length(self, length=0):
         self.length = length
+        self.header = None
@@ -0,0 +1,234 @@
+"""
+    Schedulers for the conversations waiting to send their next packet.
+
+    A scheduler holds (time_ns, seq, conversation) entries and hands
+    them back in (time_ns, seq) order, where seq is the order in which
+    the entries were pushed.  Conversations with equal times therefore
+    come out first in, first out and are never compared themselves.
+
+    Available schedulers (see make_scheduler()):
+
+      heap         A binary heap (the default).  O(log n) push and pop.
+      wheel        A hierarchical timing wheel.  O(1) push; pop is O(1)
+                   amortized plus a small heap over the entries that
+                   share the current tick.
+      sorteddict   A SortedDict of lists keyed by time, as used by
+                   earlier versions of sniffles.  Kept for comparison.
+"""
+import heapq
+from itertools import count
+
+from sortedcontainers import SortedDict
+
+# Timing wheel geometry: 4 levels of 256 slots with a 1 microsecond
+# tick cover 2**32 microseconds (about 71 minutes) ahead of the current
+# time.  Entries further out wait in an overflow heap.
+WHEEL_TICK_NS = 1000
+WHEEL_SLOT_BITS = 8
+WHEEL_LEVELS = 4
+
+
+class Scheduler:
+    """
+        Base class for schedulers.  Should not be instantiated (it
+        behaves as a scheduler that is always empty).  Subclasses
+        implement push(), pop(), peek_time() and __len__().
+
+          push(time_ns, conversation): schedule conversation at time_ns.
+          pop(): remove and return the earliest (time_ns, conversation).
+          peek_time(): the time of the earliest entry, or -1 if empty.
+          len(scheduler): the number of scheduled entries.
+    """
+
+    name = None
+
+    def __init__(self):
+        self.seq = count()
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __len__(self):
+        return 0
+
+    def push(self, time_ns, conversation):
+        pass
+
+    def pop(self):
+        return None
+
+    def peek_time(self):
+        return -1
+
+
+class HeapScheduler(Scheduler):
+
+    name = 'heap'
+
+    def __init__(self):
+        super().__init__()
+        self.heap = []
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, time_ns, conversation):
+        heapq.heappush(self.heap, (time_ns, next(self.seq), conversation))
+
+    def pop(self):
+        time_ns, _, conversation = heapq.heappop(self.heap)
+        return time_ns, conversation
+
+    def peek_time(self):
+        if self.heap:
+            return self.heap[0][0]
+        return -1
+
+
+class TimingWheelScheduler(Scheduler):
+    """
+        Hierarchical timing wheel.  Level l holds the entries whose tick
+        shares every bit above level l with the current tick, in the
+        slot given by their level-l bits.  When the current tick is
+        exhausted the wheel moves to the next occupied slot, cascading
+        higher-level slots down as it goes.  Entries of the current tick
+        (and entries pushed in the past) sit in a small heap so that
+        they come out in exact (time_ns, seq) order.
+    """
+
+    name = 'wheel'
+
+    def __init__(self, tick_ns=WHEEL_TICK_NS, slot_bits=WHEEL_SLOT_BITS,
+                 levels=WHEEL_LEVELS):
+        super().__init__()
+        self.tick_ns = tick_ns
+        self.slot_bits = slot_bits
+        self.slot_mask = (1 << slot_bits) - 1
+        self.levels = levels
+        self.wheels = [[[] for _ in range(1 << slot_bits)]
+                       for _ in range(levels)]
+        # One bit per non-empty slot, per level.
+        self.occupied = [0] * levels
+        self.ready = []
+        self.overflow = []
+        self.now = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, time_ns, conversation):
+        self.place((time_ns, next(self.seq), conversation))
+        self.size += 1
+
+    def place(self, entry):
+        tick = entry[0] // self.tick_ns
+        if self.now is None:
+            self.now = tick
+        if tick <= self.now:
+            heapq.heappush(self.ready, entry)
+            return
+        for level in range(self.levels):
+            shift = self.slot_bits * (level + 1)
+            if tick >> shift == self.now >> shift:
+                slot = (tick >> (shift - self.slot_bits)) & self.slot_mask
+                self.wheels[level][slot].append(entry)
+                self.occupied[level] |= 1 << slot
+                return
+        heapq.heappush(self.overflow, entry)
+
+    def advance(self):
+        # Move the current tick forward to the next occupied slot and
+        # fill the ready heap from it.
+        while not self.ready:
+            for level in range(self.levels):
+                shift = self.slot_bits * level
+                current = (self.now >> shift) & self.slot_mask
+                later = self.occupied[level] >> (current + 1)
+                if later:
+                    slot = current + (later & -later).bit_length()
+                    break
+            else:
+                # Every wheel is empty: jump to the first overflow entry
+                # and take back everything now within reach.
+                self.now = self.overflow[0][0] // self.tick_ns
+                pending = self.overflow
+                self.overflow = []
+                for entry in pending:
+                    self.place(entry)
+                continue
+            high = self.slot_bits * (level + 1)
+            self.now = ((self.now >> high) << high) | \
+                (slot << (high - self.slot_bits))
+            entries = self.wheels[level][slot]
+            self.wheels[level][slot] = []
+            self.occupied[level] &= ~(1 << slot)
+            for entry in entries:
+                self.place(entry)
+
+    def pop(self):
+        if not self.ready:
+            self.advance()
+        time_ns, _, conversation = heapq.heappop(self.ready)
+        self.size -= 1
+        return time_ns, conversation
+
+    def peek_time(self):
+        if not self.size:
+            return -1
+        if not self.ready:
+            self.advance()
+        return self.ready[0][0]
+
+
+class SortedDictScheduler(Scheduler):
+
+    name = 'sorteddict'
+
+    def __init__(self):
+        super().__init__()
+        self.queue = SortedDict()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, time_ns, conversation):
+        if time_ns in self.queue:
+            self.queue[time_ns].append(conversation)
+        else:
+            self.queue[time_ns] = [conversation]
+        self.size += 1
+
+    def pop(self):
+        time_ns, con_list = self.queue.peekitem(0)
+        conversation = con_list.pop(0)
+        if not con_list:
+            del self.queue[time_ns]
+        self.size -= 1
+        return time_ns, conversation
+
+    def peek_time(self):
+        if self.queue:
+            return self.queue.peekitem(0)[0]
+        return -1
+
+
+SCHEDULERS = {
+    'heap': HeapScheduler,
+    'wheel': TimingWheelScheduler,
+    'sorteddict': SortedDictScheduler,
+}
+
+
+def make_scheduler(name=None):
+    """
+        Builds the scheduler with the given name (heap by default).
+        Raises ValueError for an unknown name.
+    """
+    if not name:
+        return HeapScheduler()
+    name = name.strip().lower()
+    if name not in SCHEDULERS:
+        raise ValueError("Unknown scheduler: " + name)
+    return SCHEDULERS[name]()
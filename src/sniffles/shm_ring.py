@@ -0,0 +1,222 @@
+"""
+    Shared memory transport from generator workers to the writer.
+
+    With --workers and --shm, each worker gets a RecordRing: a single
+    producer, single consumer ring buffer in a
+    multiprocessing.shared_memory block.  The worker serializes each
+    packet straight into the ring as a pcap record (record header and
+    packet), followed by its result file line.  A small ring of fixed
+    size index entries gives the time, position and lengths of every
+    record.  The writer (the parent process) merges the rings by time
+    and writes each record to the pcap from a view of the shared memory,
+    so packets are never pickled or copied again on their way out.
+
+    Block layout (all counters are 64-bit and only ever grow; positions
+    in the rings are the counters modulo the ring sizes):
+
+      0   data written      8   data read
+      16  index written     24  index read
+      32  closed            40  streams, 48 packets, 56 last second
+      64  index ring: INDEX_ENTRY.size bytes per entry
+      ..  data ring
+
+    Each counter has a single writer, and a producer fills in a record
+    before it publishes it by moving "index written" forward (and the
+    consumer reads a record before it frees it), so no locks are needed.
+
+    multiprocessing.shared_memory needs Python 3.8; on older versions
+    shared_memory is None and --shm is refused.
+"""
+import struct
+import time
+
+from sniffles.traffic_writer import NSEC_PER_SEC, NSEC_PER_USEC, RECORD_HEADER
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+RING_DATA_SIZE = 16 * 1024 * 1024
+RING_INDEX_SLOTS = 65536
+RING_HEADER_SIZE = 64
+COUNTER = struct.Struct('Q')
+# time_ns, data position, record length, result line length
+INDEX_ENTRY = struct.Struct('QQII')
+DATA_WRITTEN = 0
+DATA_READ = 8
+INDEX_WRITTEN = 16
+INDEX_READ = 24
+CLOSED = 32
+STATS = 40
+# Polling backs off up to this many seconds while a ring is full or
+# empty.
+RING_MAX_WAIT = 0.001
+
+
+class RecordRing:
+    """
+        A ring of pcap records in shared memory.  Create it in the
+        writer with RecordRing(), fork the worker, and use it from both
+        sides; call unlink() in the writer when done.
+
+        Worker side: write_packet_ns(length, pkt, time_ns) and then
+        write(line) for its result line (the ring stands in for both the
+        TrafficWriter and the result file of the worker), and finally
+        close_save_file() and set_stats().
+
+        Writer side: peek() for the next (time_ns, record, line) view,
+        release() once it is written, and get_stats() at the end.
+    """
+
+    def __init__(self, data_size=RING_DATA_SIZE, index_slots=RING_INDEX_SLOTS,
+                 nanosecond=False):
+        self.data_size = data_size
+        self.index_slots = index_slots
+        self.nanosecond = nanosecond
+        self.data_start = RING_HEADER_SIZE + index_slots * INDEX_ENTRY.size
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=self.data_start + data_size)
+        self.buf = self.shm.buf
+        self.buf[:self.data_start] = bytes(self.data_start)
+        self.total_pkts = 0
+        self.current_ns = 0
+        self.pending = None
+        self.alive = None
+
+    def get(self, offset):
+        return COUNTER.unpack_from(self.buf, offset)[0]
+
+    def put(self, offset, value):
+        COUNTER.pack_into(self.buf, offset, value)
+
+    def unlink(self):
+        self.buf = None
+        self.shm.close()
+        self.shm.unlink()
+
+    def wait(self, ready):
+        delay = 0.00001
+        while not ready():
+            if self.alive is not None and not self.alive() and \
+                    not ready():
+                raise RuntimeError("A generator worker died.")
+            time.sleep(delay)
+            delay = min(delay * 2, RING_MAX_WAIT)
+
+    # Worker side
+
+    def get_total_pkts(self):
+        return self.total_pkts
+
+    def get_timestamp_ns(self):
+        return self.current_ns
+
+    def write_packet_ns(self, len=0, pkt=None, time_ns=-1):
+        if time_ns >= 0:
+            self.current_ns = time_ns
+        self.total_pkts += 1
+        self.pending = (self.current_ns, len, pkt)
+        return self.current_ns
+
+    def write(self, line):
+        time_ns, length, pkt = self.pending
+        self.pending = None
+        note = line.encode()
+        size = RECORD_HEADER.size + length + len(note)
+        if size > self.data_size:
+            raise ValueError("Packet too large for the ring.")
+        written = self.get(DATA_WRITTEN)
+        offset = written % self.data_size
+        if offset + size > self.data_size:
+            # Records never wrap, so they can be written out in one go.
+            written += self.data_size - offset
+            offset = 0
+        self.wait(lambda: written + size - self.get(DATA_READ) <=
+                  self.data_size)
+        index = self.get(INDEX_WRITTEN)
+        self.wait(lambda: index - self.get(INDEX_READ) < self.index_slots)
+        secs, frac = divmod(time_ns, NSEC_PER_SEC)
+        if not self.nanosecond:
+            frac //= NSEC_PER_USEC
+        start = self.data_start + offset
+        RECORD_HEADER.pack_into(self.buf, start, secs, frac, length, length)
+        start += RECORD_HEADER.size
+        self.buf[start:start + length] = pkt
+        self.buf[start + length:start + length + len(note)] = note
+        INDEX_ENTRY.pack_into(self.buf, RING_HEADER_SIZE +
+                              (index % self.index_slots) * INDEX_ENTRY.size,
+                              time_ns, written, length, len(note))
+        self.put(DATA_WRITTEN, written + size)
+        self.put(INDEX_WRITTEN, index + 1)
+
+    def close(self):
+        pass
+
+    def close_save_file(self):
+        self.put(CLOSED, 1)
+
+    def set_stats(self, streams, packets, last_sec):
+        for i, value in enumerate([streams, packets, last_sec]):
+            self.put(STATS + 8 * i, value)
+
+    # Writer side
+
+    def peek(self):
+        """
+            Returns (time_ns, record, line) for the next record, or None
+            once the worker has closed the ring and everything has been
+            read.  record and line are views of the shared memory that
+            stay valid until release().
+        """
+        index = self.get(INDEX_READ)
+        self.wait(lambda: self.get(INDEX_WRITTEN) > index or
+                  self.get(CLOSED))
+        if self.get(INDEX_WRITTEN) <= index:
+            return None
+        time_ns, position, length, note_length = INDEX_ENTRY.unpack_from(
+            self.buf, RING_HEADER_SIZE +
+            (index % self.index_slots) * INDEX_ENTRY.size)
+        start = self.data_start + position % self.data_size
+        end = start + RECORD_HEADER.size + length
+        self.pending = position + end - start + note_length
+        return time_ns, self.buf[start:end], \
+            self.buf[end:end + note_length]
+
+    def release(self):
+        self.put(DATA_READ, self.pending)
+        self.put(INDEX_READ, self.get(INDEX_READ) + 1)
+
+    def get_stats(self):
+        return [self.get(STATS + 8 * i) for i in range(3)]
+
+
+def merge_rings(rings, traffic_writer, fd_result):
+    """
+        Writes the records of the rings to traffic_writer (and their
+        result lines, renumbered, to fd_result) in time order, until
+        every ring is closed and empty.  Each ring must be in time
+        order.  Returns the number of packets written.
+    """
+    heads = {}
+    for index, ring in enumerate(rings):
+        head = ring.peek()
+        if head is not None:
+            heads[index] = head
+    total_pkts = 0
+    while heads:
+        index = min(heads, key=lambda i: (heads[i][0], i))
+        _, record, line = heads[index]
+        traffic_writer.write_records(record, 1)
+        total_pkts += 1
+        note = bytes(line).decode()
+        fd_result.write("Pkt " + str(total_pkts) + note[note.find(" :"):])
+        record.release()
+        line.release()
+        rings[index].release()
+        head = rings[index].peek()
+        if head is None:
+            del heads[index]
+        else:
+            heads[index] = head
+    return total_pkts
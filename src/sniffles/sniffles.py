@@ -1,23 +1,42 @@
-import copy
 import datetime
+import multiprocessing
+import os
 import random
 import signal
 import sys
-
-from sortedcontainers import SortedDict
-
+import time
+
+from sniffles.batch import BatchGenerator, batch_limitation
+from sniffles.checkpoint import (CHECKPOINT_SUFFIX, Checkpointer,
+                                 load_checkpoint, sync_file)
+from sniffles.flowtable import FlowTable, parse_flow_mode
+from sniffles.merge import MergeBuffer, merge_pcaps
+from sniffles.metrics import TICK_PACKETS, Metrics
+from sniffles.pipeline import PacketPipeline, packet_comment, result_note
+from sniffles.rate import Pacer, parse_rate
 from sniffles.rulereader import (BackgroundTrafficRule, Rule, RuleList,
                                  ScanAttackRule)
-from sniffles.ruletrafficgenerator import (Conversation, set_ipv4_home,
-                                           set_ipv6_home)
+from sniffles.ruletrafficgenerator import (NSEC_PER_SEC, NSEC_PER_USEC,
+                                           Conversation, clear_mac_ip_map,
+                                           compile_rule_specs,
+                                           get_generator_state,
+                                           get_nfa_cache_stats, read_vars_file,
+                                           set_generator_state,
+                                           set_host_population, set_ipv4_home,
+                                           set_ipv6_home, set_mac_ip_map_size,
+                                           set_timing_distribution)
+from sniffles.scheduler import make_scheduler
+from sniffles.shm_ring import RecordRing, merge_rings
 from sniffles.snifflesconfig import SnifflesConfig, getVersion
-from sniffles.traffic_writer import TrafficWriter
+from sniffles.traffic_writer import PcapngWriter, TrafficWriter
 
 TOTAL_GENERATED_PACKETS = 0
 TOTAL_GENERATED_STREAMS = 0
 GLOBAL_SCONF = None
 START = None
 FINAL = 0
+SHARD_JOB = None
+METRICS = None
 
 """Sniffles.py
    Traffic generator for IDS evaluation.  Please see the usage section
@@ -51,6 +70,8 @@ def main():
     global GLOBAL_SCONF
     global START
     signal.signal(signal.SIGINT, handlerKeyboardInterupt)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, handlerMetricsSnapshot)
     sconf = SnifflesConfig(sys.argv[1:])
     GLOBAL_SCONF = sconf
     start = datetime.datetime.now()
@@ -86,10 +107,11 @@ def start_generation(sconf):
     """ This function controls the reading of rules and the actual
         generation of traffic.
     """
-    global TOTAL_GENERATED_STREAMS
-    global TOTAL_GENERATED_PACKETS
-    global FINAL
-
+    if sconf.getSeed() is not None:
+        random.seed(sconf.getSeed())
+        # Bindings left by an earlier run in this process would save
+        # random draws and change the traffic.
+        clear_mac_ip_map()
     myrulelist = RuleList()
     if sconf.getRuleFile() and sconf.getRuleDir():
         print("You must specify either a single rule file, "
@@ -103,11 +125,20 @@ def start_generation(sconf):
         print("Random Content and Random headers")
         sconf.setRandom(True)
 
+    if sconf.getVarsFile() is not None:
+        read_vars_file(sconf.getVarsFile())
+    set_mac_ip_map_size(sconf.getMacMapSize())
     if sconf.getIPV4Home() is not None:
         set_ipv4_home(sconf.getIPV4Home())
     if sconf.getIPV6Home() is not None:
         set_ipv6_home(sconf.getIPV6Home())
+    set_host_population(sconf.getHostCount(), sconf.getHostSkew(),
+                        sconf.getMacAddrDef())
+    set_timing_distribution(sconf.getTiming())
     allrules = myrulelist.getParsedRules()
+    for rule in allrules:
+        rule.freeze()
+    compile_rule_specs(allrules)
     # Retrieve Background Traffic percentage
     back_traffic_percent = sconf.getBackgroundTraffic()
     if sconf.getBackgroundTrafficRule() is not None:
@@ -127,22 +158,133 @@ def start_generation(sconf):
         back_traffic_percent = bt_rule.getBackgroundPercent()
         back_dist_list = bt_rule.getProbabilityDist()
         back_absent_proto = bt_rule.getAbsentProtocol()
+    background = (back_traffic_percent, back_dist_list, back_absent_proto)
+
+    if sconf.getWriteRegEx():
+        return printRegEx(allrules)
+
+    if not sconf.getEval() and not sconf.getFullEval() and \
+            (not sconf.getBatch() or batch_limitation(sconf, allrules)):
+        state = None
+        if sconf.getResume():
+            try:
+                state = load_checkpoint(sconf.getOutputFile() +
+                                        CHECKPOINT_SUFFIX)
+            except (OSError, ValueError) as err:
+                print("Cannot resume: ", err)
+                sconf.usage()
+        if sconf.getShard() is not None:
+            index, count = sconf.getShard()
+            traffic_writer, fd_result = open_outputs(sconf, state)
+            return generate_shard(allrules, sconf, background,
+                                  random.getrandbits(64), index,
+                                  shard_shares(sconf, count),
+                                  traffic_writer, fd_result, state)
+        if state is not None:
+            traffic_writer, fd_result = open_outputs(sconf, state)
+            return generate_traffic(allrules, sconf, traffic_writer,
+                                    fd_result, background, state=state)
+        if sconf.getWorkers() > 1:
+            return build_sharded_pcap(allrules, sconf, background)
+
+    traffic_writer = make_traffic_writer(sconf, sconf.getOutputFile())
+
+    if sconf.getEval() or sconf.getFullEval():
+        return build_eval_pcap(allrules, traffic_writer, sconf)
+
+    if sconf.getBatch():
+        limitation = batch_limitation(sconf, allrules)
+        if limitation is None:
+            return build_batch_pcap(traffic_writer, sconf)
+        print("Batch generation is not available (" + limitation +
+              "), using the standard generator.")
+
+    return generate_traffic(allrules, sconf, traffic_writer,
+                            open_result_file(sconf), background)
+
+
+def make_traffic_writer(sconf, save_file):
+    """
+        Returns a TrafficWriter (a PcapngWriter with --pcapng) for
+        save_file (opened if it is given) with the timestamp and buffer
+        options of sconf.
+    """
+    writer = PcapngWriter if sconf.getPcapng() else TrafficWriter
+    return writer(save_file, sconf.getFirstTimestamp(),
+                  sconf.getNanosecond(), sconf.getWriteBuffer() * 1024 * 1024)
+
+
+def open_result_file(sconf):
+    """
+        Opens the result file, or returns None with --pcapng, where the
+        rule of each packet is written as its comment instead.
+    """
+    if sconf.getPcapng():
+        return None
+    return open(sconf.getResultFile(), 'w')
+
+
+def open_outputs(sconf, state=None):
+    """
+        Opens the pcap and the result file (see open_result_file()).
+        If state (a checkpoint, see checkpoint.py) is given, they are
+        opened for appending and cut back to their length at the
+        checkpoint.
+    """
+    if state is None:
+        return (make_traffic_writer(sconf, sconf.getOutputFile()),
+                open_result_file(sconf))
+    traffic_writer = make_traffic_writer(sconf, None)
+    traffic_writer.set_file_name(sconf.getOutputFile())
+    traffic_writer.resume_save_file(*state['pcap'])
+    if sconf.getPcapng():
+        return traffic_writer, None
+    fd_result = open(sconf.getResultFile(), 'r+')
+    fd_result.truncate(state['result'])
+    fd_result.seek(state['result'])
+    return traffic_writer, fd_result
+
+
+def generate_traffic(allrules, sconf, traffic_writer, fd_result,
+                     background, scans=True, total_streams=None,
+                     rate_share=1, state=None, shard=None):
+    """
+        The main generation loop: conversations are created from the
+        rules (or at random) and their packets written through
+        traffic_writer (and their result lines to fd_result, if it is
+        not None, both of which are closed at the end) until -c streams
+        (or total_streams, if given) are generated or the -D duration is
+        reached.  background holds the background traffic percentage,
+        distribution and absent protocol.  The -s scan attacks are only
+        added if scans is True.  With --rate, the packets are paced to
+        rate_share of the rate, and with --flows poisson, flows arrive
+        at rate_share of the arrival rate.  With --checkpoint, the state
+        of the loop is saved regularly; if state (a saved checkpoint) is
+        given, the loop carries on from there.  The metrics of the run
+        (see metrics.py) are labeled with shard, if given.
+        Returns [streams, packets, last second].
+    """
+    global TOTAL_GENERATED_STREAMS
+    global TOTAL_GENERATED_PACKETS
+    global FINAL
+    global METRICS
+
+    back_traffic_percent, back_dist_list, back_absent_proto = background
     current = 0
     end = 0
-    current_sec = sconf.getFirstTimestamp()
-    current_usec = 0
+    current_ns = sconf.getFirstTimestamp() * NSEC_PER_SEC
     total_generated_streams = 0
     total_generated_packets = 0
     flow_start_offset = 0
     mix_count = sconf.getMixCount()
-    traffic_queue = SortedDict()
-
-    if sconf.getWriteRegEx():
-        return printRegEx(allrules)
+    flow_mode, arrival_rate = parse_flow_mode(sconf.getFlowMode())
+    next_arrival_ns = current_ns
+    traffic_queue = FlowTable(make_scheduler(sconf.getScheduler()),
+                              sconf.getMaxFlows())
 
     # If we define a scan attack from the command line, add it to the traff
     # here.
-    if sconf.getScan():
+    if scans and sconf.getScan() and state is None:
         base_offset = 0
         for t in sconf.getScanTargets():
             if sconf.getRandomizeOffset():
@@ -160,45 +302,110 @@ def start_generation(sconf):
                                   base_offset,
                                   sconf.getScanReplyChance())
             rule.addTS(r_ts)
-            conversation = Conversation(rule, sconf, current_sec)
-            sec, usec = conversation.getNextTimeStamp()
-            timekey = sec + (usec / 1000000)
-            if timekey in traffic_queue:
-                traffic_queue[timekey].append(conversation)
-            else:
-                traffic_queue[timekey] = [conversation]
+            conversation = Conversation(rule, sconf,
+                                        current_ns // NSEC_PER_SEC)
+            traffic_queue.add(conversation)
             total_generated_streams += conversation.getNumberOfStreams()
 
-    traffic_writer = TrafficWriter(sconf.getOutputFile(),
-                                   sconf.getFirstTimestamp())
-
-    if sconf.getEval() or sconf.getFullEval():
-        return build_eval_pcap(allrules, traffic_writer, sconf)
-
     if sconf.getTrafficDuration() > 0:
         end = sconf.getTrafficDuration() + sconf.getFirstTimestamp()
+    elif total_streams is not None:
+        end = total_streams
     else:
         end = sconf.getTotalStreams()
 
-    # for recording how packets are generated
-    fd_result = open(sconf.getResultFile(), 'w')
-
+    pacer = None
+    if sconf.getRate() is not None:
+        end_ns = None
+        if sconf.getTrafficDuration() > 0:
+            end_ns = end * NSEC_PER_SEC
+        pacer = Pacer(parse_rate(sconf.getRate()).scaled(rate_share),
+                      current_ns, end_ns)
+    merge_buffer = MergeBuffer(traffic_writer, sconf.getWindow(), fd_result,
+                               pacer)
+    pipeline = PacketPipeline(merge_buffer, sconf.getPipeline(),
+                              note=packet_comment if sconf.getPcapng()
+                              else result_note)
+
+    rule_cursor = 0
     if allrules:
         rule_cursor = random.randrange(len(allrules))
+    checkpointer = None
+    if state is not None:
+        random.setstate(state['random'])
+        set_generator_state(state['generator'])
+        traffic_queue = state['flows']
+        merge_buffer.set_state(state['merge'])
+        pacer = merge_buffer.pacer = state['pacer']
+        (current, current_ns, end, total_generated_streams,
+         total_generated_packets, mix_count, rule_cursor,
+         next_arrival_ns) = state['loop']
+        TOTAL_GENERATED_STREAMS = total_generated_streams
+        TOTAL_GENERATED_PACKETS = total_generated_packets
+    if sconf.getCheckpoint() is not None or state is not None:
+        checkpointer = Checkpointer(
+            sconf.getOutputFile() + CHECKPOINT_SUFFIX,
+            sconf.getCheckpoint() or state['interval'])
+        checkpointer.last_packets = total_generated_packets
+
+    metrics_file = None
+    if sconf.getMetricsFile() is not None:
+        # Workers append to the file their parent truncated.
+        metrics_file = open(sconf.getMetricsFile(),
+                            'a' if sconf.getWorkers() > 1 or
+                            state is not None else 'w', buffering=1)
+    metrics = Metrics(sconf.getProgress(), metrics_file, shard)
+    metrics.watch('bytes', lambda: merge_buffer.bytes_out)
+    metrics.watch('written', traffic_writer.get_total_pkts)
+    metrics.watch('conversations', lambda: traffic_queue.opened)
+    metrics.watch('open_flows', lambda: traffic_queue.get_open())
+    metrics.watch('scheduler_depth', lambda: len(traffic_queue))
+    metrics.watch('merge_depth', lambda: len(merge_buffer))
+    metrics.watch('write_seconds', lambda: round(merge_buffer.write_time, 6))
+    if isinstance(traffic_writer, TrafficWriter):
+        metrics.watch('disk_writes', lambda: traffic_writer.flushes)
+        metrics.watch('disk_seconds',
+                      lambda: round(traffic_writer.flush_time, 6))
+    metrics.watch('nfa_cache_hits', lambda: get_nfa_cache_stats()[0])
+    metrics.watch('nfa_cache_misses', lambda: get_nfa_cache_stats()[1])
+
+    def progress():
+        if sconf.getTrafficDuration() > 0:
+            return (current - sconf.getFirstTimestamp(),
+                    sconf.getTrafficDuration())
+        # A stream is done once its conversation is closed.
+        return (total_generated_streams * traffic_queue.closed /
+                max(traffic_queue.opened, 1), end)
+    metrics.set_progress(progress)
+    METRICS = metrics
     while current < end:
         myrule = None
         if sconf.getMixMode() and mix_count >= 0:
             if mix_count > 0 and allrules:
-                myrule = copy.deepcopy(allrules[rule_cursor])
+                myrule = allrules[rule_cursor]
                 mix_count = mix_count - 1
         elif allrules:
-            myrule = copy.deepcopy(allrules[rule_cursor])
+            myrule = allrules[rule_cursor]
         if sconf.getVerbosity():
             print(myrule)
 
-        flow_start_offset = random.randint(
-            1, sconf.getConcurrentFlows() + 100000
-        )
+        start_ns = current_ns
+        if flow_mode == 'fill':
+            flow_start_offset = random.randint(
+                1, sconf.getConcurrentFlows() + 100000
+            )
+        elif flow_mode == 'steady':
+            # The new flow takes over from the one that ended last.
+            if traffic_queue.last_ns >= 0:
+                start_ns = traffic_queue.last_ns
+        else:
+            # Arrivals held back by --maxflows start when a flow ends.
+            start_ns = max(next_arrival_ns, traffic_queue.last_ns)
+            next_arrival_ns += int(random.expovariate(
+                arrival_rate * rate_share) * NSEC_PER_SEC)
+        current_sec, current_usec = divmod(start_ns // NSEC_PER_USEC,
+                                           1000000)
+        begin = time.perf_counter()
         # Create background traffic conversation based on
         # Background traffic rule
         if back_traffic_percent > 0:
@@ -222,44 +429,285 @@ def start_generation(sconf):
             conversation = Conversation(myrule, sconf, current_sec,
                                         current_usec + flow_start_offset)
             rule_cursor = (rule_cursor + 1) % len(allrules) if allrules else 0
+        metrics.add_time('payload', time.perf_counter() - begin)
 
-        sec, usec = conversation.getNextTimeStamp()
-        timekey = timekey = sec + (usec / 1000000)
-        if timekey in traffic_queue:
-            traffic_queue[timekey].append(conversation)
-        else:
-            traffic_queue[timekey] = [conversation]
+        traffic_queue.add(conversation)
         total_generated_streams += conversation.getNumberOfStreams()
+        metrics.count('streams', conversation.getNumberOfStreams())
 
         # Need to track global value in case of interrupt
         TOTAL_GENERATED_STREAMS = total_generated_streams
-        if len(traffic_queue) >= sconf.getConcurrentFlows():
-            pkts, current_sec, current_usec = write_packets(
-                traffic_queue, traffic_writer, sconf, fd_result
+        if flow_mode == 'fill' and \
+                len(traffic_queue) >= sconf.getConcurrentFlows():
+            pkts, current_ns = write_packets(
+                traffic_queue, pipeline, sconf, metrics=metrics
+            )
+            total_generated_packets += pkts
+        if not may_open_flow(traffic_queue, sconf, flow_mode,
+                             next_arrival_ns):
+            pkts, current_ns = write_packets(
+                traffic_queue, pipeline, sconf,
+                lambda: may_open_flow(traffic_queue, sconf, flow_mode,
+                                      next_arrival_ns), metrics
             )
             total_generated_packets += pkts
 
-            # Need to track global values in case of interrupt
-            TOTAL_GENERATED_PACKETS = total_generated_packets
-            FINAL = current_sec
-
-        if sconf.getTrafficDuration() > 0:
-            current = current_sec
+        # Need to track global values in case of interrupt
+        TOTAL_GENERATED_PACKETS = total_generated_packets
+        FINAL = current_ns // NSEC_PER_SEC
+
+        if sconf.getTrafficDuration() > 0 and pacer is not None:
+            # The duration is one of the capture, not of the generator.
+            current = pacer.get_time_ns() // NSEC_PER_SEC
+        elif sconf.getTrafficDuration() > 0 and flow_mode == 'poisson':
+            current = next_arrival_ns // NSEC_PER_SEC
+        elif sconf.getTrafficDuration() > 0:
+            current = current_ns // NSEC_PER_SEC
         elif sconf.getTrafficDuration() <= 0:
             current = total_generated_streams
+        metrics.tick()
+
+        if checkpointer is not None and \
+                checkpointer.due(total_generated_packets):
+            # Everything handed to the pipeline must be in the
+            # MergeBuffer, and everything written on disk.
+            pipeline.sync()
+            traffic_writer.flush()
+            checkpointer.save({
+                'random': random.getstate(),
+                'generator': get_generator_state(),
+                'flows': traffic_queue,
+                'merge': merge_buffer.get_state(),
+                'pacer': pacer,
+                'pcap': (sync_file(traffic_writer.writer_handle),
+                         traffic_writer.get_total_pkts(),
+                         traffic_writer.get_timestamp_ns()),
+                'result': sync_file(fd_result) if fd_result else 0,
+                'loop': (current, current_ns, end, total_generated_streams,
+                         total_generated_packets, mix_count, rule_cursor,
+                         next_arrival_ns),
+            }, total_generated_packets)
 
     while traffic_queue and len(traffic_queue) > 0:
-        pkts, current_sec, current_usec = write_packets(
-            traffic_queue, traffic_writer, sconf, fd_result
+        pkts, current_ns = write_packets(
+            traffic_queue, pipeline, sconf, metrics=metrics
         )
         total_generated_packets += pkts
 
         # Track global values
         TOTAL_GENERATED_PACKETS = total_generated_packets
-        FINAL = current_sec
+        FINAL = current_ns // NSEC_PER_SEC
+    pipeline.close()
+    metrics.close()
+    METRICS = None
+    if sconf.getPipeline():
+        print("Pipeline stages:")
+        print(pipeline.report())
+    if merge_buffer.report():
+        print("Merge:", merge_buffer.report())
+    print("Flows:")
+    print(traffic_queue.report())
+    if pacer is not None:
+        print("Rate:")
+        print(pacer.report())
+        total_generated_packets -= pacer.dropped
+        TOTAL_GENERATED_PACKETS = total_generated_packets
+        current_ns = pacer.get_time_ns()
+    traffic_writer.close_save_file()
+    if fd_result is not None:
+        fd_result.close()
+    if checkpointer is not None:
+        checkpointer.remove()
+    return [total_generated_streams, total_generated_packets,
+            current_ns // NSEC_PER_SEC]
+
+
+def build_sharded_pcap(allrules, sconf, background):
+    """
+        Generate traffic with --workers processes.  The rules are
+        already parsed and compiled; each worker is forked with them and
+        generates its share of the streams (or, with -D, the whole
+        duration) with its own random substream into a shard pcap and
+        result file.  The shards are then merged by timestamp into the
+        output pcap and result file (see merge.py) and removed.
+        -C is split between the workers and the -s scans are generated
+        by the first one.  With --shm, the workers write to shared
+        memory rings instead, which are merged as they are written (see
+        generate_shm_shards()).  The workers append their metrics to
+        the same --metricsfile.
+    """
+    global SHARD_JOB
+
+    workers = sconf.getWorkers()
+    if sconf.getTrafficDuration() <= 0:
+        workers = max(min(workers, sconf.getTotalStreams()), 1)
+    shares = shard_shares(sconf, workers)
+    seed = random.getrandbits(64)
+    if sconf.getMetricsFile() is not None:
+        open(sconf.getMetricsFile(), 'w').close()
+    if sconf.getShm():
+        total_pkts, stats = generate_shm_shards(allrules, sconf, background,
+                                                seed, shares)
+        return sum_shard_stats(total_pkts, stats)
+    outputs = [sconf.getOutputFile() + ".shard" + str(i)
+               for i in range(workers)]
+    results = [sconf.getResultFile() + ".shard" + str(i)
+               for i in range(workers)]
+    SHARD_JOB = (allrules, sconf, background, seed, shares, outputs,
+                 results)
+    context = multiprocessing.get_context('fork')
+    with context.Pool(workers) as pool:
+        stats = pool.map(run_shard_job, range(workers))
+    SHARD_JOB = None
+
+    total_pkts = merge_pcaps(outputs, sconf.getOutputFile(), results,
+                             sconf.getResultFile())
+    for shard in outputs + results:
+        os.remove(shard)
+    return sum_shard_stats(total_pkts, stats)
+
+
+def sum_shard_stats(total_pkts, stats):
+    """
+        Adds up the [streams, packets, last second] of the shards.
+    """
+    global TOTAL_GENERATED_STREAMS
+    global TOTAL_GENERATED_PACKETS
+    global FINAL
+
+    total_streams = sum(stat[0] for stat in stats)
+    last_sec = max(stat[2] for stat in stats)
+    TOTAL_GENERATED_STREAMS = total_streams
+    TOTAL_GENERATED_PACKETS = total_pkts
+    FINAL = last_sec
+    return [total_streams, total_pkts, last_sec]
+
+
+def generate_shm_shards(allrules, sconf, background, seed, shares):
+    """
+        The --shm part of build_sharded_pcap(): a worker process is
+        forked for each shard and writes it to a RecordRing, while this
+        process merges the rings into the output pcap and result file.
+        Returns the number of packets and the stats of every shard.
+    """
+    rings = [RecordRing(nanosecond=sconf.getNanosecond()) for _ in shares]
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=run_ring_job, daemon=True,
+                                 args=(allrules, sconf, background, seed,
+                                       index, shares, rings[index]))
+                 for index in range(len(shares))]
+    try:
+        for ring, process in zip(rings, processes):
+            process.start()
+            ring.alive = process.is_alive
+        traffic_writer = make_traffic_writer(sconf, sconf.getOutputFile())
+        with open(sconf.getResultFile(), 'w') as fd_result:
+            total_pkts = merge_rings(rings, traffic_writer, fd_result)
+        traffic_writer.close_save_file()
+        for process in processes:
+            process.join()
+        return total_pkts, [ring.get_stats() for ring in rings]
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for ring in rings:
+            ring.unlink()
+
+
+def run_ring_job(allrules, sconf, background, seed, index, shares, ring):
+    """
+        Worker side of generate_shm_shards(): generates shard index into
+        ring, which stands in for both the pcap and the result file.
+    """
+    ring.set_stats(*generate_shard(allrules, sconf, background, seed, index,
+                                   shares, ring, ring))
+
+
+def run_shard_job(index):
+    """
+        Worker side of build_sharded_pcap(): generates shard index of
+        SHARD_JOB.
+    """
+    allrules, sconf, background, seed, shares, outputs, results = SHARD_JOB
+    return generate_shard(allrules, sconf, background, seed, index, shares,
+                          make_traffic_writer(sconf, outputs[index]),
+                          open(results[index], 'w'))
+
+
+def shard_shares(sconf, count):
+    """
+        Returns the number of streams each of count shards generates,
+        or a list of None (no limit) for duration based generation.
+    """
+    if sconf.getTrafficDuration() > 0:
+        return [None] * count
+    total = sconf.getTotalStreams()
+    return [total // count + (1 if i < total % count else 0)
+            for i in range(count)]
+
+
+def generate_shard(allrules, sconf, background, seed, index, shares,
+                   traffic_writer, fd_result, state=None):
+    """
+        Generates shard index of len(shares) into traffic_writer and
+        fd_result.  Shard index draws from the random substream
+        "seed:index", generates shares[index] streams with its part of
+        -C, and holds the -s scans if it is the first shard.  This is
+        the same for --workers and --shard, so that a shard is the same
+        wherever it is generated.  A shard resumes from state (a
+        checkpoint) if it is given.
+    """
+    random.seed(str(seed) + ":" + str(index))
+    sconf.setConcurrentFlows(
+        max(-(-sconf.getConcurrentFlows() // len(shares)), 1))
+    if sconf.getMaxFlows() > 0:
+        sconf.setMaxFlows(max(-(-sconf.getMaxFlows() // len(shares)), 1))
+    return generate_traffic(allrules, sconf, traffic_writer, fd_result,
+                            background, index == 0, shares[index],
+                            1 / len(shares), state, index)
+
+
+def build_batch_pcap(traffic_writer, sconf):
+    """
+        Generate random traffic with the batch engine (see batch.py).
+        Each batch holds -C streams and is written out as one block.
+        Honors both count (-c) and duration (-D) based generation.
+    """
+    global TOTAL_GENERATED_STREAMS
+    global TOTAL_GENERATED_PACKETS
+    global FINAL
+
+    generator = BatchGenerator(sconf)
+    fd_result = open(sconf.getResultFile(), 'w')
+    total_streams = 0
+    total_pkts = 0
+    last_sec = sconf.getFirstTimestamp()
+    end = sconf.getTrafficDuration() + sconf.getFirstTimestamp()
+    while True:
+        num_streams = generator.batch_size
+        if sconf.getTrafficDuration() > 0:
+            if last_sec >= end:
+                break
+        else:
+            num_streams = min(num_streams,
+                              sconf.getTotalStreams() - total_streams)
+            if num_streams <= 0:
+                break
+        data, pkts, (last_sec, last_usec) = \
+            generator.build_batch(num_streams)
+        traffic_writer.write_records(data, pkts, last_sec, last_usec)
+        fd_result.write(''.join(["Pkt " + str(i) + " : (rule none)\n"
+                                 for i in range(total_pkts + 1,
+                                                total_pkts + pkts + 1)]))
+        total_streams += num_streams
+        total_pkts += pkts
+        TOTAL_GENERATED_STREAMS = total_streams
+        TOTAL_GENERATED_PACKETS = total_pkts
+        FINAL = last_sec
     traffic_writer.close_save_file()
     fd_result.close()
-    return [total_generated_streams, total_generated_packets, current_sec]
+    return [total_streams, total_pkts, last_sec]
 
 
 def build_eval_pcap(rules, traffic_writer, sconf):
@@ -297,15 +745,16 @@ def build_eval_pcap(rules, traffic_writer, sconf):
     mytimer = 0
     while traffic_queue:
         current_stream = traffic_queue.pop(0)
+        # The packets of a rule are one microsecond apart.
+        batch = []
         while current_stream.hasPackets():
             _, _, pkt = current_stream.getNextPacket()
             if pkt:
-                traffic_writer.write_packet(
-                    pkt.get_size(), pkt.get_packet(),
-                    0, mytimer)
+                batch.append((mytimer * NSEC_PER_USEC, pkt.get_packet()))
                 mytimer += 1
-                total_pkts += 1
-                TOTAL_GENERATED_PACKETS = total_pkts
+        traffic_writer.write_packets(batch)
+        total_pkts += len(batch)
+        TOTAL_GENERATED_PACKETS = total_pkts
     traffic_writer.close_save_file()
     return [len(rules), total_pkts, 0]
 
@@ -331,80 +780,92 @@ def printRegEx(rules):
     return [0, 0, 0]
 
 
-def write_packets(queue, traffic_writer, sconf, fd_result):
+def may_open_flow(flow_table, sconf, flow_mode, next_arrival_ns):
     """
-        Packets are written out interleaved (round-robin) from
-        each stream until the batch is complete, or there are no more packets
-        to write.  This helps defeat locality in that packets from a single
-        stream (assuming some streams have more than one packet) will be
-        roughly the length of the queue apart in the traffic stream.
+        Returns True if the next flow can be opened: flow_table is below
+        its --maxflows cap and, for --flows steady, fewer than -C flows
+        are open, or, for --flows poisson, no packet is due before the
+        next flow arrives at next_arrival_ns.
+    """
+    if flow_table.full():
+        return False
+    if flow_mode == 'steady':
+        return flow_table.get_open() < sconf.getConcurrentFlows()
+    if flow_mode == 'poisson':
+        return not flow_table or flow_table.peek_time() >= next_arrival_ns
+    return True
+
+
+def queue_conversation(queue, conversation):
+    """
+        Adds a conversation to the traffic queue under the integer
+        nanosecond time of its next packet.
+    """
+    queue.push(conversation.getNextTime(), conversation)
+
+
+def write_packets(queue, pipeline, sconf, stop=None, metrics=None):
+    """
+        Packets are written out in time order: the earliest conversation
+        is taken from the queue (a FlowTable, see flowtable.py), writes
+        its next packet and goes back under the time of the packet after
+        that (or is closed after its last packet), until stop() returns
+        True or, without stop, until half of the queue (or all of it, if
+        the queue is not full) is done.  Packets
+        from concurrent conversations are thus interleaved.  Packets go
+        through the pipeline (see pipeline.py) and its MergeBuffer (see
+        merge.py), which guarantees that the pcap timestamps never go
+        backwards.
+        The packets and the time spent building them are counted in
+        metrics, if given.
+        Returns the number of packets written and the latest time, in
+        integer nanoseconds, seen in the queue.
     """
     if not queue:
         print("No packets to write")
-        return (0, traffic_writer.get_timestamp())
+        return (0, pipeline.get_last_ns())
     half_threshold = 0
-    last_sec = 0
-    last_usec = 0
+    last_ns = pipeline.get_last_ns()
     if len(queue) >= sconf.getConcurrentFlows():
         half_threshold = int(len(queue) / 2)
+    if stop is None:
+        def stop():
+            return len(queue) <= half_threshold
     num_packets = 0
-    while queue and len(queue) > half_threshold:
-        _, con_list = queue.popitem(index=0)
-        for current_conversation in con_list:
-            if current_conversation.hasPackets():
-                # write that packet
-                pkt = None
-                s, u, pkt = current_conversation.getNextPacket()
-                if s > last_sec:
-                    last_sec = s
-                if u > last_usec:
-                    last_usec = u
-                if pkt is not None:
-                    traffic_writer.write_packet(
-                        pkt.get_size(), pkt.get_packet(), s, u
-                    )
-                    num_packets += 1
-
-                    # print the rule & traffic stream info
-                    result_line = "\n"
-                    pkt_rule = None
-                    pkt_rule_idx = 0
-                    pkt_ts_rule = pkt.get_ts_rule()
-                    if pkt_ts_rule:
-                        pkt_rule = pkt_ts_rule.getRule()
-                        pkt_rule_idx = pkt_ts_rule.getRuleIndex()
-                    if pkt_rule:
-                        result_line = "Pkt " + \
-                            str(traffic_writer.get_total_pkts()) + \
-                            " : rule = " + pkt_rule.getRuleName() + \
-                            ", ts idx = " + str(pkt_rule_idx)
-                        if pkt.get_content_set():
-                            result_line += ", content_set "
-                            result_line += ("(truncated)"
-                                            if pkt.get_content_truncated() else "")
-                            result_line += "\n"
-                    else:
-                        result_line = "Pkt " + str(traffic_writer.get_total_pkts()) + \
-                            " : (rule none)\n"
-                    fd_result.write(result_line)
-
-                else:
-                    print("Packets is none!!! Something is wrong")
-
-        for current_conversation in con_list:
-            if current_conversation.hasPackets():
-                next_sec, next_usec = current_conversation.getNextTimeStamp()
-                if next_sec > last_sec:
-                    last_sec = next_sec
-                if next_usec > last_usec:
-                    last_usec = next_usec
-                timekey = next_sec + (next_usec / 1000000)
-                if timekey in queue:
-                    queue[timekey].append(current_conversation)
-                else:
-                    queue[timekey] = [current_conversation]
-
-    return (num_packets, last_sec, last_usec)
+    payload_time = 0.0
+    while queue and not stop():
+        _, current_conversation = queue.pop()
+        if current_conversation.hasPackets():
+            # write that packet
+            pkt = None
+            begin = time.perf_counter()
+            time_ns, pkt = current_conversation.getNextPacketNs()
+            payload_time += time.perf_counter() - begin
+            if time_ns > last_ns:
+                last_ns = time_ns
+            if pkt is not None:
+                # Serialized (exactly once) and logged by the pipeline.
+                pipeline.put(time_ns, pkt)
+                num_packets += 1
+                if metrics is not None and num_packets % TICK_PACKETS == 0:
+                    metrics.count('packets', TICK_PACKETS)
+                    metrics.add_time('payload', payload_time)
+                    payload_time = 0.0
+                    metrics.tick()
+
+            else:
+                print("Packets is none!!! Something is wrong")
+
+        if current_conversation.hasPackets():
+            last_ns = max(last_ns, current_conversation.getNextTime())
+            queue_conversation(queue, current_conversation)
+        else:
+            queue.close(current_conversation)
+
+    if metrics is not None:
+        metrics.count('packets', num_packets % TICK_PACKETS)
+        metrics.add_time('payload', payload_time)
+    return (num_packets, last_ns)
 
 
 def handlerKeyboardInterupt(signum, frame):
@@ -441,5 +902,14 @@ def handlerKeyboardInterupt(signum, frame):
     sys.exit(0)
 
 
+def handlerMetricsSnapshot(signum, frame):
+    '''
+    On SIGUSR1, the metrics of the running generation are printed (and
+    written to the metrics file) at the next packet.
+    '''
+    if METRICS is not None:
+        METRICS.request_snapshot()
+
+
 if __name__ == "__main__":
     main()
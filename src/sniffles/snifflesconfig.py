@@ -9,9 +9,19 @@ from os.path import join, normcase
 
 from pkg_resources import DistributionNotFound, get_distribution
 
+from sniffles.checkpoint import parse_checkpoint_interval
+from sniffles.flowtable import parse_flow_mode
+from sniffles.merge import MERGE_WINDOW
+from sniffles.metrics import parse_progress_interval
+from sniffles.rate import parse_rate
 from sniffles.rulereader import (OPEN_PORT_CHANCE, SYN_SCAN,
                                  BackgroundTrafficRule)
-from sniffles.ruletrafficgenerator import CONNECTION_SCAN, SUPPORTED_PROTOCOLS
+from sniffles.ruletrafficgenerator import (CONNECTION_SCAN, MAC_IP_MAP_SIZE,
+                                           SUPPORTED_PROTOCOLS)
+from sniffles.scheduler import make_scheduler
+from sniffles.shm_ring import shared_memory
+from sniffles.timing import parse_timing
+from sniffles.traffic_writer import WRITE_BUFFER_SIZE
 
 
 def getVersion():
@@ -42,31 +52,50 @@ class SnifflesConfig:
     """
 
     def __init__(self, cmd=None):
+        self.batch = False
         self.bi = False
         self.background_traffic = 0
         self.background_traffic_rule = None
+        self.checkpoint = None
         self.concurrent_flows = 1000
+        self.flow_mode = 'fill'
         self.config_file = None
         self.mix_mode = False
         self.mix_count = 0
         self.eval = False
         self.full_eval = False
         self.full_match = True
+        self.host_count = 0
+        self.host_skew = 1.0
         self.intensity = 1
         self.proto = 'any'
         self.ipv4_home = None
         self.ipv6_home = None
         self.ipv6_percent = 0
         self.mac_addr_def = None
+        self.mac_map_size = MAC_IP_MAP_SIZE
+        self.max_flows = 0
+        self.metrics_file = None
+        self.nanosecond = False
         self.output_file = "sniffles.pcap"
         self.result_file = "result.txt"
+        self.pcapng = False
         self.pcap_start_sec = int(calendar.timegm(time.gmtime()))
+        self.pcap_start_set = False
+        self.pipeline = False
         self.pkt_length = -1
         self.pkts_per_stream = 1
+        self.progress = 0
         self.rand = False
+        self.rate = None
+        self.resume = False
         self.rule_dir = None
         self.rule_file = None
         self.scan = False
+        self.scheduler = 'heap'
+        self.seed = None
+        self.shard = None
+        self.shm = False
         self.scan_duration = 1
         self.scan_offset = 0
         self.scan_randomize_offset = False
@@ -78,10 +107,15 @@ class SnifflesConfig:
         self.tcp_handshake = False
         self.tcp_teardown = False
         self.latency = 0
+        self.timing = 'exponential'
         self.total_streams = 1
         self.traffic_duration = 0
+        self.vars_file = None
         self.verbosity = False
         self.version = 0
+        self.window = MERGE_WINDOW
+        self.workers = 1
+        self.write_buffer = WRITE_BUFFER_SIZE // (1024 * 1024)
         self.write_reg_ex = False
 
         if cmd:
@@ -89,6 +123,8 @@ class SnifflesConfig:
 
     def __str__(self):
         mystr = "Sniffles Configuration: \n"
+        if self.batch:
+            mystr += "  Random traffic is generated in batches.\n"
         if self.bi:
             mystr += "  Bi-directional content generation is turned on.\n"
         mystr += "  Background Traffic percentage set to: " + \
@@ -126,6 +162,53 @@ class SnifflesConfig:
                      ".\n"
         if self.proto:
             mystr += "  Protocol specified is: " + self.proto + ".\n"
+        if self.vars_file:
+            mystr += "  Using the vars file: " + self.vars_file + ".\n"
+        if self.host_count > 0:
+            mystr += "  Addresses come from a population of " + \
+                     str(self.host_count) + " hosts (skew " + \
+                     str(self.host_skew) + ").\n"
+        if self.mac_map_size > 0:
+            mystr += "  At most " + str(self.mac_map_size) + \
+                     " IP to MAC bindings are kept.\n"
+        if self.nanosecond:
+            mystr += "  Packet timestamps are written in nanoseconds.\n"
+        if self.pcapng:
+            mystr += "  The output is a pcapng file with the rule of each" \
+                     " packet as its comment.\n"
+        if self.write_buffer * 1024 * 1024 != WRITE_BUFFER_SIZE:
+            mystr += "  The pcap is written out in blocks of " + \
+                     str(self.write_buffer) + " MB.\n"
+        if self.pipeline:
+            mystr += "  Packets are serialized and written on separate" \
+                     " threads.\n"
+        if self.workers > 1:
+            mystr += "  Traffic is generated by " + str(self.workers) + \
+                     " worker processes.\n"
+            if self.shm:
+                mystr += "  Workers hand packets to the writer through" \
+                         " shared memory.\n"
+        mystr += "  Conversations are scheduled with a " + self.scheduler + \
+                 " scheduler.\n"
+        if self.rate is not None:
+            mystr += "  Packets are paced to a target rate of " + \
+                     str(parse_rate(self.rate)) + ".\n"
+        if self.seed is not None:
+            mystr += "  The random seed is " + str(self.seed) + ".\n"
+        if self.checkpoint is not None:
+            mystr += "  A checkpoint is saved every " + self.checkpoint + \
+                     (" packets" if self.checkpoint[-1].isdigit() else "") + \
+                     ".\n"
+        if self.resume:
+            mystr += "  Generation resumes from the last checkpoint.\n"
+        if self.progress > 0:
+            mystr += "  Progress is printed every " + str(self.progress) + \
+                     " seconds.\n"
+        if self.metrics_file is not None:
+            mystr += "  Metrics are written to " + self.metrics_file + ".\n"
+        if self.shard is not None:
+            mystr += "  Generating shard " + str(self.shard[0]) + " of " + \
+                     str(self.shard[1]) + ".\n"
         if self.tcp_handshake:
             mystr += "  TCP handshakes will be included in the pcap.\n"
         if self.tcp_teardown:
@@ -171,6 +254,10 @@ class SnifflesConfig:
                      " microsecond delay between each packet.\n"
         else:
             mystr += "  One microsecond delay between packets.\n"
+        mystr += "  Gaps between packets follow the " + self.timing + \
+                 " distribution.\n"
+        mystr += "  Packets are put in time order within a window of " + \
+                 str(self.window) + " packets.\n"
         if self.pkt_length >= 0:
             mystr += "  Data-bearing packets will have " + str(self.pkt_length)
             mystr += " bytes of content.\n"
@@ -180,11 +267,23 @@ class SnifflesConfig:
         if not self.eval and not self.full_eval:
             mystr += "  Will generate at " + str(self.concurrent_flows)
             mystr += " concurrent flows when possible."
+            if self.flow_mode != 'fill':
+                mystr += "\n  Flows are opened in " + self.flow_mode + \
+                         " mode."
+            if self.max_flows > 0:
+                mystr += "\n  At most " + str(self.max_flows) + \
+                         " flows are kept in memory."
         mystr += "\n  Starting timestamp: " + str(self.pcap_start_sec) + \
             " seconds or: " + str(datetime.datetime.fromtimestamp(
                 self.pcap_start_sec)) + "\n"
         return mystr
 
+    def getBatch(self):
+        return self.batch
+
+    def setBatch(self, value):
+        self.batch = value
+
     def getBi(self):
         return self.bi
 
@@ -194,6 +293,18 @@ class SnifflesConfig:
     def getBackgroundTraffic(self):
         return self.background_traffic
 
+    def getCheckpoint(self):
+        return self.checkpoint
+
+    def setCheckpoint(self, value):
+        self.checkpoint = value
+
+    def getResume(self):
+        return self.resume
+
+    def setResume(self, value):
+        self.resume = value
+
     def getConcurrentFlows(self):
         return self.concurrent_flows
 
@@ -224,6 +335,30 @@ class SnifflesConfig:
     def setFullMatch(self, value):
         self.full_match = value
 
+    def getFlowMode(self):
+        return self.flow_mode
+
+    def setFlowMode(self, value):
+        self.flow_mode = value
+
+    def getMaxFlows(self):
+        return self.max_flows
+
+    def setMaxFlows(self, value):
+        self.max_flows = value
+
+    def getHostCount(self):
+        return self.host_count
+
+    def setHostCount(self, value):
+        self.host_count = value
+
+    def getHostSkew(self):
+        return self.host_skew
+
+    def setHostSkew(self, value):
+        self.host_skew = value
+
     def getIntensity(self):
         return self.intensity
 
@@ -254,6 +389,24 @@ class SnifflesConfig:
     def setMacAddrDef(self, value):
         self.mac_addr_def = value
 
+    def getMacMapSize(self):
+        return self.mac_map_size
+
+    def setMacMapSize(self, value):
+        self.mac_map_size = value
+
+    def getPcapng(self):
+        return self.pcapng
+
+    def setPcapng(self, value):
+        self.pcapng = value
+
+    def getNanosecond(self):
+        return self.nanosecond
+
+    def setNanosecond(self, value):
+        self.nanosecond = value
+
     def getOutputFile(self):
         return self.output_file
 
@@ -263,6 +416,30 @@ class SnifflesConfig:
     def setOutputFile(self, value):
         self.output_file = value
 
+    def getMetricsFile(self):
+        return self.metrics_file
+
+    def setMetricsFile(self, value):
+        self.metrics_file = value
+
+    def getProgress(self):
+        return self.progress
+
+    def setProgress(self, value):
+        self.progress = value
+
+    def getRate(self):
+        return self.rate
+
+    def setRate(self, value):
+        self.rate = value
+
+    def getPipeline(self):
+        return self.pipeline
+
+    def setPipeline(self, value):
+        self.pipeline = value
+
     def getPktLength(self):
         return self.pkt_length
 
@@ -278,6 +455,9 @@ class SnifflesConfig:
     def getProto(self):
         return self.proto
 
+    def setProto(self, value):
+        self.proto = value
+
     def getMixMode(self):
         return self.mix_mode
 
@@ -338,6 +518,30 @@ class SnifflesConfig:
     def setScanType(self, value):
         self.scan_type = value
 
+    def getSeed(self):
+        return self.seed
+
+    def setSeed(self, value):
+        self.seed = value
+
+    def getShard(self):
+        return self.shard
+
+    def setShard(self, value):
+        self.shard = value
+
+    def getShm(self):
+        return self.shm
+
+    def setShm(self, value):
+        self.shm = value
+
+    def getScheduler(self):
+        return self.scheduler
+
+    def setScheduler(self, value):
+        self.scheduler = value
+
     def getScanReplyChance(self):
         return self.scan_reply_chance
 
@@ -374,6 +578,12 @@ class SnifflesConfig:
     def setLatency(self, value):
         self.latency = value
 
+    def getTiming(self):
+        return self.timing
+
+    def setTiming(self, value):
+        self.timing = value
+
     def getTotalStreams(self):
         return self.total_streams
 
@@ -386,12 +596,36 @@ class SnifflesConfig:
     def setTrafficDuration(self, value):
         self.traffic_duration = value
 
+    def getVarsFile(self):
+        return self.vars_file
+
+    def setVarsFile(self, value):
+        self.vars_file = value
+
     def getVerbosity(self):
         return self.verbosity
 
     def setVerbosity(self, value):
         self.verbosity = value
 
+    def getWindow(self):
+        return self.window
+
+    def setWindow(self, value):
+        self.window = value
+
+    def getWorkers(self):
+        return self.workers
+
+    def setWorkers(self, value):
+        self.workers = value
+
+    def getWriteBuffer(self):
+        return self.write_buffer
+
+    def setWriteBuffer(self, value):
+        self.write_buffer = value
+
     def getWriteRegEx(self):
         return self.write_reg_ex
 
@@ -410,7 +644,12 @@ class SnifflesConfig:
         """
         cmd_options = "abB:c:C:d:D:eEf:F:g:h:H:i:I:l:L:" + \
                       "mM:o:O:p:P:q:rRs:S:tTvwW:x:Z:?"
-        long_options = ["resultfile="]
+        long_options = ["batch", "checkpoint=", "flows=", "hosts=", "macmap=",
+                        "maxflows=", "metricsfile=", "nanosecond", "pcapng",
+                        "pipeline", "progress=", "rate=", "resultfile=",
+                        "resume", "scheduler=", "seed=", "shard=", "shm",
+                        "timing=", "vars=", "window=", "workers=",
+                        "writebuffer=", "zipf="]
         try:
             options, _args = getopt.getopt(cmd, cmd_options, long_options)
         except getopt.GetoptError as err:
@@ -418,6 +657,33 @@ class SnifflesConfig:
             self.usage()
         for opt, arg in options:
             self.parse_opt_arg(opt, arg)
+        self.check_options()
+
+    def check_options(self):
+        """
+            Reject combinations of options that cannot work together.
+            Called once every option (including those of a config
+            file) has been read.
+        """
+        if self.shard is not None and \
+                (self.seed is None or not self.pcap_start_set):
+            print("--shard needs --seed and -g, the same on every shard.")
+            self.usage()
+        if self.shard is not None and self.workers > 1:
+            print("--shard and --workers cannot be used together.")
+            self.usage()
+        if (self.checkpoint is not None or self.resume) and \
+                self.workers > 1:
+            print("Checkpoints are not available with --workers (use "
+                  "--shard).")
+            self.usage()
+        if self.shm and shared_memory is None:
+            print("--shm needs Python 3.8 or later "
+                  "(multiprocessing.shared_memory).")
+            self.usage()
+        if self.pcapng and (self.workers > 1 or self.shard is not None):
+            print("--pcapng cannot be used with --workers or --shard.")
+            self.usage()
 
     def parse_config_file(self, cfg_file):
         """
@@ -535,6 +801,7 @@ class SnifflesConfig:
         elif opt == "-g":
             if self.pcap_start_sec > 0:
                 self.pcap_start_sec = int(arg)
+                self.pcap_start_set = True
 
         # Set home address ranges.
         elif opt == "-h":
@@ -580,10 +847,115 @@ class SnifflesConfig:
         elif opt == "-o":
             self.output_file = arg
 
+        # Generate random traffic with the NumPy batch engine.
+        elif opt == "--batch":
+            self.batch = True
+
+        # Save the generator state every so many packets (or seconds).
+        elif opt == "--checkpoint":
+            try:
+                parse_checkpoint_interval(arg)
+            except ValueError as err:
+                print("Bad checkpoint interval: ", err)
+                self.usage()
+            self.checkpoint = arg.strip().lower()
+
+        # How flows are opened: fill, steady or poisson:rate.
+        elif opt == "--flows":
+            try:
+                parse_flow_mode(arg)
+            except ValueError as err:
+                print("Bad flow mode: ", err)
+                self.usage()
+            self.flow_mode = arg.strip().lower()
+
+        # Size of the host population.  Unconstrained addresses are
+        # picked from this many hosts rather than generated fresh.
+        elif opt == "--hosts":
+            self.host_count = int(arg)
+
+        # Maximum number of IP to MAC bindings kept.  Bindings are
+        # dropped least recently used first.  0 keeps every binding.
+        elif opt == "--macmap":
+            self.mac_map_size = int(arg)
+
+        # Hard cap on the flows kept in memory.  0 sets no cap.
+        elif opt == "--maxflows":
+            self.max_flows = int(arg)
+            if self.max_flows < 0:
+                print("The flow cap cannot be negative.")
+                self.usage()
+
+        # Write snapshots of the run metrics as JSON lines.
+        elif opt == "--metricsfile":
+            self.metrics_file = arg
+
+        # Write a nanosecond resolution pcap.
+        elif opt == "--nanosecond":
+            self.nanosecond = True
+
+        # Write a pcapng file with the rule of each packet as its
+        # comment instead of a result file.
+        elif opt == "--pcapng":
+            self.pcapng = True
+
+        # Serialize and write packets on their own threads.
+        elif opt == "--pipeline":
+            self.pipeline = True
+
+        # Print a progress line every so many seconds.
+        elif opt == "--progress":
+            try:
+                self.progress = parse_progress_interval(arg)
+            except ValueError as err:
+                print("Bad progress interval: ", err)
+                self.usage()
+
+        # Target packet or bit rate of the capture.
+        elif opt == "--rate":
+            try:
+                parse_rate(arg)
+            except (ValueError, OSError) as err:
+                print("Bad rate: ", err)
+                self.usage()
+            self.rate = arg
+
         # Set result file name, default is result.txt
         elif opt == "--resultfile":
             self.result_file = arg
 
+        # Carry on from the checkpoint of an interrupted run.
+        elif opt == "--resume":
+            self.resume = True
+
+        # Data structure ordering the conversations by time.
+        elif opt == "--scheduler":
+            try:
+                make_scheduler(arg)
+            except ValueError as err:
+                print("Bad scheduler: ", err)
+                self.usage()
+            self.scheduler = arg.strip().lower()
+
+        # Seed of the random number generator, for repeatable runs.
+        elif opt == "--seed":
+            self.seed = int(arg)
+
+        # Generate only shard i of N (written i/N, counting from 0).
+        elif opt == "--shard":
+            try:
+                index, count = [int(part) for part in arg.split('/')]
+            except ValueError:
+                index, count = -1, 0
+            if index < 0 or index >= count:
+                print("The shard must be given as i/N with 0 <= i < N.")
+                self.usage()
+            self.shard = (index, count)
+
+        # Workers hand their packets to the writer in shared memory.
+        elif opt == "--shm":
+            self.shm = True
+
         # For scan attacks.  The offset designates the offset from
         # the beginning of the traffic generation to when the
         # scan attack will start.  If used with Random, this becomes
@@ -638,6 +1010,49 @@ class SnifflesConfig:
         elif opt == "-T":
             self.tcp_teardown = True
 
+        # Distribution of the gaps between the packets of a stream.
+        elif opt == "--timing":
+            try:
+                parse_timing(arg)
+            except (OSError, ValueError) as err:
+                print("Bad timing distribution: ", err)
+                self.usage()
+            self.timing = arg
+
+        # Snort style vars file defining $NAME values (portvar/ipvar)
+        # used in rule headers.
+        elif opt == "--vars":
+            self.vars_file = arg
+
+        # Number of packets held back to put the pcap in time order.
+        elif opt == "--window":
+            self.window = int(arg)
+            if self.window < 0:
+                print("The merge window cannot be negative.")
+                self.usage()
+
+        # Number of processes generating traffic.
+        elif opt == "--workers":
+            self.workers = int(arg)
+            if self.workers < 1:
+                print("At least one worker is needed.")
+                self.usage()
+
+        # Size of the pcap write buffer, in MB.
+        elif opt == "--writebuffer":
+            self.write_buffer = int(arg)
+            if self.write_buffer < 1:
+                print("The write buffer must be at least 1 MB.")
+                self.usage()
+
+        # Popularity skew of the host population (Zipf exponent).
+        # 0 picks hosts uniformly.
+        elif opt == "--zipf":
+            self.host_skew = float(arg)
+            if self.host_skew < 0:
+                print("The host popularity skew cannot be negative.")
+                self.usage()
+
         # Will print out the rules read, and used in the traffic.
         elif opt == "-v":
             self.verbosity = True
@@ -823,10 +1238,91 @@ class SnifflesConfig:
         print("-Z Reply Chance: chance that a scan will have a reply.")
         print("   In other words, chance the target port is open")
         print("   (default 20%).")
+        print("--batch: Generate random traffic in batches of -C streams")
+        print("   with NumPy (much faster).  Only for random traffic without")
+        print("   rules, scans, background traffic, IPv6, -M, --hosts or -b.")
+        print("   Otherwise the standard generator is used.")
+        print("--checkpoint interval: Save the state of the run every")
+        print("   interval packets (or interval seconds, if it ends in s)")
+        print("   to <output>.ckpt, so that it can be resumed.")
+        print("--flows mode: How flows are opened: fill (default; open")
+        print("   -C flows, then send until half are done), steady (keep")
+        print("   exactly -C flows open) or poisson:rate (rate new flows")
+        print("   per second).  Concurrency is reported at the end.")
+        print("--hosts count: Use a fixed population of count hosts for")
+        print("   all addresses not fixed by a rule.  Half are home hosts")
+        print("   (using -h/-H) and half external.  Each host keeps one MAC")
+        print("   (using -M).  By default every stream gets new addresses.")
+        print("--macmap size: Maximum number of IP to MAC address bindings")
+        print("   remembered (default " + str(MAC_IP_MAP_SIZE) + ").  The")
+        print("   least recently used binding is dropped when full; open")
+        print("   streams keep their MAC addresses.  0 keeps every binding.")
+        print("--maxflows count: Never keep more than count flows in")
+        print("   memory; new flows wait for open ones to end.  0 (the")
+        print("   default) sets no cap.")
+        print("--metricsfile file: Write a JSON line of run metrics")
+        print("   (packets, bytes, flows, rates, stage times, NFA cache,")
+        print("   ETA) to file every second (or every --progress seconds)")
+        print("   and at the end.  SIGUSR1 prints one on stderr at any time.")
+        print("--nanosecond: Write packet timestamps with nanosecond")
+        print("   resolution (nanosecond pcap magic).  Microseconds by")
+        print("   default.")
+        print("--pcapng: Write a pcapng file (nanosecond timestamps)")
+        print("   where each packet carries the rule it was built from as")
+        print("   a comment, instead of writing a result file.  Not with")
+        print("   --workers, --shard or --batch.")
+        print("--pipeline: Serialize and write the packets on separate")
+        print("   threads, fed through bounded queues, and print how long")
+        print("   each stage was busy or blocked.")
+        print("--progress seconds: Print a progress line (packets, pps,")
+        print("   MB/s and, for -c or -D, the ETA) on stderr every seconds")
+        print("   seconds.")
+        print("--rate rate: Pace the packets to a target rate, either")
+        print("   constant (e.g. 500pps, 20kpps, 100Mbps, 2Gbps) or")
+        print("   profile:file, a file of 'offset rate' lines giving the")
+        print("   rate from offset seconds on.  The achieved rate is")
+        print("   reported for every second.  With -D, the capture stops")
+        print("   at the end of the duration.")
         print("--resultfile result file: designate the name of the result file.")
         print("   it conatains information about how packets are created")
         print("   for example which rules are used for which packets.")
         print("   by default, the file is named: result.txt.")
+        print("--resume: Carry on an interrupted run from its last")
+        print("   checkpoint, appending to its pcap and result file.  Use")
+        print("   the same options as the interrupted run.")
+        print("--scheduler name: How conversations are ordered by time:")
+        print("   heap (default), wheel (hierarchical timing wheel) or")
+        print("   sorteddict (the old SortedDict of lists).")
+        print("--seed seed: Seed the random number generator (an integer)")
+        print("   so that runs can be repeated.")
+        print("--shard i/N: Generate only shard i (0 to N-1) of the")
+        print("   traffic, as worker i of --workers N would.  Needs --seed")
+        print("   and -g, which must be the same on every shard, as must")
+        print("   the other options.  Combine the shards with")
+        print("   sniffles-merge.")
+        print("--shm: With --workers, pass the packets from the workers")
+        print("   to the writer through shared memory ring buffers")
+        print("   instead of shard files (Python 3.8 or later).")
+        print("--timing dist: Distribution of the gaps between the packets")
+        print("   of a stream: exponential (default), constant,")
+        print("   lognormal[:sigma] or empirical:file (a file of gaps in")
+        print("   microseconds, one per line).  The mean is the stream")
+        print("   latency (see -L), except for empirical.")
+        print("--vars vars file: Snort style file of portvar and ipvar")
+        print("   lines (e.g. 'portvar HTTP_PORTS [80,8080]') giving the")
+        print("   values used for $NAME variables in rule headers.")
+        print("--window count: Hold back up to count packets to write the")
+        print("   pcap in time order (default " + str(MERGE_WINDOW) + ").")
+        print("   Packets later than that are moved forward in time.")
+        print("--workers count: Generate with count processes, each")
+        print("   writing a share of the streams (or, with -D, the whole")
+        print("   duration) to a shard that is merged by time at the end.")
+        print("--writebuffer MB: Buffer MB megabytes of pcap records and")
+        print("   write them out in one piece (default " +
+              str(WRITE_BUFFER_SIZE // (1024 * 1024)) + ").")
+        print("--zipf skew: Popularity skew for --hosts.  The k-th host is")
+        print("   picked with weight 1/k^skew.  0 picks hosts uniformly.")
+        print("   The default is 1.0.")
         print("")
         print("Please see README for examples and further details.")
 
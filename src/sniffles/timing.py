@@ -0,0 +1,164 @@
+"""
+    Inter-packet timing for traffic streams.
+
+    A timing distribution draws the gaps, in microseconds, between the
+    consecutive packets of a stream.  Gaps are always at least one
+    microsecond.  Streams draw the gaps of all of their remaining packets
+    in one call to sample(), so a stream's timeline is known before its
+    packets are built.  With NumPy installed, large draws are vectorized;
+    the generator is seeded from the random module so runs stay
+    reproducible under random.seed().
+
+    Distributions are selected with a spec string of the form
+    name[:param] (see parse_timing()):
+
+      exponential         Exponential gaps with the stream latency as the
+                          mean (the default).
+      constant            Every gap is the stream latency.
+      lognormal[:sigma]   Log-normal gaps with the stream latency as the
+                          mean and the given shape (default 1.0).
+      empirical:file      Gaps picked uniformly from the values (one per
+                          line, in microseconds) in file.  The stream
+                          latency is ignored.
+"""
+import math
+import random
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Below this many gaps, drawing with the random module is faster than
+# setting up a NumPy generator.
+NUMPY_MIN_SAMPLES = 64
+
+
+def numpy_rng(count):
+    """
+        Returns a NumPy generator seeded from the random module if NumPy
+        is available and count is large enough to be worth it, or None.
+    """
+    if np is None or count < NUMPY_MIN_SAMPLES:
+        return None
+    return np.random.default_rng(random.getrandbits(64))
+
+
+class TimingDistribution:
+    """
+        Base class for timing distributions.  Should not be
+        instantiated.  Subclasses set name and implement sample(mean,
+        count), which returns a list of count integer gaps (in
+        microseconds, at least 1) for a stream whose average latency is
+        mean.
+    """
+
+    name = None
+
+    def __init__(self, param=None):
+        self.param = param
+
+    def __str__(self):
+        if self.param is None:
+            return self.name
+        return self.name + ":" + str(self.param)
+
+    def sample(self, mean=1, count=1):
+        return None
+
+
+class ExponentialTiming(TimingDistribution):
+
+    name = 'exponential'
+
+    def sample(self, mean=1, count=1):
+        mean = max(mean, 1)
+        rng = numpy_rng(count)
+        if rng is not None:
+            gaps = np.rint(rng.exponential(mean, count)).astype(np.int64)
+            return (gaps + 1).tolist()
+        lambd = 1 / mean
+        return [int(round(random.expovariate(lambd))) + 1
+                for _ in range(count)]
+
+
+class ConstantTiming(TimingDistribution):
+
+    name = 'constant'
+
+    def sample(self, mean=1, count=1):
+        return [max(int(mean), 1)] * count
+
+
+class LognormalTiming(TimingDistribution):
+
+    name = 'lognormal'
+
+    def __init__(self, param=None):
+        if param is None:
+            param = 1.0
+        param = float(param)
+        if param <= 0:
+            raise ValueError("The lognormal shape must be positive.")
+        super().__init__(param)
+
+    def sample(self, mean=1, count=1):
+        # Choose mu so that the mean of the distribution is mean.
+        sigma = self.param
+        mu = math.log(max(mean, 1)) - sigma * sigma / 2
+        rng = numpy_rng(count)
+        if rng is not None:
+            gaps = np.rint(rng.lognormal(mu, sigma, count)).astype(np.int64)
+            return np.maximum(gaps, 1).tolist()
+        return [max(int(round(random.lognormvariate(mu, sigma))), 1)
+                for _ in range(count)]
+
+
+class EmpiricalTiming(TimingDistribution):
+
+    name = 'empirical'
+
+    def __init__(self, param=None):
+        if not param:
+            raise ValueError("The empirical timing needs a file of gaps.")
+        super().__init__(param)
+        self.gaps = []
+        with open(param) as gap_file:
+            for line in gap_file:
+                line = line.strip()
+                if not line or line[0] == '#':
+                    continue
+                self.gaps.append(max(int(float(line)), 1))
+        if not self.gaps:
+            raise ValueError("No gaps found in " + param + ".")
+
+    def sample(self, mean=1, count=1):
+        rng = numpy_rng(count)
+        if rng is not None:
+            return rng.choice(self.gaps, count).tolist()
+        return [random.choice(self.gaps) for _ in range(count)]
+
+
+TIMING_DISTRIBUTIONS = {
+    'exponential': ExponentialTiming,
+    'constant': ConstantTiming,
+    'lognormal': LognormalTiming,
+    'empirical': EmpiricalTiming,
+}
+
+
+def parse_timing(spec=None):
+    """
+        Builds the timing distribution for a spec of the form
+        name[:param].  Raises ValueError for an unknown name or a bad
+        parameter.
+    """
+    if not spec:
+        return ExponentialTiming()
+    name, _, param = spec.partition(':')
+    name = name.strip().lower()
+    if name not in TIMING_DISTRIBUTIONS:
+        raise ValueError("Unknown timing distribution: " + name)
+    if not param:
+        param = None
+    return TIMING_DISTRIBUTIONS[name](param)
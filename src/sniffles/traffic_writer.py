@@ -1,5 +1,26 @@
+import atexit
 import struct
 import sys
+import time
+import weakref
+
+NSEC_PER_SEC = 1000000000
+NSEC_PER_USEC = 1000
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+# The pcap file header and record header, little-endian.
+FILE_HEADER = struct.Struct('<IHHIIII')
+RECORD_HEADER = struct.Struct('<IIII')
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+# Writers with a save file open, flushed at exit (after Ctrl-C, for
+# instance).
+OPEN_WRITERS = weakref.WeakSet()
+
+
+@atexit.register
+def flush_open_writers():
+    for writer in list(OPEN_WRITERS):
+        writer.flush()
 
 
 class TrafficWriter:
@@ -28,12 +49,43 @@ class TrafficWriter:
             open_save_file():  allows you to open a save file outside of
             the constructor.  That way you can build the object then
             set_file_name(name) and then open_save_file().
+
+            write_packet_ns(length, pkt, time_ns): same as write_packet()
+            with the timestamp in integer nanoseconds.
+
+            write_packets(batch): write a batch of (time_ns, pkt) pairs.
+
+            resume_save_file(offset, total_pkts, time_ns): reopen an
+            existing save file to append to it, after cutting it back
+            to offset bytes (where total_pkts packets were written and
+            the time was time_ns).
+
+            flush(): write the buffered records out to the save file.
+
+        The writer keeps its current time in integer nanoseconds.  With
+        nanosecond=True the file uses the nanosecond pcap magic and the
+        records carry nanoseconds; otherwise they carry microseconds and
+        the time is truncated to the microsecond.
+
+        Records are packed into a preallocated buffer of buffer_size
+        bytes, which is written out in one piece when it is full, on
+        flush() and when the file is closed.  get_write_stats() gives
+        the bytes written out, the number of writes and their time.
     """
     writer_handle = None
-    current_time_sec = 0
-    current_time_usec = 0
+    current_time_ns = 0
 
-    def __init__(self, save_file=None, start_ts=0):
+    def __init__(self, save_file=None, start_ts=0, nanosecond=False,
+                 buffer_size=WRITE_BUFFER_SIZE):
+        self.nanosecond = nanosecond
+        self.buffer = bytearray(max(buffer_size, FILE_HEADER.size))
+        # Records are copied in through a view, much faster than slice
+        # assignment to the bytearray.
+        self.view = memoryview(self.buffer)
+        self.used = 0
+        self.bytes_written = 0
+        self.flushes = 0
+        self.flush_time = 0.0
         if save_file:
             self.save_file = save_file
             self.open_save_file()
@@ -42,17 +94,39 @@ class TrafficWriter:
 
     def close_save_file(self):
         if self.writer_handle:
+            self.flush()
             self.writer_handle.close()
+            OPEN_WRITERS.discard(self)
+
+    def flush(self):
+        if self.used and self.writer_handle and \
+                not self.writer_handle.closed:
+            self.write_out(self.view[:self.used])
+            self.used = 0
+
+    def write_out(self, data):
+        begin = time.perf_counter()
+        self.writer_handle.write(data)
+        self.writer_handle.flush()
+        self.flush_time += time.perf_counter() - begin
+        self.flushes += 1
+        self.bytes_written += len(data)
+
+    def get_write_stats(self):
+        return self.bytes_written, self.flushes, self.flush_time
 
     def increment_timestamp(self, secs=0, msecs=0):
-        self.current_time_sec += secs
-        self.current_time_usec += msecs
-        if self.current_time_usec > 1000000:
-            self.current_time_sec += 1
-            self.current_time_usec -= 1000000
+        self.current_time_ns += secs * NSEC_PER_SEC + msecs * NSEC_PER_USEC
 
     def get_timestamp(self):
-        return (self.current_time_sec + (self.current_time_usec / 1000000))
+        return self.current_time_ns / NSEC_PER_SEC
+
+    def get_timestamp_ns(self):
+        return self.current_time_ns
+
+    # The current time as (seconds, microseconds).
+    def get_sec_usec(self):
+        return divmod(self.current_time_ns // NSEC_PER_USEC, 1000000)
 
     def get_total_pkts(self):
         return self.total_pkts
@@ -64,10 +138,25 @@ class TrafficWriter:
             except:
                 print("Could not open save file for writing: ", self.save_file)
                 sys.exit(1)
+            self.used = 0
+            OPEN_WRITERS.add(self)
             self.write_pcap_file_header()
         else:
             print("No name for the pcap save file.")
 
+    def resume_save_file(self, offset=0, total_pkts=0, time_ns=0):
+        try:
+            self.writer_handle = open(self.save_file, 'r+b')
+        except OSError:
+            print("Could not open save file for appending: ", self.save_file)
+            sys.exit(1)
+        self.writer_handle.truncate(offset)
+        self.writer_handle.seek(offset)
+        self.used = 0
+        OPEN_WRITERS.add(self)
+        self.total_pkts = total_pkts
+        self.current_time_ns = time_ns
+
     def set_file_name(self, save_file=None):
         if save_file:
             self.save_file = save_file
@@ -75,41 +164,241 @@ class TrafficWriter:
             print("Did not set a name for the save file.")
 
     def set_timestamp(self, secs=0, usecs=0):
-        self.current_time_sec = secs
-        self.current_time_usec = usecs
-        while self.current_time_usec >= 1000000:
-            self.current_time_sec += 1
-            self.current_time_usec -= 1000000
+        self.current_time_ns = secs * NSEC_PER_SEC + usecs * NSEC_PER_USEC
 
     def write_packet(self, len=0, pkt=None, secs=-1, usecs=-1):
-        if pkt and self.writer_handle:
-            if secs < 0:
-                secs = self.current_time_sec
-            if usecs < 0:
-                usecs = self.current_time_usec
+        cur_sec, cur_usec = self.get_sec_usec()
+        if secs < 0:
+            secs = cur_sec
+        if usecs < 0:
+            usecs = cur_usec
+        if secs != cur_sec or usecs != cur_usec:
             self.set_timestamp(secs, usecs)
-            pcap_hdr = struct.pack("IIII", self.current_time_sec,
-                                   self.current_time_usec, len, len)
-            self.writer_handle.write(pcap_hdr)
-            self.writer_handle.write(pkt)
-            self.total_pkts += 1
-        else:
-            print("No packet to write!")
-        return self.current_time_sec, self.current_time_usec
+        self.write_packet_ns(len, pkt)
+        return self.get_sec_usec()
+
+    def write_packet_ns(self, len=0, pkt=None, time_ns=-1):
+        if not pkt:
+            return self.current_time_ns
+        if not self.writer_handle:
+            print("No save file to write packets to!")
+            return self.current_time_ns
+        if time_ns >= 0:
+            self.current_time_ns = time_ns
+        secs, frac = divmod(self.current_time_ns, NSEC_PER_SEC)
+        if not self.nanosecond:
+            frac //= NSEC_PER_USEC
+        used = self.used
+        end = used + RECORD_HEADER.size + len
+        if end > self.buffer_size():
+            self.flush()
+            used = 0
+            end = RECORD_HEADER.size + len
+            if end > self.buffer_size():
+                self.write_out(RECORD_HEADER.pack(secs, frac, len, len) +
+                               pkt)
+                self.total_pkts += 1
+                return self.current_time_ns
+        RECORD_HEADER.pack_into(self.view, used, secs, frac, len, len)
+        self.view[used + RECORD_HEADER.size:end] = pkt
+        self.used = end
+        self.total_pkts += 1
+        return self.current_time_ns
+
+    def buffer_size(self):
+        return self.view.nbytes
+
+    def write_packets(self, batch=()):
+        """
+            Write a batch of (time_ns, pkt) pairs, in time order.  Empty
+            packets are skipped.  Returns the writer's current time,
+            that of the last packet written.
+        """
+        if not self.writer_handle:
+            print("No save file to write packets to!")
+            return self.current_time_ns
+        view = self.view
+        capacity = view.nbytes
+        used = self.used
+        pack_into = RECORD_HEADER.pack_into
+        header_size = RECORD_HEADER.size
+        usec = not self.nanosecond
+        count = 0
+        last_ns = self.current_time_ns
+        for time_ns, pkt in batch:
+            if not pkt:
+                continue
+            length = len(pkt)
+            secs, frac = divmod(time_ns, NSEC_PER_SEC)
+            if usec:
+                frac //= NSEC_PER_USEC
+            count += 1
+            last_ns = time_ns
+            end = used + header_size + length
+            if end > capacity:
+                self.used = used
+                self.flush()
+                used = 0
+                end = header_size + length
+                if end > capacity:
+                    self.write_out(RECORD_HEADER.pack(secs, frac, length,
+                                                      length) + pkt)
+                    continue
+            pack_into(view, used, secs, frac, length, length)
+            view[used + header_size:end] = pkt
+            used = end
+        self.used = used
+        self.total_pkts += count
+        self.current_time_ns = last_ns
+        return last_ns
+
+    def write_records(self, data=None, count=0, secs=-1, usecs=-1):
+        """
+            Write a block of count packets that are already framed as
+            pcap records (record header followed by the packet).  The
+            timestamp of the last record should be provided so that
+            the writer's current timestamp stays up to date.  An empty
+            block is skipped.
+        """
+        if not data:
+            return self.get_sec_usec()
+        if not self.writer_handle:
+            print("No save file to write packets to!")
+            return self.get_sec_usec()
+        self.write_bytes(data)
+        self.total_pkts += count
+        if secs >= 0:
+            self.set_timestamp(secs, max(usecs, 0))
+        return self.get_sec_usec()
+
+    def write_bytes(self, data):
+        size = len(data)
+        if self.used + size > self.buffer_size():
+            self.flush()
+            if size > self.buffer_size():
+                self.write_out(data)
+                return
+        self.view[self.used:self.used + size] = data
+        self.used += size
 
     def write_pcap_file_header(self):
         if not self.writer_handle:
             return
 
-        magic_number = 0xa1b2c3d4
+        magic_number = PCAP_MAGIC_NSEC if self.nanosecond else PCAP_MAGIC
         version_major = 2
         version_minor = 4
         thiszone = 0
         sigfigs = 0
         snaplen = 0xffff
         network = 1
-        global_header = struct.pack('IHHIIII', magic_number,
-                                    version_major, version_minor,
-                                    thiszone, sigfigs, snaplen,
-                                    network)
-        self.writer_handle.write(global_header)
+        global_header = FILE_HEADER.pack(magic_number,
+                                         version_major, version_minor,
+                                         thiszone, sigfigs, snaplen,
+                                         network)
+        self.write_bytes(global_header)
+
+
+# pcapng block types and option codes.
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_IDB = 0x00000001
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+PCAPNG_OPT_END = 0
+PCAPNG_OPT_COMMENT = 1
+PCAPNG_SHB_USERAPPL = 4
+PCAPNG_IF_TSRESOL = 9
+LINKTYPE_ETHERNET = 1
+# Block type, total length, interface, timestamp (high and low 32
+# bits), captured and original length.
+EPB_HEADER = struct.Struct('<IIIIIII')
+BLOCK_LENGTH = struct.Struct('<I')
+OPTION_HEADER = struct.Struct('<HH')
+
+
+def pcapng_option(code, value):
+    """
+        Returns a pcapng option, padded to 32 bits.
+    """
+    return OPTION_HEADER.pack(code, len(value)) + value + \
+        bytes(-len(value) % 4)
+
+
+def pcapng_block(block_type, body):
+    """
+        Returns a pcapng block of block_type holding body (padded to
+        32 bits by the caller).
+    """
+    total = 12 + len(body)
+    return struct.pack('<II', block_type, total) + body + \
+        BLOCK_LENGTH.pack(total)
+
+
+class PcapngWriter(TrafficWriter):
+    """
+        A TrafficWriter for pcapng files: one section with one Ethernet
+        interface with nanosecond timestamps, and an Enhanced Packet
+        Block per packet.  The packets can carry a comment (see
+        write_packet_ns()), which is how the rule a packet was built
+        from is recorded in the file itself rather than in a result
+        file.  The records go through the same buffer as the pcap ones.
+        nanosecond is ignored: timestamps are always in nanoseconds.
+
+          write_packet_ns(length, pkt, time_ns, comment): write a
+          packet with an optional comment.
+    """
+
+    def __init__(self, save_file=None, start_ts=0, nanosecond=True,
+                 buffer_size=WRITE_BUFFER_SIZE):
+        super().__init__(save_file, start_ts, True, buffer_size)
+
+    def write_packet_ns(self, len=0, pkt=None, time_ns=-1, comment=None):
+        if time_ns < 0:
+            time_ns = self.current_time_ns
+        return self.write_packets(((time_ns, pkt, comment),))
+
+    def write_packets(self, batch=()):
+        """
+            Write a batch of (time_ns, pkt) pairs, or (time_ns, pkt,
+            comment) triples, in time order.  Empty packets are skipped.
+        """
+        if not self.writer_handle:
+            print("No save file to write packets to!")
+            return self.current_time_ns
+        last_ns = self.current_time_ns
+        for entry in batch:
+            time_ns, pkt = entry[0], entry[1]
+            if not pkt:
+                continue
+            length = len(pkt)
+            options = b''
+            if len(entry) > 2 and entry[2]:
+                options = pcapng_option(
+                    PCAPNG_OPT_COMMENT,
+                    entry[2].encode('utf-8', 'replace')) + \
+                    OPTION_HEADER.pack(PCAPNG_OPT_END, 0)
+            padding = -length % 4
+            total = EPB_HEADER.size + length + padding + len(options) + \
+                BLOCK_LENGTH.size
+            self.write_bytes(EPB_HEADER.pack(PCAPNG_EPB, total, 0,
+                                             time_ns >> 32,
+                                             time_ns & 0xffffffff,
+                                             length, length) +
+                             pkt + bytes(padding) + options +
+                             BLOCK_LENGTH.pack(total))
+            self.total_pkts += 1
+            last_ns = time_ns
+        self.current_time_ns = last_ns
+        return last_ns
+
+    def write_pcap_file_header(self):
+        if not self.writer_handle:
+            return
+        section = struct.pack('<IHHq', PCAPNG_BYTE_ORDER_MAGIC, 1, 0, -1) + \
+            pcapng_option(PCAPNG_SHB_USERAPPL, b'Sniffles') + \
+            OPTION_HEADER.pack(PCAPNG_OPT_END, 0)
+        interface = struct.pack('<HHI', LINKTYPE_ETHERNET, 0, 0) + \
+            pcapng_option(PCAPNG_IF_TSRESOL, bytes([9])) + \
+            OPTION_HEADER.pack(PCAPNG_OPT_END, 0)
+        self.write_bytes(pcapng_block(PCAPNG_SHB, section) +
+                         pcapng_block(PCAPNG_IDB, interface))
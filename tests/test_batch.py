@@ -0,0 +1,87 @@
+import struct
+import unittest
+
+from sniffles.batch import BatchGenerator, batch_limitation, np
+from sniffles.rulereader import Rule
+from sniffles.snifflesconfig import SnifflesConfig
+
+
+def ones_complement_sum(data):
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return total
+
+
+def read_records(data):
+    records = []
+    offset = 0
+    while offset < len(data):
+        sec, usec, incl, orig = struct.unpack('<IIII',
+                                              data[offset:offset + 16])
+        records.append((sec, usec, data[offset + 16:offset + 16 + incl]))
+        offset += 16 + incl
+    return records
+
+
+@unittest.skipIf(np is None, "NumPy is not installed")
+class TestBatch(unittest.TestCase):
+    def test_batch_limitation(self):
+        sconf = SnifflesConfig()
+        self.assertIsNone(batch_limitation(sconf))
+        self.assertIsNotNone(batch_limitation(sconf, [Rule()]))
+        sconf.setIPV6Percent(50)
+        self.assertIsNotNone(batch_limitation(sconf))
+
+    def test_build_batch(self):
+        sconf = SnifflesConfig()
+        sconf.setTCPHandshake(True)
+        sconf.setTCPTeardown(True)
+        sconf.setTCPACK(True)
+        sconf.setPktsPerStream(2)
+        sconf.setFirstTimestamp(1000)
+        generator = BatchGenerator(sconf, 50)
+        data, pkts, last = generator.build_batch()
+        records = read_records(data)
+        self.assertEqual(len(records), pkts)
+        self.assertEqual((records[-1][0], records[-1][1]), last)
+        times = [sec * 1000000 + usec for sec, usec, _ in records]
+        self.assertEqual(times, sorted(times))
+        self.assertGreaterEqual(times[0], 1000 * 1000000)
+        flows = {}
+        for _, _, frame in records:
+            ip = frame[14:]
+            self.assertEqual(ones_complement_sum(ip[:20]), 0xffff)
+            length = struct.unpack('!H', ip[2:4])[0]
+            self.assertEqual(length, len(ip))
+            proto = ip[9]
+            if proto in [6, 17]:
+                pseudo = ip[12:20] + struct.pack('!HH', proto, length - 20)
+                self.assertEqual(ones_complement_sum(pseudo + ip[20:]),
+                                 0xffff)
+            if proto == 6:
+                key = frozenset([ip[12:16] + ip[20:22],
+                                 ip[16:20] + ip[22:24]])
+                flags = struct.unpack('!H', ip[32:34])[0] & 0xff
+                flows.setdefault(key, []).append(flags)
+        # handshake, two data packets each acked, teardown
+        for flags in flows.values():
+            self.assertEqual(flags, [0x02, 0x12, 0x10, 0x10, 0x10, 0x10,
+                                     0x11, 0x10, 0x11, 0x10])
+
+    def test_build_batch_fixed_length(self):
+        sconf = SnifflesConfig()
+        sconf.setProto('udp')
+        sconf.setPktLength(100)
+        generator = BatchGenerator(sconf, 10)
+        data, pkts, _ = generator.build_batch(4)
+        self.assertEqual(pkts, 4)
+        for _, _, frame in read_records(data):
+            self.assertEqual(len(frame), 14 + 20 + 8 + 100)
+            self.assertEqual(frame[23], 17)
+
+
+if __name__ == '__main__':
+    unittest.main()
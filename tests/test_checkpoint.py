@@ -0,0 +1,125 @@
+import contextlib
+import io
+import itertools
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from sniffles import sniffles
+from sniffles.checkpoint import (Checkpointer, CheckpointPickler,
+                                 load_checkpoint, parse_checkpoint_interval)
+from sniffles.snifflesconfig import SnifflesConfig
+
+
+class Interrupted(Exception):
+    pass
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_parse_checkpoint_interval(self):
+        self.assertEqual(parse_checkpoint_interval('5000'), (5000, 0))
+        self.assertEqual(parse_checkpoint_interval('30s'), (0, 30))
+        for spec in ['0', '-5s', 'often']:
+            with self.assertRaises(ValueError):
+                parse_checkpoint_interval(spec)
+
+    def test_checkpointer(self):
+        path = os.path.join(self.workdir, 'out.pcap.ckpt')
+        checkpointer = Checkpointer(path, '10')
+        self.assertFalse(checkpointer.due(9))
+        self.assertTrue(checkpointer.due(10))
+        counter = itertools.count(7)
+        checkpointer.save({'counter': counter}, 10)
+        self.assertFalse(checkpointer.due(19))
+        state = load_checkpoint(path)
+        self.assertEqual(next(state['counter']), 7)
+        self.assertEqual(state['interval'], '10')
+        self.assertEqual(os.listdir(self.workdir), ['out.pcap.ckpt'])
+        checkpointer.remove()
+        self.assertEqual(os.listdir(self.workdir), [])
+        with open(path, 'wb') as bad:
+            CheckpointPickler(bad).dump(['not', 'a', 'checkpoint'])
+        with self.assertRaises(ValueError):
+            load_checkpoint(path)
+        with open(path, 'wb') as bad:
+            bad.write(pickle.dumps(None)[:1])
+        with self.assertRaises(ValueError):
+            load_checkpoint(path)
+
+    def run_sniffles(self, options):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return sniffles.start_generation(SnifflesConfig(options))
+
+    def check_resume(self, name, options, interval, stop):
+        """
+            Runs options whole, and again stopped after the first
+            checkpoint past stop packets and resumed, and checks that
+            both give the same pcap and result file.
+        """
+        outputs = []
+        for run in ['whole', 'resumed']:
+            output = os.path.join(self.workdir, name + run + '.pcap')
+            outputs.append(output)
+            files = ['-o', output, '--resultfile', output + '.txt']
+            if run == 'whole':
+                stats = self.run_sniffles(options + files)
+                continue
+            save = Checkpointer.save
+
+            def save_and_stop(checkpointer, state, packets):
+                save(checkpointer, state, packets)
+                if packets > stop:
+                    raise Interrupted()
+            with mock.patch.object(Checkpointer, 'save', save_and_stop):
+                with self.assertRaises(Interrupted):
+                    self.run_sniffles(options + files + ['--checkpoint',
+                                                         interval])
+            self.assertTrue(os.path.exists(output + '.ckpt'))
+            # The interrupted run wrote more than the checkpoint holds.
+            with open(output + '.txt', 'a') as fd_result:
+                fd_result.write("Pkt 9999 : lost\n")
+            self.assertEqual(self.run_sniffles(options + files +
+                                               ['--resume']), stats)
+            self.assertFalse(os.path.exists(output + '.ckpt'))
+        for suffix in ['', '.txt']:
+            with open(outputs[0] + suffix, 'rb') as first, \
+                    open(outputs[1] + suffix, 'rb') as second:
+                self.assertEqual(first.read(), second.read())
+
+    def test_resume(self):
+        self.check_resume('random', ['-c', '300', '-C', '20', '-p', '5',
+                                     '-g', '1000', '--seed', '5', '--flows',
+                                     'steady', '--rate', '1kpps',
+                                     '--pipeline'], '200', 500)
+
+    def test_resume_bulk_and_fragments(self):
+        # Open bulk transfers and fragmented packets hold memoryview
+        # slices of their payloads.
+        for name in ['test_bulk.xml', 'test_frag.xml']:
+            self.check_resume(name, ['-c', '30', '-C', '10', '--flows',
+                                     'steady', '-g', '1000', '--seed', '7',
+                                     '-f', 'tests/data_files/' + name],
+                              '5', 40)
+
+    def test_checkpoint_options(self):
+        sconf = SnifflesConfig(['--checkpoint', '30S', '--resume'])
+        self.assertEqual(sconf.getCheckpoint(), '30s')
+        self.assertTrue(sconf.getResume())
+        with contextlib.redirect_stdout(io.StringIO()):
+            for options in [['--checkpoint', 'never'],
+                            ['--resume', '--workers', '2']]:
+                with self.assertRaises(SystemExit):
+                    SnifflesConfig(options)
+
+
+if __name__ == '__main__':
+    unittest.main()
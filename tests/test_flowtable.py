@@ -0,0 +1,88 @@
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import sniffles.ruletrafficgenerator as rtgen
+from sniffles import sniffles
+from sniffles.flowtable import FlowTable, deep_size, parse_flow_mode
+from sniffles.scheduler import make_scheduler
+from sniffles.snifflesconfig import SnifflesConfig
+
+
+class TestFlowTable(unittest.TestCase):
+    def test_parse_flow_mode(self):
+        self.assertEqual(parse_flow_mode(), ('fill', None))
+        self.assertEqual(parse_flow_mode('Steady'), ('steady', None))
+        self.assertEqual(parse_flow_mode('poisson:250'), ('poisson', 250))
+        for spec in ['burst', 'steady:5', 'poisson', 'poisson:0']:
+            with self.assertRaises(ValueError):
+                parse_flow_mode(spec)
+
+    def test_flow_table(self):
+        sconf = SnifflesConfig(['-p', '3', '-L', '10'])
+        table = FlowTable(make_scheduler(), 2)
+        conversations = [rtgen.Conversation(None, sconf, 1, usec)
+                         for usec in [0, 5]]
+        for conversation in conversations:
+            table.add(conversation)
+        self.assertEqual(table.get_open(), 2)
+        self.assertTrue(table.full())
+        while table:
+            time_ns, conversation = table.pop()
+            conversation.getNextPacketNs()
+            if conversation.hasPackets():
+                table.push(conversation.getNextTime(), conversation)
+            else:
+                table.close(conversation)
+        self.assertEqual(table.get_open(), 0)
+        self.assertFalse(table.full())
+        self.assertEqual(table.peak_live, 2)
+        self.assertEqual(table.peak_active, 2)
+        self.assertEqual(table.duration_ns,
+                         sum(conversation.last_ns - start for conversation,
+                             start in zip(conversations,
+                                          [1000000000, 1000005000])))
+        self.assertGreater(deep_size(conversations[0]), 0)
+        self.assertEqual(len(table.report().splitlines()), 3)
+
+    def generate(self, options):
+        workdir = tempfile.mkdtemp()
+        try:
+            output = os.path.join(workdir, 'out.pcap')
+            sconf = SnifflesConfig(options + ['-g', '1000', '-o', output,
+                                              '--resultfile',
+                                              output + '.txt'])
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                stats = sniffles.start_generation(sconf)
+            return stats, out.getvalue()
+        finally:
+            shutil.rmtree(workdir)
+
+    def test_flow_modes(self):
+        (streams, pkts, _), out = self.generate(
+            ['-c', '200', '-p', '4', '-C', '10', '--flows', 'steady'])
+        self.assertEqual((streams, pkts), (200, 800))
+        self.assertIn("at most 10 live", out)
+        self.assertIn("Concurrent flows: peak 10,", out)
+        (streams, pkts, _), out = self.generate(
+            ['-c', '200', '-p', '4', '--flows', 'poisson:1000',
+             '--maxflows', '2'])
+        self.assertEqual((streams, pkts), (200, 800))
+        self.assertIn("at most 2 live at a time (cap 2)", out)
+
+    def test_flow_options(self):
+        sconf = SnifflesConfig(['--flows', 'poisson:10', '--maxflows', '5'])
+        self.assertEqual(sconf.getFlowMode(), 'poisson:10')
+        self.assertEqual(sconf.getMaxFlows(), 5)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for options in [['--flows', 'burst'], ['--maxflows', '-1']]:
+                with self.assertRaises(SystemExit):
+                    SnifflesConfig(options)
+
+
+if __name__ == '__main__':
+    unittest.main()
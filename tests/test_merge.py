@@ -0,0 +1,164 @@
+import contextlib
+import io
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from sniffles import sniffles
+from sniffles.merge import MergeBuffer, merge_pcaps
+from sniffles.snifflesconfig import SnifflesConfig
+from sniffles.traffic_writer import TrafficWriter
+
+
+def read_times(path):
+    with open(path, 'rb') as pcap:
+        data = pcap.read()
+    times = []
+    offset = 24
+    while offset < len(data):
+        sec, usec, incl, _ = struct.unpack('IIII', data[offset:offset + 16])
+        times.append((sec, usec, data[offset + 16:offset + 16 + incl]))
+        offset += 16 + incl
+    return times
+
+
+class TestMerge(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.pcap')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_merge_buffer(self):
+        writer = TrafficWriter(self.path)
+        result = io.StringIO()
+        merge_buffer = MergeBuffer(writer, 2, result)
+        self.assertIsNone(merge_buffer.report())
+        for usec, data in [(10, b'a'), (30, b'c'), (20, b'b'), (40, b'd'),
+                           (5, b'e'), (50, b'f')]:
+            merge_buffer.add(usec * 1000, data, " : " + data.decode() + "\n")
+            self.assertLessEqual(len(merge_buffer), 2)
+        merge_buffer.flush()
+        writer.close_save_file()
+        # b is put back in order, e is too late for the window and gets
+        # the timestamp of the packet before it.
+        self.assertEqual(read_times(self.path),
+                         [(0, 10, b'a'), (0, 20, b'b'), (0, 20, b'e'),
+                          (0, 30, b'c'), (0, 40, b'd'), (0, 50, b'f')])
+        self.assertEqual(result.getvalue(),
+                         "Pkt 1 : a\nPkt 2 : b\nPkt 3 : e\nPkt 4 : c\n"
+                         "Pkt 5 : d\nPkt 6 : f\n")
+        self.assertEqual((merge_buffer.reordered, merge_buffer.clamped),
+                         (2, 1))
+        self.assertIsNotNone(merge_buffer.report())
+        self.assertEqual(merge_buffer.get_last_ns(), 50000)
+
+    def test_merge_pcaps(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            shards = []
+            results = []
+            for index, times in enumerate([[1, 4, 4, 9], [2, 4, 8], []]):
+                shard = os.path.join(workdir, 'shard' + str(index))
+                result = shard + '.txt'
+                writer = TrafficWriter(shard, 0, True)
+                with open(result, 'w') as fd_result:
+                    for time_ns in times:
+                        writer.write_packet_ns(1, bytes([time_ns]), time_ns)
+                        fd_result.write("Pkt 0 : shard " + str(index) +
+                                        "\n")
+                writer.close_save_file()
+                shards.append(shard)
+                results.append(result)
+            merged = os.path.join(workdir, 'merged')
+            self.assertEqual(merge_pcaps(shards, merged, results,
+                                         merged + '.txt'), 7)
+            self.assertEqual([(frac, data) for _, frac, data
+                              in read_times(merged)],
+                             [(1, b'\x01'), (2, b'\x02'), (4, b'\x04'),
+                              (4, b'\x04'), (4, b'\x04'), (8, b'\x08'),
+                              (9, b'\x09')])
+            with open(merged + '.txt') as fd_result:
+                self.assertEqual(fd_result.read().splitlines(),
+                                 ["Pkt 1 : shard 0", "Pkt 2 : shard 1",
+                                  "Pkt 3 : shard 0", "Pkt 4 : shard 0",
+                                  "Pkt 5 : shard 1", "Pkt 6 : shard 1",
+                                  "Pkt 7 : shard 0"])
+        finally:
+            shutil.rmtree(workdir)
+
+    def test_workers(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            output = os.path.join(workdir, 'out.pcap')
+            result = os.path.join(workdir, 'result.txt')
+            sconf = SnifflesConfig(['-c', '25', '-t', '-T', '-C', '4',
+                                    '--workers', '3', '-o', output,
+                                    '--resultfile', result])
+            streams, pkts, _ = sniffles.start_generation(sconf)
+            self.assertEqual(streams, 25)
+            self.assertEqual(sorted(os.listdir(workdir)),
+                             ['out.pcap', 'result.txt'])
+            records = read_times(output)
+            self.assertEqual(len(records), pkts)
+            times = [sec * 1000000 + usec for sec, usec, _ in records]
+            self.assertEqual(times, sorted(times))
+            with open(result) as fd_result:
+                self.assertEqual(len(fd_result.read().splitlines()), pkts)
+        finally:
+            shutil.rmtree(workdir)
+
+    def test_shard(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            options = ['-c', '12', '-t', '-T', '-C', '4', '-g', '1000',
+                       '--seed', '7']
+            pcaps = []
+            results = []
+            for index in range(3):
+                pcaps.append(os.path.join(workdir, str(index) + '.pcap'))
+                results.append(os.path.join(workdir, str(index) + '.txt'))
+                sniffles.start_generation(SnifflesConfig(
+                    options + ['--shard', str(index) + '/3', '-o',
+                               pcaps[index], '--resultfile',
+                               results[index]]))
+            merged = os.path.join(workdir, 'merged.pcap')
+            merge_pcaps(pcaps, merged, results, merged + '.txt')
+            output = os.path.join(workdir, 'workers.pcap')
+            sniffles.start_generation(SnifflesConfig(
+                options + ['--workers', '3', '-o', output,
+                           '--resultfile', output + '.txt']))
+            # The shards merge into exactly what --workers generates.
+            for path in [merged, merged + '.txt']:
+                with open(path, 'rb') as first, \
+                        open(path.replace('merged', 'workers'),
+                             'rb') as second:
+                    self.assertEqual(first.read(), second.read())
+        finally:
+            shutil.rmtree(workdir)
+
+    def test_shard_option(self):
+        fixed = ['--seed', '7', '-g', '1000']
+        self.assertEqual(SnifflesConfig(['--shard', '2/4'] +
+                                        fixed).getShard(), (2, 4))
+        with contextlib.redirect_stdout(io.StringIO()):
+            for arg in ['4/4', '1', 'a/b']:
+                with self.assertRaises(SystemExit):
+                    SnifflesConfig(['--shard', arg] + fixed)
+            with self.assertRaises(SystemExit):
+                SnifflesConfig(['--shard', '0/2', '--workers', '2'] + fixed)
+            # Unseeded shards, or shards starting at the current time,
+            # would not fit together.
+            for missing in [fixed[:2], fixed[2:]]:
+                with self.assertRaises(SystemExit):
+                    SnifflesConfig(['--shard', '0/2'] + missing)
+
+    def test_window_option(self):
+        self.assertEqual(SnifflesConfig(['--window', '16']).getWindow(), 16)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import sniffles.ruletrafficgenerator as rtgen
+from sniffles import sniffles
+from sniffles.metrics import Metrics, format_eta, parse_progress_interval
+from sniffles.snifflesconfig import SnifflesConfig
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_parse_progress_interval(self):
+        self.assertEqual(parse_progress_interval('2'), 2.0)
+        self.assertEqual(parse_progress_interval('0.5'), 0.5)
+        for spec in ['0', '-1', 'often']:
+            with self.assertRaises(ValueError):
+                parse_progress_interval(spec)
+        self.assertEqual(format_eta(None), "?")
+        self.assertEqual(format_eta(3725.5), "1:02:05")
+
+    def test_metrics(self):
+        path = os.path.join(self.workdir, 'metrics.jsonl')
+        metrics = Metrics(0.5, open(path, 'w'), 3)
+        written = [0]
+        metrics.watch('bytes', lambda: written[0])
+        metrics.set_progress(lambda: (written[0] // 100, 40))
+        metrics.count('packets', 10)
+        metrics.add_time('payload', 0.25)
+        written[0] = 1000
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['shard'], 3)
+        self.assertEqual(snapshot['packets'], 10)
+        self.assertEqual(snapshot['bytes'], 1000)
+        self.assertEqual(snapshot['payload_seconds'], 0.25)
+        self.assertEqual(snapshot['done'], 0.25)
+        self.assertIsNotNone(snapshot['eta'])
+        self.assertGreater(snapshot['pps'], 0)
+        self.assertFalse(snapshot['final'])
+        self.assertTrue(metrics.progress_line(snapshot).startswith(
+            "shard 3:  25.0% 10 packets"))
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            metrics.request_snapshot()
+            metrics.tick()
+            self.assertFalse(metrics.requested)
+            metrics.next_time = 0
+            metrics.tick()
+            written[0] = 4000
+            final = metrics.close()
+        lines = err.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith("Metrics: {"))
+        self.assertEqual(final['done'], 1.0)
+        self.assertEqual(final['eta'], 0.0)
+        with open(path) as metrics_file:
+            snapshots = [json.loads(line) for line in metrics_file]
+        self.assertEqual([snapshot['final'] for snapshot in snapshots],
+                         [False, False, True])
+
+    def test_nfa_cache(self):
+        generator = rtgen.ContentGenerator()
+        with mock.patch.dict(rtgen.NFA_CACHE, clear=True), \
+                mock.patch.object(rtgen, 'NFA_CACHE_HITS', 0):
+            for _ in range(3):
+                self.assertEqual(generator.generate_from_regex('/abc/'),
+                                 [97, 98, 99])
+            self.assertEqual(rtgen.get_nfa_cache_stats(), (2, 1))
+
+    def test_metrics_file(self):
+        output = os.path.join(self.workdir, 'out.pcap')
+        path = os.path.join(self.workdir, 'metrics.jsonl')
+        sconf = SnifflesConfig(['-c', '100', '-p', '3', '-g', '1000',
+                                '-o', output, '--resultfile',
+                                output + '.txt', '--metricsfile', path])
+        self.assertEqual(sconf.getMetricsFile(), path)
+        with contextlib.redirect_stdout(io.StringIO()):
+            stats = sniffles.start_generation(sconf)
+        with open(path) as metrics_file:
+            final = json.loads(metrics_file.readlines()[-1])
+        self.assertTrue(final['final'])
+        self.assertEqual(final['packets'], stats[1])
+        self.assertEqual(final['written'], stats[1])
+        self.assertEqual(final['streams'], 100)
+        self.assertEqual(final['conversations'], 100)
+        self.assertEqual(final['open_flows'], 0)
+        self.assertEqual(final['bytes'],
+                         os.path.getsize(output) - 24 - 16 * stats[1])
+        self.assertIsNone(sniffles.METRICS)
+
+    def test_metrics_options(self):
+        sconf = SnifflesConfig(['--progress', '5'])
+        self.assertEqual(sconf.getProgress(), 5.0)
+        self.assertIsNone(sconf.getMetricsFile())
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(SystemExit):
+                SnifflesConfig(['--progress', '0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import io
+import os
+import tempfile
+import unittest
+
+import sniffles.ruletrafficgenerator as rtgen
+from sniffles.merge import MergeBuffer
+from sniffles.pipeline import PacketPipeline, result_note
+from sniffles.snifflesconfig import SnifflesConfig
+from sniffles.traffic_writer import TrafficWriter
+
+
+class BrokenPacket:
+    def get_packet(self):
+        raise RuntimeError("cannot serialize")
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.pcap')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def run_pipeline(self, packets, threads):
+        writer = TrafficWriter(self.path)
+        result = io.StringIO()
+        pipeline = PacketPipeline(MergeBuffer(writer, 16, result), threads,
+                                  batch_size=7, depth=2)
+        for time_ns, pkt in packets:
+            pipeline.put(time_ns, pkt)
+        pipeline.close()
+        writer.close_save_file()
+        with open(self.path, 'rb') as pcap:
+            return pcap.read(), result.getvalue(), pipeline
+
+    def test_pipeline(self):
+        packets = []
+        for i in range(100):
+            myts = rtgen.TrafficStream(None, SnifflesConfig())
+            packets.append((i * 1000, myts.getNextPacket()))
+        inline = self.run_pipeline(packets, False)
+        threaded = self.run_pipeline(packets, True)
+        self.assertEqual(inline[:2], threaded[:2])
+        self.assertEqual(inline[1].count(result_note(packets[0][1])), 100)
+        for timer in threaded[2].timers:
+            self.assertEqual(timer.packets, 100)
+        self.assertEqual(len(threaded[2].report().splitlines()), 3)
+        self.assertEqual(threaded[2].get_last_ns(), 99000)
+
+    def test_pipeline_error(self):
+        packets = [(i, BrokenPacket()) for i in range(50)]
+        with self.assertRaises(RuntimeError):
+            self.run_pipeline(packets, True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from sniffles import sniffles
+from sniffles.rate import Pacer, RateProfile, parse_rate, parse_rate_value
+from sniffles.snifflesconfig import SnifflesConfig
+from sniffles.traffic_writer import NSEC_PER_SEC
+
+
+class TestRate(unittest.TestCase):
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate_value('2Gbps'), (2e9, 'bps'))
+        self.assertEqual(parse_rate_value('20kpps'), (20000, 'pps'))
+        self.assertEqual(parse_rate('1.5Mbps').segments, [(0, 1.5e6)])
+        for spec in ['10', '10furlongs', '-1pps', 'profile:']:
+            with self.assertRaises(ValueError):
+                parse_rate(spec)
+        workdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(workdir, 'profile.txt')
+            with open(path, 'w') as profile:
+                profile.write("# diurnal\n0 1kpps\n\n2.5 3kpps\n4 0pps\n")
+            profile = parse_rate('profile:' + path)
+            self.assertEqual(profile.segments,
+                             [(0, 1000), (2.5, 3000), (4, 0)])
+            self.assertEqual(profile.unit, 'pps')
+            self.assertEqual(profile.get_end(), 4)
+            self.assertEqual(profile.requested(2), 2000)
+            with open(path, 'w') as profile:
+                profile.write("0 1kpps\n1 1Mbps\n")
+            with self.assertRaises(ValueError):
+                parse_rate('profile:' + path)
+        finally:
+            shutil.rmtree(workdir)
+
+    def test_pacer(self):
+        pacer = Pacer(RateProfile([(0, 4), (1, 0), (2, 2)], 'pps'), 10)
+        times = [pacer.place(100) for _ in range(6)]
+        self.assertEqual(times, [10, 10 + NSEC_PER_SEC // 4,
+                                 10 + NSEC_PER_SEC // 2,
+                                 10 + 3 * NSEC_PER_SEC // 4,
+                                 10 + 2 * NSEC_PER_SEC,
+                                 10 + 5 * NSEC_PER_SEC // 2])
+        self.assertEqual(pacer.achieved, [4, 0, 2])
+
+        pacer = Pacer(RateProfile([(0, 8000)], 'bps'), 0, NSEC_PER_SEC)
+        times = [pacer.place(500) for _ in range(3)]
+        self.assertEqual(times, [0, NSEC_PER_SEC // 2, None])
+        self.assertEqual(pacer.dropped, 1)
+        self.assertEqual(pacer.get_time_ns(), NSEC_PER_SEC)
+        self.assertEqual(len(pacer.report().splitlines()), 3)
+
+    def test_rate_duration(self):
+        workdir = tempfile.mkdtemp()
+        try:
+            output = os.path.join(workdir, 'out.pcap')
+            sconf = SnifflesConfig(['-D', '2', '-C', '10', '-g', '1000',
+                                    '--rate', '200pps', '-o', output,
+                                    '--resultfile', output + '.txt'])
+            with contextlib.redirect_stdout(io.StringIO()):
+                streams, pkts, last_sec = sniffles.start_generation(sconf)
+            self.assertEqual(pkts, 400)
+            self.assertEqual(last_sec, 1002)
+            with open(output + '.txt') as fd_result:
+                self.assertEqual(len(fd_result.read().splitlines()), 400)
+        finally:
+            shutil.rmtree(workdir)
+
+    def test_rate_option(self):
+        self.assertEqual(SnifflesConfig(['--rate', '2Gbps']).getRate(),
+                         '2Gbps')
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(SystemExit):
+                SnifflesConfig(['--rate', 'fast'])
+
+
+if __name__ == '__main__':
+    unittest.main()
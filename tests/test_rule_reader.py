@@ -12,6 +12,8 @@ class TestRuleReader(unittest.TestCase):
 
         # Asserts for rule settings
         self.assertEqual(myrule.getProto(), 'tcp')
+        with self.assertRaises(AttributeError):
+            myrule.not_a_field = 1
         for protocolType in protocols:
             myrule = reader.BackgroundTrafficRule()
             myrule.updateContent(protocolType)
@@ -85,6 +87,51 @@ class TestRuleReader(unittest.TestCase):
         myrule.setReplyChance(-8)
         self.assertEqual(myrule.getReplyChance(), -8)
 
+    def test_bulk_transfer_rule(self):
+        myrule = reader.BulkTransferRule(4096, 512, 3, [10])
+        self.assertEqual(myrule.getProto(), 'tcp')
+        self.assertTrue(myrule.testTypeRule('BulkTransfer'))
+        self.assertEqual(myrule.getTotalBytes(), 4096)
+        self.assertEqual(myrule.getMSS(), 512)
+        self.assertEqual(myrule.getAckEvery(), 3)
+        self.assertEqual(myrule.getMatchOffsets(), [10])
+        myrule.setMSS(0)
+        self.assertEqual(myrule.getMSS(), 1)
+
+        myrulelist = reader.RuleList()
+        myrulelist.readRuleFile('tests/data_files/test_bulk.xml')
+        myts = myrulelist.getParsedRules()[0].getTS()[0]
+        self.assertIsInstance(myts, reader.BulkTransferRule)
+        self.assertEqual(myts.getTotalBytes(), 100000)
+        self.assertEqual(myts.getMSS(), 1000)
+        self.assertEqual(myts.getAckEvery(), 4)
+        self.assertEqual(myts.getMatchOffsets(), [5000, 90000])
+        self.assertEqual(len(myts.getPkts()), 2)
+
+    def test_freeze_rule(self):
+        myrule = reader.Rule('frozen')
+        mytsrule = reader.TrafficStreamRule('tcp')
+        mypkt = reader.RulePkt("to server", "/abc/")
+        mytsrule.addPktRule(mypkt)
+        myrule.addTS(mytsrule)
+        self.assertFalse(myrule.isFrozen())
+        with self.assertRaises(AttributeError):
+            mypkt.not_a_field = 1
+        myrule.freeze()
+        for obj in [myrule, mytsrule, mypkt, mypkt.getContent()[0]]:
+            self.assertTrue(obj.isFrozen())
+        self.assertEqual(myrule.getTS(), (mytsrule,))
+        self.assertEqual(mytsrule.getPkts(), (mypkt,))
+        with self.assertRaises(AttributeError):
+            myrule.setRuleName('thawed')
+        with self.assertRaises(AttributeError):
+            mytsrule.setProto('udp')
+        with self.assertRaises(AttributeError):
+            mypkt.setTimes(5)
+        self.assertEqual(myrule.getRuleName(), 'frozen')
+        self.assertEqual(mytsrule.getProto(), 'tcp')
+        self.assertEqual(mypkt.getTimes(), 1)
+
     def test_ttl_expiry_value(self):
         myprule = reader.Rule('Petabi')
         mytsrule1 = reader.TrafficStreamRule('udp')
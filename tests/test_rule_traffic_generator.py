@@ -1,12 +1,14 @@
+import contextlib
+import io
 import random
 import struct
 import unittest
 import warnings
 
 import sniffles.ruletrafficgenerator as rtgen
-from sniffles.rulereader import (BackgroundTrafficRule, RuleList, RulePkt,
-                                 ScanAttackRule, SnortRuleParser,
-                                 TrafficStreamRule)
+from sniffles.rulereader import (BackgroundTrafficRule, BulkTransferRule, Rule,
+                                 RuleList, RulePkt, ScanAttackRule,
+                                 SnortRuleParser, TrafficStreamRule)
 from sniffles.snifflesconfig import SnifflesConfig
 from sniffles.vendor_mac_list import VENDOR_MAC_OUI
 
@@ -183,6 +185,118 @@ class TestRuleTrafficGenerator(unittest.TestCase):
         with self.assertRaises(KeyError):
             ef.get_dist_mac_oui('src')
 
+    def test_dist_mac_oui_sampling(self):
+        ef = rtgen.EthernetFrame('10.2.2.2', '10.3.3.3',
+                                 rtgen.ETHERNET_HDR_GEN_DISTRIBUTION,
+                                 'tests/data_files/mac_definition_file.txt')
+        bounds, prefixes = rtgen.VENDOR_MAC_DIST['src']
+        self.assertEqual(prefixes[0], [0x00, 0x80, 0x5a, 0x36])
+        self.assertEqual(bounds[:3], [10, 30, 40])
+        counts = {}
+        random.seed(1)
+        for _ in range(0, 10000):
+            oui = tuple(ef.get_dist_mac_oui('src'))
+            counts[oui] = counts.get(oui, 0) + 1
+        # 10% and 20% shares of a domain of 100.
+        self.assertAlmostEqual(counts[(0x00, 0x80, 0x5a, 0x36)], 1000,
+                               delta=150)
+        self.assertAlmostEqual(
+            counts[(0x00, 0x80, 0x5b, 0x98, 0x76, 0x54)], 2000, delta=200)
+        random.seed()
+        ef.clear_globals()
+
+    def test_mac_ip_map_is_bounded(self):
+        ip = [rtgen.pack_ip('10.0.0.' + str(i)) for i in range(0, 6)]
+        ef = rtgen.EthernetFrame(ip[1], ip[2])
+        ef.clear_globals()
+        size = rtgen.MAC_IP_MAP_SIZE
+        rtgen.set_mac_ip_map_size(4)
+        try:
+            first = rtgen.EthernetFrame(ip[1], ip[2])
+            rtgen.EthernetFrame(ip[3], ip[4])
+            # Reusing 10.0.0.1 keeps its binding recent.
+            again = rtgen.EthernetFrame(ip[1], ip[5])
+            self.assertEqual(first.get_s_mac(), again.get_s_mac())
+            self.assertEqual(len(rtgen.MAC_IP_MAP), 4)
+            self.assertNotIn(ip[2], rtgen.MAC_IP_MAP)
+            self.assertIn(ip[1], rtgen.MAC_IP_MAP)
+        finally:
+            rtgen.set_mac_ip_map_size(size)
+            ef.clear_globals()
+
+    def test_clear_mac_ip_map(self):
+        ef = rtgen.EthernetFrame(type=None)
+        # clear_globals() rebinds MAC_IP_MAP; the new map is cleared.
+        ef.clear_globals()
+        rtgen.EthernetFrame(rtgen.pack_ip('10.0.0.1'),
+                            rtgen.pack_ip('10.0.0.2'))
+        self.assertEqual(len(rtgen.MAC_IP_MAP), 2)
+        rtgen.clear_mac_ip_map()
+        self.assertEqual(len(rtgen.MAC_IP_MAP), 0)
+
+    def test_stream_macs_survive_eviction(self):
+        myrules = RuleList()
+        myrules.readRuleFile('tests/data_files/test_tcp_overlap.xml')
+        tsrule = myrules.getParsedRules()[0].getTS()[0]
+        ef = rtgen.EthernetFrame(type=None)
+        ef.clear_globals()
+        size = rtgen.MAC_IP_MAP_SIZE
+        rtgen.set_mac_ip_map_size(1)
+        try:
+            streams = [rtgen.TrafficStream(tsrule),
+                       rtgen.TrafficStream(tsrule)]
+            macs = [{}, {}]
+            # Interleaving the streams evicts each one's bindings.
+            while any(ts.hasPackets() for ts in streams):
+                for ts, seen in zip(streams, macs):
+                    if ts.hasPackets():
+                        pkt = ts.getNextPacket()
+                        hdr = pkt.datalink_hdr
+                        for ip, mac in [
+                                (pkt.network_hdr.get_packed_sip(),
+                                 hdr.get_s_mac()),
+                                (pkt.network_hdr.get_packed_dip(),
+                                 hdr.get_d_mac())]:
+                            self.assertEqual(seen.setdefault(ip, mac), mac)
+        finally:
+            rtgen.set_mac_ip_map_size(size)
+            ef.clear_globals()
+
+    def test_host_population(self):
+        rtgen.set_ipv4_home(['10.1'])
+        rtgen.set_host_population(
+            50, 1.0, 'tests/data_files/mac_definition_file.txt')
+        try:
+            hosts = rtgen.HOST_POPULATION
+            self.assertEqual(hosts.get_size(), 50)
+            seen = set()
+            for _ in range(0, 200):
+                tsrule = TrafficStreamRule('tcp', '$HOME_NET',
+                                           '$EXTERNAL_NET', 'any', 'any',
+                                           -1, 4, False, False, False)
+                tsrule.addPktRule(RulePkt("to server", "/abc/", 1))
+                ts = rtgen.TrafficStream(tsrule, SnifflesConfig())
+                self.assertTrue(ts.sip.startswith(b'\x0a\x01'))
+                self.assertFalse(ts.dip.startswith(b'\x0a\x01'))
+                seen.add(ts.sip)
+                seen.add(ts.dip)
+                pkt = ts.getNextPacket()
+                self.assertEqual(pkt.datalink_hdr.get_s_mac(),
+                                 hosts.get_mac(ts.sip))
+                self.assertEqual(pkt.datalink_hdr.get_s_mac()[0:2],
+                                 [0x00, 0x80])
+            self.assertLessEqual(len(seen), 50)
+            tsrule = TrafficStreamRule('tcp', '192.168.1.1', 'any', 'any',
+                                       'any', -1, 4, False, False, False)
+            tsrule.addPktRule(RulePkt("to server", "/abc/", 1))
+            ts = rtgen.TrafficStream(tsrule, SnifflesConfig())
+            self.assertEqual(rtgen.format_ip(ts.sip), '192.168.1.1')
+            self.assertIsNone(hosts.get_mac(ts.sip))
+        finally:
+            rtgen.set_host_population(0)
+            rtgen.set_ipv4_home([])
+            rtgen.EthernetFrame().clear_globals()
+
     def test_build_ip_header(self):
         myipv4a = rtgen.IPV4(None, None)
         myipv4b = rtgen.IPV4(myipv4a.get_sip(), myipv4a.get_dip())
@@ -192,6 +306,13 @@ class TestRuleTrafficGenerator(unittest.TestCase):
         myipv6b = rtgen.IPV6(myipv6a.get_sip(), myipv6a.get_dip())
         self.assertEqual(myipv6a.get_sip(), myipv6b.get_sip())
         self.assertEqual(myipv6a.get_dip(), myipv6b.get_dip())
+        myipv4c = rtgen.IPV4('10.1.2.3', myipv4a.get_packed_dip())
+        self.assertEqual(myipv4c.get_sip(), '10.1.2.3')
+        self.assertEqual(myipv4c.get_packed_sip(), b'\x0a\x01\x02\x03')
+        self.assertEqual(myipv4c.get_ip_header()[12:],
+                         b'\x0a\x01\x02\x03' + myipv4a.get_packed_dip())
+        self.assertEqual(rtgen.format_ip(rtgen.pack_ip('2001:db8::1')),
+                         '2001:db8::1')
 
     def test_get_ports(self):
         myport = rtgen.Port("80")
@@ -225,6 +346,84 @@ class TestRuleTrafficGenerator(unittest.TestCase):
         myport = rtgen.Port("1,5,80,1000,4000,50000")
         self.assertIn(myport.get_port_value(), [1, 5, 80, 1000, 4000, 50000])
 
+    def test_port_spec(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            for _ in range(0, 50):
+                myport = rtgen.Port("!80")
+                self.assertNotEqual(myport.get_port_value(), 80)
+                myport = rtgen.Port("[1:10,!5]")
+                self.assertIn(myport.get_port_value(),
+                              [1, 2, 3, 4, 6, 7, 8, 9, 10])
+                myport = rtgen.Port("![0:65534]")
+                self.assertEqual(myport.get_port_value(), 65535)
+                myport = rtgen.Port("[80,[8000:8001]]")
+                self.assertIn(myport.get_port_value(), [80, 8000, 8001])
+        self.assertEqual(out.getvalue(), "")
+        self.assertIs(rtgen.get_port_spec("[1:10,!5]"),
+                      rtgen.get_port_spec("[1:10,!5]"))
+        self.assertEqual(rtgen.get_port_spec("[1:10,!5]").get_ranges(),
+                         [(1, 4), (6, 10)])
+        ranges = rtgen.get_port_spec("$HTTP_PORTS").get_ranges()
+        self.assertEqual(sum(hi - lo + 1 for (lo, hi) in ranges),
+                         len(set(rtgen.HTTP_PORTS)))
+
+    def test_ip_spec(self):
+        rtgen.set_ipv4_home(['10.1', '192.168.1'])
+        rtgen.set_ipv6_home(['2001:8888:8888'])
+        try:
+            for _ in range(0, 50):
+                ip = rtgen.get_ip_spec('10.0.0.0/8').get_ip()
+                self.assertTrue(ip.startswith('10.'))
+                ip = rtgen.get_ip_spec('[1.1.1.0/30,!1.1.1.1]').get_ip()
+                self.assertIn(ip, ['1.1.1.0', '1.1.1.2', '1.1.1.3'])
+                ip = rtgen.get_ip_spec('1.1.1').get_ip()
+                self.assertTrue(ip.startswith('1.1.1.'))
+                ip = rtgen.get_ip_spec('any', 4, True).get_ip()
+                self.assertTrue(ip.startswith('10.1.') or
+                                ip.startswith('192.168.1.'))
+                ip = rtgen.get_ip_spec('$HOME_NET').get_ip()
+                self.assertTrue(ip.startswith('10.1.') or
+                                ip.startswith('192.168.1.'))
+                ip = rtgen.get_ip_spec('$EXTERNAL_NET').get_ip()
+                self.assertFalse(ip.startswith('10.1.') or
+                                 ip.startswith('192.168.1.'))
+                ip = rtgen.get_ip_spec('2001:db8::/126', 6).get_ip()
+                self.assertIn(ip, ['2001:db8::', '2001:db8::1',
+                                   '2001:db8::2', '2001:db8::3'])
+                ip = rtgen.get_ip_spec('any', 6, True).get_ip()
+                self.assertTrue(ip.startswith('2001:8888:8888:'))
+                ip = rtgen.get_ip_spec('[10.0.0.1,2001:db8::1]', 6).get_ip()
+                self.assertEqual(ip, '2001:db8::1')
+            self.assertEqual(
+                rtgen.get_ip_spec('10.0.0.1').get_packed_ip(),
+                b'\x0a\x00\x00\x01')
+            self.assertIs(rtgen.get_ip_spec('10.0.0.0/8'),
+                          rtgen.get_ip_spec('10.0.0.0/8'))
+            self.assertEqual(rtgen.get_ip_spec('10.1.2.3/16').get_ranges(),
+                             [(0x0a010000, 0x0a01ffff)])
+        finally:
+            rtgen.set_ipv4_home([])
+            rtgen.set_ipv6_home([])
+
+    def test_port_spec_vars_file(self):
+        rtgen.read_vars_file('tests/data_files/test_vars.txt')
+        try:
+            for _ in range(0, 20):
+                self.assertIn(rtgen.Port("$HTTP_PORTS").get_port_value(),
+                              [8080, 8081])
+                self.assertIn(rtgen.Port("http").get_port_value(),
+                              [8080, 8081])
+                self.assertIn(rtgen.Port("$WEB_PORTS").get_port_value(),
+                              [443, 8080, 8081])
+                ip = rtgen.get_ip_spec('$HOME_NET').get_ip()
+                self.assertTrue(ip.startswith('10.1.') or
+                                ip.startswith('10.2.'))
+        finally:
+            rtgen.clear_vars()
+        self.assertIn(rtgen.Port("$HTTP_PORTS").get_port_value(),
+                      rtgen.HTTP_PORTS)
+
     def test_transport_header(self):
         mydata = struct.pack("!HH", 0, 0)
         mytrans = rtgen.ICMP("1", "0")
@@ -614,6 +813,27 @@ class TestRuleTrafficGenerator(unittest.TestCase):
         self.assertEqual(mypkt.get_content_length(), 5)
         self.assertEqual(mypkt.get_content().get_data()[0:4], b'1234')
 
+    def test_packet_serialization_cache(self):
+        myrpkt = RulePkt("to server", "/12345/")
+        cg = rtgen.ContentGenerator(myrpkt)
+        mypkt = rtgen.Packet('tcp', '10.11.12.13', '13.12.11.10', 4, '1234',
+                             '4321', rtgen.ACK, 100, 0,
+                             rtgen.ETHERNET_HDR_GEN_RANDOM, None,
+                             cg.get_next_published_content())
+        data = mypkt.get_packet()
+        self.assertEqual(len(data), mypkt.get_size())
+        self.assertIs(mypkt.get_packet(), data)
+        mypkt.set_ttl(7)
+        data = mypkt.get_packet()
+        self.assertEqual(data[22], 7)
+        self.assertIs(mypkt.get_packet(), data)
+        mypkt.set_seq_num(0x01020304)
+        data = mypkt.get_packet()
+        self.assertEqual(struct.unpack('!I', data[38:42])[0], 0x01020304)
+        mypkt.network_hdr.set_ttl(9)
+        self.assertEqual(mypkt.get_packet()[22], 9)
+        self.assertEqual(mypkt.get_packet()[-5:], b'12345')
+
     def test_background_traffic(self):
 
         rule = BackgroundTrafficRule()
@@ -645,6 +865,150 @@ class TestRuleTrafficGenerator(unittest.TestCase):
             elif protocol == 'smtp':
                 self.assertIn(port_value, [25, 465])
 
+    def test_bulk_transfer(self):
+        myrulelist = RuleList()
+        myrulelist.readRuleFile('tests/data_files/test_bulk.xml')
+        con = myrulelist.getParsedRules()[0]
+        myconv = rtgen.Conversation(con, SnifflesConfig())
+
+        flags = []
+        payload = b''
+        next_seq = None
+        ts = myconv.getNextPacket()
+        while ts is not None:
+            mypkt = ts[2]
+            if mypkt.transport_hdr.get_flags() & rtgen.FIN:
+                break
+            seq = mypkt.transport_hdr.get_seq_num()
+            size = mypkt.get_content_length()
+            self.assertLessEqual(size, 1000)
+            if size > 0:
+                if next_seq is not None:
+                    self.assertEqual(seq, next_seq)
+                next_seq = seq + size
+                payload += bytes(mypkt.content.get_data())
+                flags.append('D')
+            elif mypkt.transport_hdr.get_flags() == rtgen.ACK and \
+                    payload and next_seq is not None:
+                flags.append('A')
+                self.assertEqual(mypkt.transport_hdr.get_ack_num(), next_seq)
+            ts = myconv.getNextPacket()
+        self.assertEqual(len(payload), 100000)
+        self.assertEqual(payload[5000:5007], b'malware')
+        self.assertEqual(payload[90000:90007], b'payload')
+        data_flags = ''.join(flags).split('A')
+        self.assertEqual(data_flags[:25], ['DDDD'] * 25)
+
+        myrule = BulkTransferRule(2500, 1000)
+        myrule.addPktRule(RulePkt("to server", "/abc/"))
+        myts = rtgen.BulkTransfer(myrule, SnifflesConfig())
+        self.assertEqual(myts.getPacketsRemaining(), 3)
+        sizes = []
+        while myts.hasPackets():
+            sizes.append(myts.getNextPacket().get_content_length())
+        self.assertEqual(sizes, [1000, 1000, 500])
+
+        myrule = BulkTransferRule(1000, 100)
+        myrule.setTotalBytes(-5)
+        myts = rtgen.BulkTransfer(myrule, SnifflesConfig())
+        self.assertEqual(myts.getPacketsRemaining(), 0)
+        self.assertFalse(myts.hasPackets())
+
+    def test_packet_plan(self):
+        mytsrule = TrafficStreamRule('tcp', '1.1.1.1', '2.2.2.2', '[100:200]',
+                                     '[10]', -1, 4, False, True, True)
+        mytsrule.addPktRule(RulePkt("to server", "/abc/", 0, 2))
+        mytsrule.addPktRule(RulePkt("to client", "/def/", 2))
+        mytsrule.addPktRule(RulePkt("to server", "/ghi/", 0, 1, -1, False,
+                                    True))
+        mytsrule.addPktRule(RulePkt("to client", "/jkl/", 0, 1, -1, False,
+                                    False, 2))
+        plan = rtgen.get_packet_plan(mytsrule, 'tcp')
+        self.assertIs(plan, rtgen.get_packet_plan(mytsrule, 'tcp'))
+        self.assertEqual([step.kind for step in plan],
+                         [rtgen.PLAN_NORMAL, rtgen.PLAN_FRAG,
+                          rtgen.PLAN_OOO, rtgen.PLAN_SPLIT])
+        self.assertEqual([step.ack_dir for step in plan],
+                         ["to client", "to server", "to client",
+                          "to server"])
+        self.assertEqual(rtgen.get_packet_plan(mytsrule, 'udp')[2].kind,
+                         rtgen.PLAN_NORMAL)
+
+        # Streams share the rule without changing it.
+        counts = []
+        for _ in range(2):
+            myts = rtgen.TrafficStream(mytsrule, SnifflesConfig())
+            count = 0
+            while myts.hasPackets():
+                myts.getNextPacket()
+                count += 1
+            counts.append(count)
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(len(mytsrule.getPkts()), 4)
+
+    def test_conversation_ordering(self):
+        rtgen.set_timing_distribution('constant')
+        try:
+            myrule = Rule("ordering")
+            for dport in ['[10]', '[20]']:
+                mytsrule = TrafficStreamRule('tcp', '1.1.1.1', '2.2.2.2',
+                                             '[100]', dport, -1, 4, False,
+                                             False, False)
+                mytsrule.addPktRule(RulePkt("to server", "/abc/", 0, 3))
+                myrule.addTS(mytsrule)
+            myconfig = SnifflesConfig()
+            myconfig.setLatency(1)
+            mycon = rtgen.Conversation(myrule, myconfig, 100, 999999)
+            self.assertEqual(mycon.getNextTime(), 100999999000)
+            self.assertEqual(mycon.getNextTimeStamp(), (100, 999999))
+            times = []
+            ports = []
+            while mycon.hasPackets():
+                time_ns, pkt = mycon.getNextPacketNs()
+                times.append(time_ns)
+                ports.append(struct.unpack('!H',
+                                           pkt.get_packet()[36:38])[0])
+            # Both streams start at the same time: no key is nudged and
+            # streams with equal times go out in activation order.
+            self.assertEqual(times, [100999999000, 100999999000,
+                                     101000000000, 101000000000,
+                                     101000001000, 101000001000])
+            self.assertEqual(ports, [10, 20, 10, 20, 10, 20])
+            self.assertEqual(mycon.getNextTime(), -1)
+        finally:
+            rtgen.set_timing_distribution()
+
+    def test_conversation_synch(self):
+        myrule = Rule("synch")
+        for dport, synch in [('[10]', True), ('[20]', False),
+                             ('[30]', False)]:
+            mytsrule = TrafficStreamRule('tcp', '1.1.1.1', '2.2.2.2',
+                                         '[100]', dport, -1, 4, synch,
+                                         False, False)
+            mytsrule.addPktRule(RulePkt("to server", "/abc/", 0, 2))
+            myrule.addTS(mytsrule)
+        mycon = rtgen.Conversation(myrule, SnifflesConfig(), 100)
+        self.assertEqual(mycon.getNumberOfStreams(), 3)
+        self.assertEqual((len(mycon.ts_active), len(mycon.ts)), (1, 2))
+        ports = []
+        active = []
+        times = []
+        while mycon.hasPackets():
+            time_ns, pkt = mycon.getNextPacketNs()
+            ports.append(struct.unpack('!H', pkt.get_packet()[36:38])[0])
+            active.append(len(mycon.ts_active))
+            times.append(time_ns)
+        # The synch stream finishes before the others start, and
+        # finished streams are released.
+        self.assertEqual(sorted(ports[:2]), [10, 10])
+        self.assertEqual(sorted(ports[2:]), [20, 20, 30, 30])
+        self.assertEqual(active[:2], [1, 2])
+        self.assertGreater(times[2], times[1])
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(active[-1], 0)
+        self.assertIsNone(mycon.getNextPacket())
+        self.assertEqual(mycon.getNextTimeStamp(), (-1, 0))
+
     def test_scan(self):
 
         rule = ScanAttackRule(rtgen.SYN_SCAN, '192.168.1.2', ['1', '2', '3', '4'],
@@ -793,6 +1157,34 @@ class TestRuleTrafficGenerator(unittest.TestCase):
         self.assertEqual(mypkt.get_size(), 54)
         self.assertEqual(mypkt.transport_hdr.get_flags(), rtgen.ACK)
 
+    def test_traffic_stream_frags_ipv6(self):
+        myrpkt = RulePkt("to server", "/abcdef/i", 3, 1, 300)
+        mytsrule = TrafficStreamRule('udp', '2001:db8::1', '2001:db8::2',
+                                     '[100:200]', '[10]', -1, 6)
+        mytsrule.addPktRule(myrpkt)
+        myConfig = SnifflesConfig()
+        myConfig.setIPV6Percent(100)
+        myts = rtgen.TrafficStream(mytsrule, myConfig)
+
+        segment = b''
+        frag_ids = set()
+        mypkt = myts.getNextPacket()
+        while mypkt is not None:
+            data = mypkt.get_packet()
+            ip = data[14:]
+            self.assertEqual(ip[6], rtgen.IPV6_FRAGMENT_HEADER)
+            self.assertEqual(struct.unpack('!H', ip[4:6])[0], len(ip) - 40)
+            next_hdr, _, frag, frag_id = struct.unpack('!BBHI', ip[40:48])
+            self.assertEqual(next_hdr, 17)
+            self.assertEqual(frag >> 3, len(segment) // 8)
+            frag_ids.add(frag_id)
+            segment += ip[48:]
+            mypkt = myts.getNextPacket()
+        self.assertEqual(len(frag_ids), 1)
+        self.assertNotIn(0, frag_ids)
+        self.assertEqual(len(segment), 308)
+        self.assertEqual(struct.unpack('!H', segment[4:6])[0], 308)
+
     def test_traffic_stream_ooo(self):
 
         myrpkt = RulePkt("to server", "/abcdef/i", 0, 5, 100, True, True)
@@ -0,0 +1,66 @@
+import random
+import unittest
+
+from sniffles.scheduler import (SCHEDULERS, HeapScheduler,
+                                TimingWheelScheduler, make_scheduler)
+from sniffles.snifflesconfig import SnifflesConfig
+
+
+class TestScheduler(unittest.TestCase):
+    def test_make_scheduler(self):
+        self.assertIsInstance(make_scheduler(), HeapScheduler)
+        self.assertIsInstance(make_scheduler('Wheel'), TimingWheelScheduler)
+        with self.assertRaises(ValueError):
+            make_scheduler('calendar')
+        self.assertEqual(SnifflesConfig(['--scheduler', 'wheel'])
+                         .getScheduler(), 'wheel')
+
+    def test_order(self):
+        # Interleave pushes and pops like the generator does: pop the
+        # earliest conversation and push it back a little later.  Every
+        # scheduler must agree with a plain sort on (time_ns, seq).
+        for name in SCHEDULERS:
+            random.seed(11)
+            scheduler = make_scheduler(name)
+            self.assertFalse(scheduler)
+            self.assertEqual(scheduler.peek_time(), -1)
+            expected = []
+            seq = 0
+            for flow in range(500):
+                time_ns = random.choice([5, 10 ** 9, 10 ** 15]) + \
+                    random.randrange(10 ** 7)
+                scheduler.push(time_ns, flow)
+                expected.append((time_ns, seq, flow))
+                seq += 1
+            popped = []
+            while scheduler:
+                expected.sort()
+                self.assertEqual(scheduler.peek_time(), expected[0][0])
+                time_ns, flow = scheduler.pop()
+                self.assertEqual((time_ns, flow), expected.pop(0)[::2])
+                popped.append(time_ns)
+                if len(popped) <= 3000:
+                    time_ns += random.choice([0, 0, 1, 999, 1000, 1001,
+                                              random.randrange(10 ** 10)])
+                    scheduler.push(time_ns, flow)
+                    expected.append((time_ns, seq, flow))
+                    seq += 1
+            self.assertEqual(len(popped), 3500, name)
+            self.assertEqual(popped, sorted(popped), name)
+            self.assertEqual(len(scheduler), 0)
+
+    def test_wheel_past(self):
+        scheduler = TimingWheelScheduler()
+        scheduler.push(5000, 'a')
+        scheduler.push(9000, 'b')
+        self.assertEqual(scheduler.pop(), (5000, 'a'))
+        self.assertEqual(scheduler.pop(), (9000, 'b'))
+        # Entries behind the current tick still come out first.
+        scheduler.push(20000, 'c')
+        scheduler.push(100, 'd')
+        self.assertEqual(scheduler.pop(), (100, 'd'))
+        self.assertEqual(scheduler.pop(), (20000, 'c'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from sniffles import sniffles
+from sniffles.shm_ring import RecordRing, merge_rings, shared_memory
+from sniffles.snifflesconfig import SnifflesConfig
+from sniffles.traffic_writer import TrafficWriter
+
+
+def fill_ring(ring, times):
+    for time_ns in times:
+        data = bytes([time_ns % 256]) * (1 + time_ns % 7)
+        ring.write_packet_ns(len(data), data, time_ns)
+        ring.write("Pkt 0 : " + str(time_ns) + "\n")
+    ring.close_save_file()
+
+
+def crash(ring):
+    ring.write_packet_ns(1, b'x', 5)
+    ring.write("Pkt 0 : x\n")
+    os._exit(1)
+
+
+@unittest.skipIf(shared_memory is None, "shared memory needs Python 3.8")
+class TestShmRing(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.rings = []
+
+    def tearDown(self):
+        for ring in self.rings:
+            ring.unlink()
+        shutil.rmtree(self.workdir)
+
+    def merge(self, shards, target=fill_ring):
+        # Tiny rings, so that the workers wrap around and wait for the
+        # writer many times.
+        context = multiprocessing.get_context('fork')
+        processes = []
+        for times in shards:
+            ring = RecordRing(100, 4, True)
+            self.rings.append(ring)
+            process = context.Process(target=target, args=(ring, times))
+            process.start()
+            ring.alive = process.is_alive
+            processes.append(process)
+        output = os.path.join(self.workdir, 'out.pcap')
+        writer = TrafficWriter(output, 0, True)
+        result = io.StringIO()
+        try:
+            total_pkts = merge_rings(self.rings, writer, result)
+        finally:
+            for process in processes:
+                process.join()
+            writer.close_save_file()
+        return total_pkts, result.getvalue()
+
+    def test_merge_rings(self):
+        shards = [list(range(0, 300, 3)), list(range(1, 300, 2)), []]
+        total_pkts, result = self.merge(shards)
+        self.assertEqual(total_pkts, 250)
+        expected = sorted([(time_ns, index)
+                           for index, times in enumerate(shards)
+                           for time_ns in times])
+        self.assertEqual(result.splitlines(),
+                         ["Pkt " + str(i + 1) + " : " + str(time_ns)
+                          for i, (time_ns, _) in enumerate(expected)])
+        # The same records written directly make the same pcap.
+        direct = os.path.join(self.workdir, 'direct.pcap')
+        writer = TrafficWriter(direct, 0, True)
+        for time_ns, _ in expected:
+            data = bytes([time_ns % 256]) * (1 + time_ns % 7)
+            writer.write_packet_ns(len(data), data, time_ns)
+        writer.close_save_file()
+        with open(direct, 'rb') as first, \
+                open(os.path.join(self.workdir, 'out.pcap'), 'rb') as second:
+            self.assertEqual(first.read(), second.read())
+
+    def test_dead_worker(self):
+        with self.assertRaises(RuntimeError):
+            self.merge([None], crash)
+
+    def test_shm_workers(self):
+        options = ['-c', '30', '-t', '-T', '-C', '4', '-g', '1000',
+                   '--seed', '3', '--workers', '3']
+        outputs = []
+        for extra in [[], ['--shm']]:
+            output = os.path.join(self.workdir, 'out' + str(len(extra)))
+            stats = sniffles.start_generation(SnifflesConfig(
+                options + extra + ['-o', output, '--resultfile',
+                                   output + '.txt']))
+            outputs.append((output, stats))
+        self.assertEqual(outputs[0][1], outputs[1][1])
+        for suffix in ['', '.txt']:
+            with open(outputs[0][0] + suffix, 'rb') as first, \
+                    open(outputs[1][0] + suffix, 'rb') as second:
+                self.assertEqual(first.read(), second.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import random
+import tempfile
+import unittest
+
+import sniffles.ruletrafficgenerator as rtgen
+from sniffles.rulereader import RulePkt, TrafficStreamRule
+from sniffles.snifflesconfig import SnifflesConfig
+from sniffles.timing import (NUMPY_MIN_SAMPLES, ConstantTiming,
+                             EmpiricalTiming, ExponentialTiming,
+                             LognormalTiming, parse_timing)
+
+
+class TestTiming(unittest.TestCase):
+    def test_parse_timing(self):
+        self.assertIsInstance(parse_timing(None), ExponentialTiming)
+        self.assertIsInstance(parse_timing('constant'), ConstantTiming)
+        mytiming = parse_timing('lognormal:2.5')
+        self.assertIsInstance(mytiming, LognormalTiming)
+        self.assertEqual(mytiming.param, 2.5)
+        self.assertEqual(str(mytiming), 'lognormal:2.5')
+        with self.assertRaises(ValueError):
+            parse_timing('gaussian')
+        with self.assertRaises(ValueError):
+            parse_timing('lognormal:0')
+        with self.assertRaises(ValueError):
+            parse_timing('empirical')
+
+    def test_sample(self):
+        for count in [5, NUMPY_MIN_SAMPLES * 10]:
+            for mytiming in [ExponentialTiming(), LognormalTiming()]:
+                gaps = mytiming.sample(100, count)
+                self.assertEqual(len(gaps), count)
+                self.assertTrue(all(type(gap) is int for gap in gaps))
+                self.assertGreaterEqual(min(gaps), 1)
+            self.assertEqual(ConstantTiming().sample(100, count),
+                             [100] * count)
+        gaps = ExponentialTiming().sample(100, 20000)
+        self.assertAlmostEqual(sum(gaps) / len(gaps), 101, delta=5)
+        gaps = LognormalTiming(0.5).sample(100, 20000)
+        self.assertAlmostEqual(sum(gaps) / len(gaps), 100, delta=5)
+
+        random.seed(7)
+        first = ExponentialTiming().sample(100, NUMPY_MIN_SAMPLES * 2)
+        random.seed(7)
+        second = ExponentialTiming().sample(100, NUMPY_MIN_SAMPLES * 2)
+        self.assertEqual(first, second)
+
+    def test_empirical(self):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as gap_file:
+            gap_file.write("# observed gaps\n10\n20\n\n30.5\n")
+        try:
+            mytiming = EmpiricalTiming(path)
+            for count in [5, NUMPY_MIN_SAMPLES * 2]:
+                gaps = mytiming.sample(1000, count)
+                self.assertEqual(len(gaps), count)
+                self.assertTrue(set(gaps) <= {10, 20, 30})
+            myconfig = SnifflesConfig(['--timing', 'empirical:' + path])
+            self.assertEqual(myconfig.getTiming(), 'empirical:' + path)
+        finally:
+            os.remove(path)
+
+    def test_stream_timeline(self):
+        rtgen.set_timing_distribution('constant')
+        try:
+            myrule = TrafficStreamRule('tcp', '1.1.1.1', '2.2.2.2', '[10]',
+                                       '[20]', -1, 4, False, True, True)
+            myrule.addPktRule(RulePkt("to server", "/abc/", 0, 3))
+            myconfig = SnifflesConfig()
+            myconfig.setLatency(250000)
+            myts = rtgen.TrafficStream(myrule, myconfig, 100, 0)
+            myts.sampleTimeline()
+            timeline = myts.getTimeline()
+            self.assertEqual(len(timeline), myts.getPacketsRemaining() + 1)
+            self.assertEqual(timeline[:3], [(100, 0), (100, 250000),
+                                            (100, 500000)])
+            sent = []
+            while myts.hasPackets():
+                sent.append(myts.getNextTimeStamp())
+                myts.getNextPacket()
+            self.assertEqual(sent, timeline[:len(sent)])
+        finally:
+            rtgen.set_timing_distribution()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import contextlib
+import io
+import os
+import struct
+import tempfile
+import unittest
+
+from sniffles import sniffles
+from sniffles.snifflesconfig import SnifflesConfig
+from sniffles.traffic_writer import (NSEC_PER_SEC, PCAP_MAGIC, PCAP_MAGIC_NSEC,
+                                     PCAPNG_EPB, PCAPNG_IDB, PCAPNG_SHB,
+                                     PcapngWriter, TrafficWriter)
+
+
+def read_pcap(path):
+    with open(path, 'rb') as pcap:
+        data = pcap.read()
+    magic = struct.unpack('I', data[:4])[0]
+    records = []
+    offset = 24
+    while offset < len(data):
+        sec, frac, incl, _ = struct.unpack('IIII', data[offset:offset + 16])
+        records.append((sec, frac, data[offset + 16:offset + 16 + incl]))
+        offset += 16 + incl
+    return magic, records
+
+
+def read_pcapng(path):
+    """
+        Returns the block types of a pcapng file and (time_ns, packet,
+        comment) for each of its Enhanced Packet Blocks.
+    """
+    with open(path, 'rb') as pcapng:
+        data = pcapng.read()
+    blocks = []
+    packets = []
+    offset = 0
+    while offset < len(data):
+        block_type, length = struct.unpack_from('<II', data, offset)
+        assert struct.unpack_from('<I', data, offset + length - 4)[0] == \
+            length
+        blocks.append(block_type)
+        if block_type == PCAPNG_EPB:
+            high, low, incl = struct.unpack_from('<III', data, offset + 12)
+            option = offset + 28 + incl + (-incl % 4)
+            comment = None
+            while option < offset + length - 4:
+                code, size = struct.unpack_from('<HH', data, option)
+                if code == 1:
+                    comment = data[option + 4:option + 4 + size].decode()
+                option += 4 + size + (-size % 4)
+            packets.append(((high << 32) | low,
+                            data[offset + 28:offset + 28 + incl], comment))
+        offset += length
+    return blocks, packets
+
+
+class TestTrafficWriter(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.pcap')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_write_packet(self):
+        writer = TrafficWriter(self.path, 100)
+        self.assertEqual(writer.write_packet(3, b'abc', 100, 1500000),
+                         (101, 500000))
+        self.assertEqual(writer.write_packet_ns(2, b'de', 102000000999),
+                         102000000999)
+        self.assertEqual(writer.get_sec_usec(), (102, 0))
+        writer.write_packet(1, b'f')
+        writer.close_save_file()
+        magic, records = read_pcap(self.path)
+        self.assertEqual(magic, PCAP_MAGIC)
+        self.assertEqual(records, [(101, 500000, b'abc'), (102, 0, b'de'),
+                                   (102, 0, b'f')])
+        self.assertEqual(writer.get_total_pkts(), 3)
+
+    def test_write_packet_nanosecond(self):
+        writer = TrafficWriter(self.path, 100, True)
+        writer.write_packet_ns(3, b'abc', 100000000001)
+        writer.write_packet(2, b'de', 100, 2)
+        writer.close_save_file()
+        magic, records = read_pcap(self.path)
+        self.assertEqual(magic, PCAP_MAGIC_NSEC)
+        self.assertEqual(records, [(100, 1, b'abc'), (100, 2000, b'de')])
+
+    def test_write_packets(self):
+        writer = TrafficWriter(self.path, 0, True, 64)
+        self.assertEqual(writer.write_packets([(5, b'abc'), (6, b''),
+                                               (NSEC_PER_SEC + 7, b'x' * 40),
+                                               (NSEC_PER_SEC + 8, b'y' * 80)]),
+                         NSEC_PER_SEC + 8)
+        self.assertEqual(writer.get_total_pkts(), 3)
+        # The buffer is written out before each of the larger records,
+        # and the last one, larger than the buffer, is written directly.
+        self.assertEqual(writer.get_write_stats()[:2],
+                         (24 + 19 + 56 + 96, 3))
+        writer.write_packet_ns(2, b'de')
+        writer.close_save_file()
+        self.assertEqual(writer.get_write_stats()[:2],
+                         (24 + 19 + 56 + 96 + 18, 4))
+        with open(self.path, 'rb') as pcap:
+            data = pcap.read()
+        self.assertEqual(data[:4], b'\x4d\x3c\xb2\xa1')
+        self.assertEqual(data[24:40], struct.pack('<IIII', 0, 5, 3, 3))
+        magic, records = read_pcap(self.path)
+        self.assertEqual(records, [(0, 5, b'abc'), (1, 7, b'x' * 40),
+                                   (1, 8, b'y' * 80), (1, 8, b'de')])
+
+    def test_write_records(self):
+        writer = TrafficWriter(self.path, 0)
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            writer.write_records(b'', 0)
+            writer.write_records(struct.pack('<IIII', 7, 9, 2, 2) + b'de', 1,
+                                 7, 9)
+        writer.close_save_file()
+        self.assertEqual(out.getvalue(), '')
+        self.assertEqual(writer.get_total_pkts(), 1)
+        self.assertEqual(read_pcap(self.path)[1], [(7, 9, b'de')])
+
+    def test_pcapng_writer(self):
+        writer = PcapngWriter(self.path, 100, False, 64)
+        writer.write_packet_ns(3, b'abc', 100 * NSEC_PER_SEC + 1, 'rule = 1')
+        writer.write_packets([(100 * NSEC_PER_SEC + 2, b'de'),
+                              (100 * NSEC_PER_SEC + 3, b''),
+                              (2 ** 32 * NSEC_PER_SEC, b'f' * 70, 'x' * 5)])
+        writer.close_save_file()
+        self.assertEqual(writer.get_total_pkts(), 3)
+        with open(self.path, 'rb') as pcapng:
+            self.assertEqual(pcapng.read(12)[8:], b'\x4d\x3c\x2b\x1a')
+        blocks, packets = read_pcapng(self.path)
+        self.assertEqual(blocks, [PCAPNG_SHB, PCAPNG_IDB] + [PCAPNG_EPB] * 3)
+        self.assertEqual(packets, [
+            (100 * NSEC_PER_SEC + 1, b'abc', 'rule = 1'),
+            (100 * NSEC_PER_SEC + 2, b'de', None),
+            (2 ** 32 * NSEC_PER_SEC, b'f' * 70, 'x' * 5)])
+
+    def test_pcapng_generation(self):
+        result = self.path + '.txt'
+        sconf = SnifflesConfig(['-c', '20', '-p', '2', '-g', '1000',
+                                '-f', 'tests/data_files/rules.txt',
+                                '-o', self.path, '--resultfile', result,
+                                '--pcapng', '--pipeline'])
+        with contextlib.redirect_stdout(io.StringIO()):
+            stats = sniffles.start_generation(sconf)
+        self.assertFalse(os.path.exists(result))
+        blocks, packets = read_pcapng(self.path)
+        self.assertEqual(blocks[:2], [PCAPNG_SHB, PCAPNG_IDB])
+        self.assertEqual(len(packets), stats[1])
+        self.assertEqual(len(packets), 40)
+        times = [time_ns for time_ns, _, _ in packets]
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(times[0] // NSEC_PER_SEC, 1000)
+        for _, _, comment in packets:
+            self.assertRegex(comment, r'^rule = [^,]+, ts idx = 0')
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(SystemExit):
+                SnifflesConfig(['--pcapng', '--workers', '2'])
+
+
+if __name__ == '__main__':
+    unittest.main()